@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета: чем меньше число, тем раньше запрос получает слот
+LIVE = 0  # Ответ в диалоге
+COMMAND = 1  # /compliment, /motivate
+BACKGROUND = 2  # Рассылка по расписанию, заблаговременная генерация, пул, сводки
+PRIORITY_NAMES = {LIVE: 'live', COMMAND: 'command', BACKGROUND: 'background'}
+
+
+class AdmissionError(Exception):
+    """Запрос к LLM не допущен к выполнению"""
+
+
+class OverloadedError(AdmissionError):
+    """Очередь запросов переполнена"""
+
+
+class DeadlineExceeded(AdmissionError):
+    """Запрос прождал в очереди дольше своего срока"""
+
+
+class _Waiter:
+    __slots__ = ('future', 'user', 'deadline', 'enqueued', 'queued')
+
+    def __init__(self, future, user, deadline: float):
+        self.future = future
+        self.user = user
+        self.deadline = deadline
+        self.enqueued = time.monotonic()
+        self.queued = True
+
+
+class AdmissionController:
+    """Допуск запросов к LLM: не больше max_concurrency одновременно.
+
+    Ожидающие обслуживаются строго по классам приоритета, внутри класса —
+    по кругу между пользователями, так что один активный пользователь не
+    занимает очередь целиком. Фоновый класс может занять не больше
+    background_share слотов, чтобы интерактивным всегда оставалось место.
+    При переполнении очереди класса (или per_user_limit запросов одного
+    пользователя) запрос сразу отклоняется, а не дождавшийся слота до
+    своего срока — снимается с очереди.
+    """
+
+    def __init__(self, max_concurrency: int, queue_limits: dict, deadlines: dict,
+                 per_user_limit: int = 3, background_share: float = 0.5):
+        self.capacity = max_concurrency
+        self.queue_limits = queue_limits
+        self.deadlines = deadlines
+        self.per_user_limit = per_user_limit
+        self.class_limits = {BACKGROUND: max(1, math.ceil(max_concurrency * background_share))}
+        self.active = 0
+        self.active_by_class = {priority: 0 for priority in PRIORITY_NAMES}
+        self.queues = {priority: OrderedDict() for priority in PRIORITY_NAMES}  # user -> deque[_Waiter]
+        self.queued = {priority: 0 for priority in PRIORITY_NAMES}
+        self.shed = 0
+        self.expired = 0
+
+    def deadline_for(self, priority: int) -> float:
+        return time.monotonic() + self.deadlines[priority]
+
+    def can_run(self, priority: int) -> bool:
+        return (self.active < self.capacity
+                and self.active_by_class[priority] < self.class_limits.get(priority, self.capacity))
+
+    @asynccontextmanager
+    async def slot(self, priority: int, user=None, deadline: float = None):
+        """Занять слот на время блока"""
+        await self.acquire(priority, user, deadline)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    async def acquire(self, priority: int, user=None, deadline: float = None):
+        name = PRIORITY_NAMES[priority]
+        if deadline is None:
+            deadline = self.deadline_for(priority)
+        # Без очереди, если слот свободен и никто того же или более важного класса не ждёт
+        if self.can_run(priority) and not any(self.queued[p] for p in PRIORITY_NAMES if p <= priority):
+            self.start(priority)
+            registry.observe('llm_admission_wait_seconds', 0.0, priority=name)
+            return
+
+        if self.queued[priority] >= self.queue_limits[priority]:
+            self.reject(priority, 'queue_full')
+        waiters = self.queues[priority].get(user)
+        if user is not None and waiters and len(waiters) >= self.per_user_limit:
+            self.reject(priority, 'user_limit')
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), user, deadline)
+        self.queues[priority].setdefault(user, deque()).append(waiter)
+        self.queued[priority] += 1
+        try:
+            await asyncio.wait_for(waiter.future, timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            self.discard(priority, waiter)
+            self.expired += 1
+            registry.inc('llm_shed_total', priority=name, reason='deadline')
+            raise DeadlineExceeded(f"Запрос {name} не дождался очереди")
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                # Слот успели выдать одновременно с отменой — возвращаем его
+                self.release(priority)
+            else:
+                self.discard(priority, waiter)
+            raise
+        registry.observe('llm_admission_wait_seconds', time.monotonic() - waiter.enqueued, priority=name)
+
+    def reject(self, priority: int, reason: str):
+        self.shed += 1
+        registry.inc('llm_shed_total', priority=PRIORITY_NAMES[priority], reason=reason)
+        raise OverloadedError(f"Очередь {PRIORITY_NAMES[priority]} переполнена ({reason})")
+
+    def start(self, priority: int):
+        self.active += 1
+        self.active_by_class[priority] += 1
+
+    def release(self, priority: int):
+        self.active -= 1
+        self.active_by_class[priority] -= 1
+        self.dispatch()
+
+    def discard(self, priority: int, waiter: _Waiter):
+        """Убрать ожидающего из очереди (истёк срок или отменён)"""
+        if not waiter.queued:
+            return
+        waiter.queued = False
+        users = self.queues[priority]
+        waiters = users.get(waiter.user)
+        if waiters is not None:
+            waiters.remove(waiter)
+            if not waiters:
+                del users[waiter.user]
+        self.queued[priority] -= 1
+
+    def pop_next(self, priority: int) -> _Waiter:
+        """Следующий ожидающий класса: по кругу между пользователями"""
+        users = self.queues[priority]
+        user, waiters = next(iter(users.items()))
+        waiter = waiters.popleft()
+        if waiters:
+            users.move_to_end(user)
+        else:
+            del users[user]
+        waiter.queued = False
+        self.queued[priority] -= 1
+        return waiter
+
+    def dispatch(self):
+        """Выдать освободившиеся слоты ожидающим, начиная с самого важного класса"""
+        now = time.monotonic()
+        for priority in sorted(PRIORITY_NAMES):
+            while self.queued[priority] and self.can_run(priority):
+                waiter = self.pop_next(priority)
+                if waiter.future.done():
+                    continue
+                if waiter.deadline <= now:
+                    self.expired += 1
+                    registry.inc('llm_shed_total', priority=PRIORITY_NAMES[priority], reason='deadline')
+                    waiter.future.set_exception(DeadlineExceeded(f"Запрос {PRIORITY_NAMES[priority]} не дождался очереди"))
+                    continue
+                self.start(priority)
+                waiter.future.set_result(None)
@@ -0,0 +1,459 @@
+"""Нагрузочный тест бота без обращения к настоящим Telegram и GigaChat.
+
+Обработчики GentlemanBot получают синтетические обновления из воспроизводимой
+нагрузки (число пользователей, частота сообщений, доля команд), GigaChat
+заменён заглушкой с настраиваемыми задержкой и долей ошибок, Bot API —
+заглушкой, которая записывает отправленные сообщения. Для каждой фазы
+печатаются пропускная способность, p50/p95/p99 задержки до первого ответа,
+задержка цикла событий, записи на диск и RSS.
+
+Примеры:
+    python bench.py --users 500 --rate 50 --duration 30
+    python bench.py --save workload.jsonl
+    python bench.py --replay workload.jsonl --llm-error-rate 0.05 --json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from gigachat.exceptions import ResponseError
+from telegram.request import BaseRequest
+
+PHRASES = [
+    "Привет! Как дела?",
+    "Расскажи что-нибудь хорошее",
+    "У меня сегодня тяжёлый день",
+    "Что почитать вечером?",
+    "Спасибо, вы очень любезны",
+    "Посоветуйте, как настроиться на работу",
+    "Как провести выходные с пользой?",
+]
+COMMANDS = ["compliment", "motivate"]
+WORDS = (
+    "сегодня ваш день полон света и тихой уверенности каждый шаг приближает к цели "
+    "вы умеете вдохновлять окружающих своей добротой и вкусом ваша улыбка согревает "
+    "даже хмурое утро смелость и терпение всегда вознаграждаются"
+).split()
+
+
+def make_workload(users: int, rate: float, duration: float, command_share: float, seed: int) -> list:
+    """Пуассоновский поток событий: сообщения и команды от случайных пользователей"""
+    rng = random.Random(seed)
+    events = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(rate)
+        if t >= duration:
+            break
+        user_id = 100000 + rng.randrange(users)
+        if rng.random() < command_share:
+            events.append({"t": round(t, 4), "user": user_id, "command": rng.choice(COMMANDS)})
+        else:
+            events.append({"t": round(t, 4), "user": user_id, "text": rng.choice(PHRASES)})
+    return events
+
+
+def save_workload(path: str, events: list):
+    with open(path, 'w', encoding='utf-8') as f:
+        for event in events:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+def load_workload(path: str) -> list:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values: list, q: float) -> float:
+    """Процентиль q (0..100) по отсортированной выборке, без интерполяции"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def rss_mb() -> float:
+    """Текущий RSS процесса (или пиковый, если /proc недоступен)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def disk_write_bytes():
+    """Байт записано процессом на диск (None, если /proc/self/io недоступен)"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class FakeGigaChat:
+    """Заглушка GigaChat: отвечает случайным текстом после случайной задержки,
+    с вероятностью error_rate — временной ошибкой 503"""
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.2, error_rate: float = 0.0,
+                 stream_chunks: int = 8, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.stream_chunks = stream_chunks
+        self.rng = random.Random(seed)
+        self.requests = 0
+
+    async def delay(self, share: float = 1.0):
+        await asyncio.sleep(max(0.0, self.rng.gauss(self.latency, self.jitter)) * share)
+
+    def maybe_fail(self):
+        if self.rng.random() < self.error_rate:
+            raise ResponseError("fake://chat/completions", 503, b"overloaded", {})
+
+    def text(self) -> str:
+        return " ".join(self.rng.choices(WORDS, k=self.rng.randint(12, 25))).capitalize() + "."
+
+    async def achat(self, payload):
+        self.requests += 1
+        await self.delay()
+        self.maybe_fail()
+        message = SimpleNamespace(content=self.text())
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    async def astream(self, payload):
+        self.requests += 1
+        words = self.text().split()
+        step = max(1, len(words) // self.stream_chunks)
+        for i in range(0, len(words), step):
+            await self.delay(1 / self.stream_chunks)
+            self.maybe_fail()
+            delta = SimpleNamespace(content=" ".join(words[i:i + step]) + " ")
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+    async def aget_token(self):
+        return SimpleNamespace(access_token="bench", expires_at=int((time.time() + 1800) * 1000))
+
+    def _reset_token(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+
+class FakeTelegram(BaseRequest):
+    """Заглушка Bot API: записывает отправленные сообщения и считает задержку
+    от поступления обновления до первого ответа в этот чат"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.message_id = 0
+        self.calls = {}  # метод -> число вызовов
+        self.waiting = {}  # chat_id -> моменты поступления ещё не отвеченных обновлений
+        self.latencies = []
+        self.sent = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def expect_reply(self, chat_id: int):
+        self.waiting.setdefault(chat_id, []).append(time.monotonic())
+
+    def pending_replies(self) -> int:
+        return sum(len(times) for times in self.waiting.values())
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if endpoint == 'getMe':
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0))
+            if endpoint == 'sendMessage':
+                self.sent += 1
+                self.message_id += 1
+                # Склеенные сообщения пользователя получают один общий ответ
+                for received in self.waiting.pop(chat_id, ()):
+                    self.latencies.append(time.monotonic() - received)
+            result = {
+                "message_id": params.get('message_id', self.message_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get('text', ''),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode('utf-8')
+
+
+class LoopLagMonitor:
+    """Задержка цикла событий: насколько позже положенного просыпается sleep(interval)"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples = []
+        self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(loop.time() - started - self.interval)
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+
+def count_loop_thread_writes(store, counter: dict):
+    """Считать записи бэкенда хранилища, выполненные прямо в потоке цикла событий:
+    так ловится save_*, вернувшийся на горячий путь"""
+    write = store.backend.write
+    loop_thread = threading.current_thread()
+
+    def counted_write(name, changes):
+        if threading.current_thread() is loop_thread:
+            counter['loop_thread_writes'] += 1
+        return write(name, changes)
+
+    store.backend.write = counted_write
+
+
+def make_update(update_id: int, event: dict) -> dict:
+    user_id = event["user"]
+    text = f"/{event['command']}" if "command" in event else event["text"]
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": f"User{user_id}"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        "text": text,
+    }
+    if "command" in event:
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": update_id, "message": message}
+
+
+class Phase:
+    """Замер одной фазы: снимки счётчиков до и после"""
+
+    def __init__(self, name: str, gentleman, telegram: FakeTelegram, counter: dict):
+        self.name = name
+        self.gentleman = gentleman
+        self.telegram = telegram
+        self.counter = counter
+        self.lag = LoopLagMonitor()
+
+    def __enter__(self):
+        self.telegram.latencies = []
+        self.sent = self.telegram.sent
+        self.records = self.gentleman.storage.records_written
+        self.loop_writes = self.counter['loop_thread_writes']
+        self.disk = disk_write_bytes()
+        self.started = time.monotonic()
+        self.lag.start()
+        return self
+
+    async def finish(self, requests: int) -> dict:
+        elapsed = time.monotonic() - self.started
+        await self.lag.stop()
+        # Сбрасываем отложенные записи, чтобы они попали в замер своей фазы
+        await self.gentleman.storage.flush()
+        disk = disk_write_bytes()
+        latencies = self.telegram.latencies
+        return {
+            "phase": self.name,
+            "requests": requests,
+            "replies": self.telegram.sent - self.sent,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_rps": round((self.telegram.sent - self.sent) / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+            "loop_lag_p99_ms": round(percentile(self.lag.samples, 99) * 1000, 2),
+            "loop_lag_max_ms": round(max(self.lag.samples, default=0.0) * 1000, 2),
+            "records_written": self.gentleman.storage.records_written - self.records,
+            "loop_thread_writes": self.counter['loop_thread_writes'] - self.loop_writes,
+            "disk_write_kb": round((disk - self.disk) / 1024, 1) if disk is not None else None,
+            "rss_mb": round(rss_mb(), 1),
+        }
+
+    def __exit__(self, *exc):
+        return False
+
+
+async def run_updates(app, telegram: FakeTelegram, events: list, drain_timeout: float):
+    """Подать события в приложение по их меткам времени и дождаться ответов"""
+    from telegram import Update
+
+    started = time.monotonic()
+    for update_id, event in enumerate(events, 1):
+        delay = started + event["t"] - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        telegram.expect_reply(event["user"])
+        await app.update_queue.put(Update.de_json(make_update(update_id, event), app.bot))
+
+    deadline = time.monotonic() + drain_timeout
+    while telegram.pending_replies() and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+
+async def run_scheduled(gentleman, app, telegram: FakeTelegram, users: int, pregen: bool, drain_timeout: float):
+    """Разослать мотивации users пользователям, записанным на одну минуту"""
+    import bot
+    from telegram.ext import CallbackContext
+
+    now = datetime.now() + timedelta(seconds=30)
+    slot = now.hour * 60 + now.minute
+    for i in range(users):
+        user_id_str = str(900000 + i)
+        gentleman.user_schedules[user_id_str] = {'times': [bot.format_slot(slot)], 'enabled': True}
+        gentleman.index_schedule(user_id_str)
+    if pregen:
+        await gentleman.pregenerate_slot(slot, set(gentleman.schedule_index.get(slot, ())))
+
+    expected = telegram.sent + users
+    # Задержка рассылки отсчитывается от наступления слота
+    for user_id_str in gentleman.schedule_index.get(slot, ()):
+        telegram.expect_reply(int(user_id_str))
+    gentleman.last_schedule_slot = (slot - 1) % bot.MINUTES_PER_DAY
+    await gentleman.scheduled_message(CallbackContext(app))
+
+    deadline = time.monotonic() + drain_timeout
+    while telegram.sent < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+
+async def bench(args, events: list) -> list:
+    import bot
+
+    telegram = FakeTelegram(args.telegram_latency)
+    giga = FakeGigaChat(args.llm_latency, args.llm_jitter, args.llm_error_rate, seed=args.seed)
+    gentleman = bot.GentlemanBot()
+    counter = {'loop_thread_writes': 0}
+    count_loop_thread_writes(gentleman.storage, counter)
+
+    app = gentleman.build_application(with_updater=False, request=telegram)
+    # Минутный тик планировщика не должен вмешиваться в замеры
+    for job in app.job_queue.jobs():
+        job.schedule_removal()
+    await app.initialize()
+    await app.start()
+    gentleman.start_services(giga=giga)
+
+    results = []
+    try:
+        if events:
+            with Phase("updates", gentleman, telegram, counter) as phase:
+                await run_updates(app, telegram, events, args.drain_timeout)
+                results.append(await phase.finish(len(events)))
+        if args.scheduled_users:
+            with Phase("scheduled", gentleman, telegram, counter) as phase:
+                await run_scheduled(gentleman, app, telegram, args.scheduled_users, args.pregen, args.drain_timeout)
+                results.append(await phase.finish(args.scheduled_users))
+    finally:
+        await gentleman.stop_services(app)
+    for result in results:
+        result["llm_requests"] = giga.requests
+        result["pool_hits"] = gentleman.pool.hits
+        result["cache_hit_rate"] = round(gentleman.response_cache.hit_rate, 3)
+    return results
+
+
+def print_report(results: list):
+    columns = [
+        ("phase", "фаза"), ("requests", "запросов"), ("replies", "ответов"), ("throughput_rps", "отв/с"),
+        ("p50_ms", "p50 мс"), ("p95_ms", "p95 мс"), ("p99_ms", "p99 мс"),
+        ("loop_lag_p99_ms", "лаг p99"), ("loop_lag_max_ms", "лаг max"),
+        ("records_written", "записей"), ("loop_thread_writes", "записей в цикле"),
+        ("disk_write_kb", "диск КБ"), ("rss_mb", "RSS МБ"),
+    ]
+    widths = [max(len(title), *(len(str(r[key])) for r in results)) for key, title in columns]
+    print("  ".join(title.rjust(width) for (_, title), width in zip(columns, widths)))
+    for result in results:
+        print("  ".join(str(result[key]).rjust(width) for (key, _), width in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с заглушками Telegram и GigaChat")
+    parser.add_argument('--users', type=int, default=200, help="число пользователей")
+    parser.add_argument('--rate', type=float, default=20.0, help="сообщений в секунду")
+    parser.add_argument('--duration', type=float, default=20.0, help="длительность потока сообщений, с")
+    parser.add_argument('--command-share', type=float, default=0.3, help="доля команд /compliment и /motivate")
+    parser.add_argument('--scheduled-users', type=int, default=200, help="пользователей в одном слоте рассылки")
+    parser.add_argument('--pregen', action='store_true', help="заранее сгенерировать персональные мотивации")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help="сохранить нагрузку в JSONL и выйти")
+    parser.add_argument('--replay', help="взять нагрузку из JSONL")
+    parser.add_argument('--llm-latency', type=float, default=0.5, help="средняя задержка GigaChat, с")
+    parser.add_argument('--llm-jitter', type=float, default=0.2, help="разброс задержки GigaChat, с")
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help="доля временных ошибок GigaChat")
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help="задержка Bot API, с")
+    parser.add_argument('--drain-timeout', type=float, default=60.0, help="сколько ждать оставшиеся ответы, с")
+    parser.add_argument('--json', action='store_true', help="вывести результат в JSON")
+    args = parser.parse_args()
+
+    if args.replay:
+        events = load_workload(args.replay)
+    else:
+        events = make_workload(args.users, args.rate, args.duration, args.command_share, args.seed)
+    if args.save:
+        save_workload(args.save, events)
+        print(f"Сохранено событий: {len(events)} -> {args.save}")
+        return
+
+    # Состояние и журнал бота — во временном каталоге, настоящие ключи не нужны
+    workdir = tempfile.mkdtemp(prefix='gentleman-bench-')
+    os.chdir(workdir)
+    os.environ['TELEGRAM_TOKEN'] = '123456:bench'
+    os.environ['GIGACHAT_API_KEY'] = 'bench'
+    os.environ['STATE_DB_FILE'] = os.path.join(workdir, 'bot_state.db')
+    os.environ.pop('TELEGRAM_API_URL', None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import logging
+    import bot  # noqa: F401 — импорт после настройки окружения
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = asyncio.run(bench(args, events))
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print(f"Каталог состояния: {workdir}")
+        print_report(results)
+
+
+if __name__ == '__main__':
+    main()
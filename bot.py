@@ -1,19 +1,48 @@
 import os
 import logging
-from datetime import time, datetime
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import Bot, Update
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from gigachat import GigaChat
 from gigachat.models import Chat, Messages, MessagesRole
 import random
 import asyncio
-import json
-from pathlib import Path
+from time import monotonic
+from collections import OrderedDict, deque
+
+import storage
+from broadcast import Broadcaster, retry_after_seconds
+from pool import ResponsePool
+import similarity
+from dialogs import DialogCache
+from cache import ResponseCache
+from llm import GigaChatClient, CircuitBreaker, CircuitOpenError
+import candidates
+from routing import ModelRouter, Route, DIALOG, SHORT, SUMMARY, parse_models
+import cluster
+from admission import AdmissionController, AdmissionError, LIVE, COMMAND, BACKGROUND, PRIORITY_NAMES
+import logs
+from logs import SAMPLED
+import metrics
+import profiling
+from metrics import registry
+from storage import SCHEDULES, NAMES, DIALOGS, COMPLIMENTS, SUMMARIES
 
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+# Режим вебхука: если задан WEBHOOK_URL, обновления принимает локальный HTTP-сервер вместо long polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # Публичный адрес, например https://bot.example.com
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+# Альтернативные адреса API (например, локальные заглушки Telegram и GigaChat для нагрузочных тестов)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '')  # По умолчанию https://api.telegram.org/bot
+GIGACHAT_BASE_URL = os.getenv('GIGACHAT_BASE_URL', '')
+GIGACHAT_AUTH_URL = os.getenv('GIGACHAT_AUTH_URL', '')
 GIGACHAT_API_KEY = os.getenv('GIGACHAT_API_KEY')
 
 try:
@@ -25,16 +54,131 @@ SCHEDULES_FILE = 'user_schedules.json'
 NAMES_FILE = 'user_names.json'
 DIALOGS_FILE = 'user_dialogs.json'
 COMPLIMENTS_FILE = 'user_compliments.json'
+SUMMARIES_FILE = 'user_summaries.json'
 MAX_DIALOG_HISTORY = 15  # Максимум сообщений в истории на пользователя
+MAX_COMPLIMENT_HISTORY = 20  # Сколько последних комплиментов помнить (для проверки повторов)
+STATE_FILES = {
+    SCHEDULES: SCHEDULES_FILE,
+    NAMES: NAMES_FILE,
+    DIALOGS: DIALOGS_FILE,
+    COMPLIMENTS: COMPLIMENTS_FILE,
+    SUMMARIES: SUMMARIES_FILE,
+}
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')  # 'sqlite' или 'json'
+STATE_DB_FILE = os.getenv('STATE_DB_FILE', 'bot_state.db')
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except (ValueError, TypeError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except (ValueError, TypeError):
+        return default
+
+
+GIGACHAT_MAX_CONCURRENCY = _env_int('GIGACHAT_MAX_CONCURRENCY', 8)  # Одновременных запросов к GigaChat
+GIGACHAT_TIMEOUT = _env_float('GIGACHAT_TIMEOUT', 30.0)  # Таймаут одного запроса, секунд
+GIGACHAT_MAX_RETRIES = _env_int('GIGACHAT_MAX_RETRIES', 2)  # Повторов при временных ошибках
+GIGACHAT_TOKEN_REFRESH_INTERVAL = _env_float('GIGACHAT_TOKEN_REFRESH_INTERVAL', 60.0)  # Повтор неудачного обновления токена, секунд
+GIGACHAT_TOKEN_REFRESH_MARGIN = _env_float('GIGACHAT_TOKEN_REFRESH_MARGIN', 120.0)  # Обновлять токен за столько секунд до истечения
+CIRCUIT_FAILURE_THRESHOLD = _env_int('CIRCUIT_FAILURE_THRESHOLD', 5)  # Ошибок подряд до отключения запросов
+CIRCUIT_RESET_TIMEOUT = _env_float('CIRCUIT_RESET_TIMEOUT', 30.0)  # Пауза перед пробным запросом, секунд
+# Допуск запросов к GigaChat: диалог важнее команд, команды важнее рассылок и фоновой генерации
+ADMISSION_QUEUE_LIVE = _env_int('ADMISSION_QUEUE_LIVE', 200)  # Ожидающих в очереди класса, сверх — отказ
+ADMISSION_QUEUE_COMMAND = _env_int('ADMISSION_QUEUE_COMMAND', 200)
+ADMISSION_QUEUE_BACKGROUND = _env_int('ADMISSION_QUEUE_BACKGROUND', 1000)
+ADMISSION_DEADLINE_LIVE = _env_float('ADMISSION_DEADLINE_LIVE', 20.0)  # Сколько запрос может ждать слота, секунд
+ADMISSION_DEADLINE_COMMAND = _env_float('ADMISSION_DEADLINE_COMMAND', 30.0)
+ADMISSION_DEADLINE_BACKGROUND = _env_float('ADMISSION_DEADLINE_BACKGROUND', 120.0)
+ADMISSION_PER_USER = _env_int('ADMISSION_PER_USER', 3)  # Ожидающих запросов одного пользователя в классе
+ADMISSION_BACKGROUND_SHARE = _env_float('ADMISSION_BACKGROUND_SHARE', 0.5)  # Доля слотов для фоновых запросов
+PERSIST_INTERVAL = _env_float('PERSIST_INTERVAL', 5.0)  # Период сброса изменений на диск, секунд
+PERSIST_MAX_PENDING = _env_int('PERSIST_MAX_PENDING', 500)  # Досрочный сброс при стольких изменениях
+BROADCAST_WORKERS = _env_int('BROADCAST_WORKERS', 16)  # Параллельных отправок при рассылке
+BROADCAST_RATE = _env_float('BROADCAST_RATE', 25.0)  # Глобальный лимит Telegram, сообщений в секунду
+BROADCAST_CHAT_INTERVAL = _env_float('BROADCAST_CHAT_INTERVAL', 1.0)  # Пауза между сообщениями в один чат
+SCHEDULE_PREGEN_MINUTES = _env_int('SCHEDULE_PREGEN_MINUTES', 10)  # За сколько минут до слота готовить сообщения
+SCHEDULE_PREGEN_CONCURRENCY = _env_int('SCHEDULE_PREGEN_CONCURRENCY', 4)  # Параллельных генераций для слота
+MINUTES_PER_DAY = 24 * 60
+# Все обработчики работают только с новыми сообщениями — остальные типы обновлений не запрашиваем
+ALLOWED_UPDATES = [Update.MESSAGE]
+POOL_SIZE = _env_int('POOL_SIZE', 10)  # Готовых ответов в каждом пуле
+POOL_LOW_WATERMARK = _env_int('POOL_LOW_WATERMARK', 3)  # При стольких оставшихся пул дозаполняется
+POOL_TTL = _env_float('POOL_TTL', 6 * 3600.0)  # Срок свежести готового ответа, секунд
+POOL_REFILL_CONCURRENCY = _env_int('POOL_REFILL_CONCURRENCY', 2)  # Параллельных генераций при пополнении
+POOL_NAME_MIN_REQUESTS = _env_int('POOL_NAME_MIN_REQUESTS', 3)  # С какого числа запросов имя получает свой пул
+POOL_MAX_NAME_POOLS = _env_int('POOL_MAX_NAME_POOLS', 50)  # Сколько именных пулов держать
+COMPLIMENT_SIMILARITY_THRESHOLD = _env_float('COMPLIMENT_SIMILARITY_THRESHOLD', 0.4)  # Сходство, с которого комплимент считается повтором
+COMPLIMENT_MAX_ATTEMPTS = _env_int('COMPLIMENT_MAX_ATTEMPTS', 3)  # Попыток получить непохожий комплимент
+# Вариантов за один запрос к GigaChat: подсказка оплачивается один раз, лишние варианты идут в запас
+COMPLIMENT_CANDIDATES = _env_int('COMPLIMENT_CANDIDATES', 3)
+POOL_BATCH_SIZE = _env_int('POOL_BATCH_SIZE', 5)
+DIALOG_CACHE_USERS = _env_int('DIALOG_CACHE_USERS', 5000)  # Сколько историй диалогов держать в памяти
+STATE_CACHE_USERS = _env_int('STATE_CACHE_USERS', 10000)  # Имён и историй комплиментов в памяти (остальные — в хранилище)
+DIALOG_IDLE_TTL = _env_float('DIALOG_IDLE_TTL', 1800.0)  # Через сколько секунд молчания история выгружается
+CONTEXT_TOKEN_BUDGET = _env_int('CONTEXT_TOKEN_BUDGET', 1200)  # Лимит токенов на подсказку диалога
+SUMMARY_EVERY_TURNS = _env_int('SUMMARY_EVERY_TURNS', 4)  # Обновлять сводку беседы каждые K обменов
+SUMMARY_MAX_TOKENS = _env_int('SUMMARY_MAX_TOKENS', 200)  # Длина сводки беседы
+# Модели по задачам (через запятую, в порядке предпочтения) и потолок токенов ответа:
+# беседа — сильной модели, короткие комплименты и мотивации — лёгкой и быстрой
+GIGACHAT_MODELS_DIALOG = parse_models(os.getenv('GIGACHAT_MODELS_DIALOG', 'GigaChat-Pro,GigaChat'))
+GIGACHAT_MODELS_SHORT = parse_models(os.getenv('GIGACHAT_MODELS_SHORT', 'GigaChat,GigaChat-Pro'))
+GIGACHAT_MODELS_SUMMARY = parse_models(os.getenv('GIGACHAT_MODELS_SUMMARY', 'GigaChat,GigaChat-Pro'))
+DIALOG_MAX_TOKENS = _env_int('DIALOG_MAX_TOKENS', 512)
+SHORT_MAX_TOKENS = _env_int('SHORT_MAX_TOKENS', 200)  # 1-2 предложения с запасом
+# Бюджет средней задержки: медленнее — трафик задачи уходит на следующую модель
+ROUTE_LATENCY_DIALOG = _env_float('ROUTE_LATENCY_DIALOG', 15.0)
+ROUTE_LATENCY_SHORT = _env_float('ROUTE_LATENCY_SHORT', 8.0)
+ROUTE_LATENCY_SUMMARY = _env_float('ROUTE_LATENCY_SUMMARY', 30.0)
+ROUTE_WINDOW = _env_float('ROUTE_WINDOW', 300.0)  # Окно статистики моделей, секунд
+ROUTE_MIN_SAMPLES = _env_int('ROUTE_MIN_SAMPLES', 10)  # Запросов в окне до первых выводов о модели
+ROUTE_MAX_ERROR_RATE = _env_float('ROUTE_MAX_ERROR_RATE', 0.3)  # Доля ошибок, после которой модель обходят
+RESPONSE_CACHE_SIZE = _env_int('RESPONSE_CACHE_SIZE', 256)  # Сколько разных подсказок держать в кэше
+RESPONSE_CACHE_TTL = _env_float('RESPONSE_CACHE_TTL', 3600.0)  # Срок жизни закэшированного ответа, секунд
+RESPONSE_CACHE_VARIANTS = _env_int('RESPONSE_CACHE_VARIANTS', 5)  # Сколько вариантов ответа чередовать на подсказку
+WEBHOOK_PORT = _env_int('WEBHOOK_PORT', 8443)
+CONCURRENT_UPDATES = _env_int('CONCURRENT_UPDATES', 64)  # Сколько обновлений обрабатывать параллельно
+WORKERS = _env_int('WORKERS', 1)  # Процессов-воркеров; пользователи распределяются по user_id
+MESSAGE_DEBOUNCE = _env_float('MESSAGE_DEBOUNCE', 0.8)  # Сообщение чаще этого после предыдущего ждёт продолжения, секунд
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', '1') == '1'  # Показывать ответ в диалоге по мере генерации
+STREAM_EDIT_INTERVAL = _env_float('STREAM_EDIT_INTERVAL', 1.0)  # Не чаще одного редактирования за столько секунд
+STREAM_MIN_CHARS = _env_int('STREAM_MIN_CHARS', 40)  # Редактировать, когда накопилось столько новых символов
+
+# Метрики: Prometheus-эндпоинт /metrics (0 — выключен) и команда /stats для ADMIN_ID
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = _env_int('METRICS_PORT', 0)  # Воркер кластера слушает METRICS_PORT + номер шарда
+
+# Профилирование на ходу: команда /profile для ADMIN_ID, результаты — файлы в PROFILE_DIR
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_SLOW_THRESHOLD = _env_float('PROFILE_SLOW_THRESHOLD', 0.25)  # Зависание цикла событий, секунд (0 — сторож выключен)
+PROFILE_SAMPLE_INTERVAL = _env_float('PROFILE_SAMPLE_INTERVAL', 0.005)  # Шаг сэмплирования профиля CPU, секунд
+PROFILE_CPU_SECONDS = _env_float('PROFILE_CPU_SECONDS', 30.0)  # Окно профиля CPU по умолчанию
+
+# Журнал: запись в файл и консоль идёт в отдельном потоке (см. logs.setup_logging)
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')  # Воркер кластера пишет в bot.<шард>.log
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_JSON = os.getenv('LOG_JSON', '1') == '1'  # Файл журнала в JSON Lines (консоль — всегда текстом)
+LOG_MAX_BYTES = _env_int('LOG_MAX_BYTES', 50 * 1024 * 1024)
+LOG_BACKUPS = _env_int('LOG_BACKUPS', 5)
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', '')  # Например midnight — ротация по времени вместо размера
+# Доля записываемых строк «на каждое сообщение» по уровням (ошибки и предупреждения пишутся все)
+LOG_SAMPLE_INFO = _env_float('LOG_SAMPLE_INFO', 0.1)
+LOG_SAMPLE_DEBUG = _env_float('LOG_SAMPLE_DEBUG', 0.01)
+
+
+def setup_logging(path: str = LOG_FILE):
+    return logs.setup_logging(
+        path, LOG_LEVEL, LOG_JSON, LOG_MAX_BYTES, LOG_BACKUPS, LOG_ROTATE_WHEN,
+        {logging.INFO: LOG_SAMPLE_INFO, logging.DEBUG: LOG_SAMPLE_DEBUG}
+    )
+
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
 # Система промпта для джентльмена
@@ -56,104 +200,357 @@ GENTLEMAN_SYSTEM_PROMPT = """Ты — галантный и воспитанны
 - Ответы 1-2 абзаца, не длинный текст
 - Отвечай разнообразно, избегай повторов"""
 
+SUMMARY_SYSTEM_PROMPT = """Ты ведёшь краткую сводку беседы пользователя с ботом-джентльменом.
+Обнови сводку с учётом новых сообщений: имя и интересы собеседника, о чём шла речь, настроение, \
+что бот обещал или о чём спрашивал. Не более 3-4 предложений, без вступлений."""
+
+MOTIVATE_PROMPT = "Напиши вдохновляющее сообщение о достижении целей и саморазвитии. Одно-два предложения, мудро и лаконично."
+
+# Ответ, когда запрос не допущен к GigaChat из-за перегрузки
+BUSY_REPLY = "⏳ Джентльмен сейчас беседует со многими дамами. Пожалуйста, напишите чуть позже."
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов (для русского текста около 3 символов на токен)"""
+    return len(text) // 3 + 1
+
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    """Обрезать текст так, чтобы по estimate_tokens он укладывался в tokens токенов"""
+    limit = max(tokens - 1, 0) * 3
+    return text if len(text) <= limit else text[:limit]
+
+
+def compliment_prompt(name: str = None, compliment_context: str = "") -> str:
+    """Подсказка для комплимента (именного, если известно имя)"""
+    if name:
+        return f"""Ты — галантный джентльмен. Придумай НОВЫЙ комплимент для {name}.
+
+ТРЕБОВАНИЯ:
+1. Один комплимент, 1-2 предложения максимум
+2. Используй имя {name} в комплименте
+3. Должен быть ОРИГИНАЛЬНЫМ и УНИКАЛЬНЫМ - не повторять старые метафоры
+4. Фокусируйся на её ЛИЧНОСТИ, ХАРАКТЕРЕ, ВЛИЯНИИ, а не на внешности через природные образы
+
+{compliment_context}
+
+Комплимент:"""
+    return f"""Ты — галантный джентльмен. Придумай НОВЫЙ комплимент для женщины.
+
+ТРЕБОВАНИЯ:
+1. Один комплимент, 1-2 предложения максимум
+2. ОРИГИНАЛЬНЫЙ и УНИКАЛЬНЫЙ - без старых метафор
+3. Про личность, характер, влияние на окружающих
+
+{compliment_context}
+
+Комплимент:"""
+
+
+def clean_compliment(text: str) -> str:
+    """Убрать лишние пробелы, нумерацию и обрамляющие кавычки"""
+    return candidates.clean(text)
+
+
+# Темы для мотиваций по расписанию
+SCHEDULED_PROMPTS = [
+    "Напиши короткий комплимент для начала дня - позитивное и воодушевляющее сообщение.",
+    "Придумай мудрый совет о самолюбии и уверенности в себе.",
+    "Напиши вдохновляющее сообщение о том, что каждый день - новая возможность.",
+    "Скажи что-то приятное про умных и целеустремленных женщин.",
+    "Напиши мотивацию для завершения дня с улыбкой.",
+]
+
+
+def parse_schedule_times(user_input: str) -> list:
+    """Разобрать ввод вида '8, 14:30, 20' в минуты от начала суток"""
+    slots = set()
+    for part in user_input.split(','):
+        part = part.strip()
+        if ':' in part:
+            hour_text, minute_text = part.split(':', 1)
+            hour, minute = int(hour_text), int(minute_text)
+        else:
+            hour, minute = int(part), 0
+        if not (0 <= hour <= 23 and 0 <= minute <= 59):
+            raise ValueError(f"время вне диапазона: {part}")
+        slots.add(hour * 60 + minute)
+    return sorted(slots)
+
+
+def schedule_slots(schedule: dict) -> list:
+    """Слоты расписания в минутах от начала суток (поддерживает старый формат с 'hours')"""
+    if 'times' in schedule:
+        return parse_schedule_times(','.join(schedule['times']))
+    return sorted(h * 60 for h in schedule.get('hours', []))
+
+
+def format_slot(slot: int) -> str:
+    return f"{slot // 60}:{slot % 60:02d}"
+
+
+def due_slots(now: datetime, previous: int = None) -> list:
+    """Слоты (дата, минута суток), рассылку которых пора выполнить к моменту now,
+    если последней обработана минута previous (с догоном пропущенных тиков).
+    Дата — своя у каждого слота: округление и догон могут перейти через полночь"""
+    # Округляем к ближайшей минуте: тик может прийти на долю секунды раньше или позже
+    rounded = (now + timedelta(seconds=30)).replace(second=0, microsecond=0)
+    current = rounded.hour * 60 + rounded.minute
+    if previous is None:
+        return [(rounded.date(), current)]
+    missed = (current - previous) % MINUTES_PER_DAY
+    if missed == 0:
+        return []
+    # Догоняем не больше 5 минут, иначе шлём только текущий слот
+    if missed > 5:
+        return [(rounded.date(), current)]
+    return [
+        ((rounded - timedelta(minutes=missed - i)).date(), (previous + i) % MINUTES_PER_DAY)
+        for i in range(1, missed + 1)
+    ]
+
+
+def webhook_config():
+    """Параметры start_webhook или None, если работаем через long polling"""
+    if not WEBHOOK_URL:
+        return None
+    return {
+        'listen': WEBHOOK_LISTEN,
+        'port': WEBHOOK_PORT,
+        'url_path': WEBHOOK_PATH,
+        'webhook_url': f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+        'secret_token': WEBHOOK_SECRET or None,
+    }
+
 
 class GentlemanBot:
-    def __init__(self):
+    def __init__(self, shard: int = 0, shards: int = 1):
         logger.info("🚀 Инициализация бота...")
+        # При запуске несколькими процессами этот экземпляр обслуживает только своих пользователей
+        self.shard = shard
+        self.shards = shards
         self.user_ids = set()
         self.app = None
         self.user_schedules = {}
-        self.user_names = {}
-        self.user_dialogs = {}  # История диалогов
-        self.user_compliments = {}  # История комплиментов для избежания повторений
+        self.schedule_index = {}  # Минута суток -> множество user_id с рассылкой в эту минуту
+        self.user_slots = {}  # user_id -> слоты, под которыми он записан в индексе
+        self.last_schedule_slot = None  # Последняя обработанная минута рассылки
+        self.pregen_tasks = {}  # Минута суток -> задача заблаговременной генерации
+        self.pregen_results = {}  # Минута суток -> {user_id: готовое персональное сообщение}
+        # Глобальный лимит Telegram делится между воркерами
+        self.broadcaster = Broadcaster(BROADCAST_WORKERS, BROADCAST_RATE / shards, BROADCAST_CHAT_INTERVAL)
+        # Готовые ответы для /motivate и /compliment, пополняются в фоне
+        self.pool = ResponsePool(
+            self.generate_pool_batch, POOL_SIZE, POOL_LOW_WATERMARK, POOL_TTL,
+            POOL_REFILL_CONCURRENCY, POOL_MAX_NAME_POOLS, is_duplicate=self.is_similar_text,
+            batch_size=POOL_BATCH_SIZE
+        )
+        self.pool.register('motivate', MOTIVATE_PROMPT, pinned=True)
+        self.pool.register('compliment', compliment_prompt(), pinned=True)
+        self.pool_task = None
+        self.name_requests = OrderedDict()  # Имя -> сколько раз просили комплимент (давно не просившие вытесняются)
+        self.pending_messages = {}  # user_id -> сообщения, ждущие склейки в один запрос
+        self.user_turns = {}  # user_id -> задача последней реплики (реплики пользователя идут по очереди)
+        self.last_message_at = {}  # user_id -> время последнего сообщения (для распознавания серий)
+        self.inflight_commands = set()  # (user_id, команда), которые уже выполняются
+        self.compliment_surplus = OrderedDict()  # user_id -> deque[(время, текст)]: невостребованные варианты
+        self.user_names = None  # Имена (LazyRecords: читаются из хранилища по первому обращению)
+        self.user_dialogs = None  # История диалогов активных пользователей (DialogCache)
+        self.summary_tasks = {}  # user_id -> задача обновления сводки
+        self.user_compliments = None  # История комплиментов для избежания повторений (LazyRecords)
+        self.response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_VARIANTS)
+        
+        # GigaChat создаётся и прогревается в фоне уже после запуска приёма обновлений
+        self.giga = None
+        self.llm = None
+        self.llm_ready = asyncio.Event()
+        self.llm_task = None
+        
+        # Расписания тоже загружаются в фоне; тики планировщика ждут окончания загрузки
+        self.schedules_loaded = asyncio.Event()
+        self.schedules_task = None
+        self.schedule_edits = set()  # Расписания, изменённые пользователями во время загрузки
         
         try:
-            self.giga = GigaChat(
-                credentials=GIGACHAT_API_KEY,
-                verify_ssl_certs=False
-            )
-            logger.info("✅ GigaChat инициализирован")
+            backend = storage.open_store(STORAGE_BACKEND, STATE_FILES, STATE_DB_FILE)
         except Exception as e:
-            logger.error(f"❌ Ошибка инициализации GigaChat: {e}")
-            self.giga = None
+            logger.error(f"❌ Ошибка открытия хранилища {STORAGE_BACKEND}: {e}, использую JSON-файлы")
+            backend = storage.JsonStateStore(STATE_FILES)
+        self.storage = storage.WriteBehindStore(backend, PERSIST_INTERVAL, PERSIST_MAX_PENDING)
+        self.storage_task = None
+        self.warm_task = None  # Прогрев хранилища JSON-файлов в потоке при старте
+        self.metrics_tasks = []
+        self.profiler = profiling.LoopProfiler(PROFILE_DIR, PROFILE_SAMPLE_INTERVAL)
         
-        # Загружаем расписания и имена из файлов
-        self.load_schedules()
+        # Имена, диалоги и комплименты читаются по пользователю, когда он напишет
         self.load_names()
         self.load_dialogs()
         self.load_compliments()
     
-    def load_schedules(self):
-        """Загрузить расписания пользователей из файла"""
+    def create_llm(self, giga=None):
+        """Создать клиент GigaChat (giga — готовый клиент, например заглушка в нагрузочном тесте)"""
+        if giga is None:
+            try:
+                giga_options = {}
+                if GIGACHAT_BASE_URL:
+                    giga_options['base_url'] = GIGACHAT_BASE_URL
+                if GIGACHAT_AUTH_URL:
+                    giga_options['auth_url'] = GIGACHAT_AUTH_URL
+                giga = GigaChat(
+                    credentials=GIGACHAT_API_KEY,
+                    verify_ssl_certs=False,
+                    timeout=GIGACHAT_TIMEOUT,
+                    **giga_options
+                )
+                logger.info("✅ GigaChat инициализирован")
+            except Exception as e:
+                logger.error(f"❌ Ошибка инициализации GigaChat: {e}")
+                return
+        self.giga = giga
+        # Один клиент (и одна HTTP-сессия) на весь процесс: повторы, предохранитель, обновление токена
+        self.llm = GigaChatClient(
+            self.giga, GIGACHAT_MAX_CONCURRENCY, GIGACHAT_TIMEOUT, GIGACHAT_MAX_RETRIES,
+            breaker=CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT),
+            token_refresh_interval=GIGACHAT_TOKEN_REFRESH_INTERVAL,
+            token_refresh_margin=GIGACHAT_TOKEN_REFRESH_MARGIN,
+            admission=AdmissionController(
+                GIGACHAT_MAX_CONCURRENCY,
+                queue_limits={
+                    LIVE: ADMISSION_QUEUE_LIVE, COMMAND: ADMISSION_QUEUE_COMMAND, BACKGROUND: ADMISSION_QUEUE_BACKGROUND
+                },
+                deadlines={
+                    LIVE: ADMISSION_DEADLINE_LIVE, COMMAND: ADMISSION_DEADLINE_COMMAND,
+                    BACKGROUND: ADMISSION_DEADLINE_BACKGROUND
+                },
+                per_user_limit=ADMISSION_PER_USER,
+                background_share=ADMISSION_BACKGROUND_SHARE,
+            ),
+            router=ModelRouter(
+                {
+                    DIALOG: Route(GIGACHAT_MODELS_DIALOG, ROUTE_LATENCY_DIALOG),
+                    SHORT: Route(GIGACHAT_MODELS_SHORT, ROUTE_LATENCY_SHORT),
+                    SUMMARY: Route(GIGACHAT_MODELS_SUMMARY, ROUTE_LATENCY_SUMMARY),
+                },
+                window=ROUTE_WINDOW,
+                min_samples=ROUTE_MIN_SAMPLES,
+                max_error_rate=ROUTE_MAX_ERROR_RATE,
+            )
+        )
+    
+    async def start_llm(self, giga=None):
+        """Создать и прогреть GigaChat в фоне, затем запустить обновление токена"""
         try:
-            if Path(SCHEDULES_FILE).exists():
-                with open(SCHEDULES_FILE, 'r', encoding='utf-8') as f:
-                    self.user_schedules = json.load(f)
-                logger.info(f"✅ Загружено расписаний: {len(self.user_schedules)}")
-        except Exception as e:
-            logger.error(f"Ошибка загрузки расписаний: {e}")
+            self.create_llm(giga)
+            if self.llm:
+                await self.llm.warmup()
+                self.llm.start()
+        finally:
+            self.llm_ready.set()
+    
+    async def ensure_llm(self) -> bool:
+        """Дождаться инициализации GigaChat (первые секунды после старта); False, если он недоступен"""
+        if not self.llm_ready.is_set():
+            try:
+                await asyncio.wait_for(self.llm_ready.wait(), timeout=GIGACHAT_TIMEOUT)
+            except asyncio.TimeoutError:
+                return False
+        return self.llm is not None
     
-    def save_schedules(self):
-        """Сохранить расписания в файл"""
+    async def load_schedules(self):
+        """Загрузить расписания пользователей из хранилища (в фоне, после запуска приёма обновлений)"""
         try:
-            with open(SCHEDULES_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.user_schedules, f, ensure_ascii=False, indent=2)
+            try:
+                stored = await asyncio.to_thread(self.storage.load, SCHEDULES)
+            except Exception as e:
+                logger.error(f"Ошибка загрузки расписаний: {e}")
+                stored = {}
+            for user_id_str, schedule in stored.items():
+                # Пока шла загрузка, пользователь мог изменить или отменить расписание — его выбор важнее
+                try:
+                    if self.owns(user_id_str) and user_id_str not in self.schedule_edits:
+                        self.user_schedules[user_id_str] = schedule
+                        self.index_schedule(user_id_str)
+                except Exception as e:
+                    # Одна испорченная запись не должна оставить без рассылки остальных
+                    self.user_schedules.pop(user_id_str, None)
+                    logger.error(f"Некорректное расписание {user_id_str}: {type(e).__name__}: {e}")
+            logger.info(f"✅ Загружено расписаний: {len(self.user_schedules)}")
+        finally:
+            # Иначе рассылка и /myschedule ждали бы загрузку вечно
+            self.schedule_edits.clear()
+            self.schedules_loaded.set()
+    
+    def owns(self, user_id_str: str) -> bool:
+        """Обслуживает ли этот воркер пользователя"""
+        return self.shards == 1 or cluster.shard_for(int(user_id_str), self.shards) == self.shard
+    
+    def index_schedule(self, user_id_str: str):
+        """Обновить индекс расписаний для пользователя"""
+        for slot in self.user_slots.pop(user_id_str, ()):
+            users = self.schedule_index.get(slot)
+            if users is not None:
+                users.discard(user_id_str)
+                if not users:
+                    del self.schedule_index[slot]
+        
+        schedule = self.user_schedules.get(user_id_str)
+        if not schedule or not schedule.get('enabled', True):
+            return
+        try:
+            slots = schedule_slots(schedule)
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.error(f"Некорректное расписание {user_id_str}: {e}")
+            return
+        for slot in slots:
+            self.schedule_index.setdefault(slot, set()).add(user_id_str)
+        self.user_slots[user_id_str] = slots
+    
+    def save_schedules(self, user_id_str: str):
+        """Сохранить расписание пользователя (удалить, если его больше нет)"""
+        if not self.schedules_loaded.is_set():
+            self.schedule_edits.add(user_id_str)
+        try:
+            if user_id_str in self.user_schedules:
+                self.storage.put(SCHEDULES, user_id_str, self.user_schedules[user_id_str])
+            else:
+                self.storage.delete(SCHEDULES, user_id_str)
             logger.info("✅ Расписания сохранены")
         except Exception as e:
             logger.error(f"Ошибка сохранения расписаний: {e}")
     
     def load_names(self):
-        """Загрузить имена пользователей из файла"""
-        try:
-            if Path(NAMES_FILE).exists():
-                with open(NAMES_FILE, 'r', encoding='utf-8') as f:
-                    self.user_names = json.load(f)
-                logger.info(f"✅ Загружено имён: {len(self.user_names)}")
-        except Exception as e:
-            logger.error(f"Ошибка загрузки имён: {e}")
+        """Подготовить имена пользователей: читаются из хранилища по первому обращению"""
+        self.user_names = storage.LazyRecords(self.storage, NAMES, STATE_CACHE_USERS)
     
-    def save_names(self):
-        """Сохранить имена в файл"""
+    def save_names(self, user_id_str: str):
+        """Сохранить имя пользователя"""
         try:
-            with open(NAMES_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.user_names, f, ensure_ascii=False, indent=2)
+            self.storage.put(NAMES, user_id_str, self.user_names[user_id_str])
             logger.info("✅ Имена сохранены")
         except Exception as e:
             logger.error(f"Ошибка сохранения имён: {e}")
     
     def load_dialogs(self):
-        """Загрузить историю диалогов из файла"""
-        try:
-            if Path(DIALOGS_FILE).exists():
-                with open(DIALOGS_FILE, 'r', encoding='utf-8') as f:
-                    self.user_dialogs = json.load(f)
-                logger.info(f"✅ Загружено диалогов: {len(self.user_dialogs)}")
-        except Exception as e:
-            logger.error(f"Ошибка загрузки диалогов: {e}")
+        """Подготовить историю диалогов: пользователи подгружаются из хранилища по первому сообщению"""
+        self.user_dialogs = DialogCache(self.storage, MAX_DIALOG_HISTORY, DIALOG_CACHE_USERS, DIALOG_IDLE_TTL)
+        logger.info(f"✅ История диалогов: до {DIALOG_CACHE_USERS} активных пользователей в памяти")
     
-    def save_dialogs(self):
-        """Сохранить историю диалогов в файл"""
+    def get_dialog_history(self, user_id_str: str):
+        """История диалога пользователя или None"""
         try:
-            with open(DIALOGS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.user_dialogs, f, ensure_ascii=False, indent=2)
+            return self.user_dialogs.get(user_id_str)
         except Exception as e:
-            logger.error(f"Ошибка сохранения диалогов: {e}")
+            logger.error(f"Ошибка загрузки диалога {user_id_str}: {e}")
+            return None
     
     def load_compliments(self):
-        """Загрузить историю комплиментов"""
-        try:
-            if Path(COMPLIMENTS_FILE).exists():
-                with open(COMPLIMENTS_FILE, 'r', encoding='utf-8') as f:
-                    self.user_compliments = json.load(f)
-                logger.info(f"✅ Загружено истории комплиментов: {len(self.user_compliments)}")
-        except Exception as e:
-            logger.error(f"Ошибка загрузки комплиментов: {e}")
+        """Подготовить историю комплиментов: читается из хранилища по первому обращению"""
+        self.user_compliments = storage.LazyRecords(self.storage, COMPLIMENTS, STATE_CACHE_USERS)
     
-    def save_compliments(self):
-        """Сохранить историю комплиментов"""
+    def save_compliments(self, user_id_str: str):
+        """Сохранить историю комплиментов пользователя"""
         try:
-            with open(COMPLIMENTS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.user_compliments, f, ensure_ascii=False, indent=2)
+            self.storage.put(COMPLIMENTS, user_id_str, self.user_compliments[user_id_str])
         except Exception as e:
             logger.error(f"Ошибка сохранения комплиментов: {e}")
     
@@ -165,14 +562,34 @@ class GentlemanBot:
         
         self.user_compliments[user_id_str].append({
             "text": compliment,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": datetime.now().isoformat(),
+            "sig": similarity.signature(compliment)
         })
         
-        # Ограничиваем последними 20 комплиментами
-        if len(self.user_compliments[user_id_str]) > 20:
-            self.user_compliments[user_id_str] = self.user_compliments[user_id_str][-20:]
+        # Ограничиваем последними MAX_COMPLIMENT_HISTORY комплиментами
+        if len(self.user_compliments[user_id_str]) > MAX_COMPLIMENT_HISTORY:
+            self.user_compliments[user_id_str] = self.user_compliments[user_id_str][-MAX_COMPLIMENT_HISTORY:]
         
-        self.save_compliments()
+        self.save_compliments(user_id_str)
+    
+    def compliment_signatures(self, user_id_str: str) -> list:
+        """Подписи прошлых комплиментов пользователя (для старых записей считаются на лету)"""
+        signatures = []
+        for record in self.user_compliments.get(user_id_str, []):
+            if "sig" not in record:
+                record["sig"] = similarity.signature(record["text"])
+            signatures.append(record["sig"])
+        return signatures
+    
+    def is_repeat_compliment(self, user_id_str: str, text: str) -> bool:
+        """Слишком ли комплимент похож на уже полученные пользователем"""
+        score = similarity.max_similarity(similarity.signature(text), self.compliment_signatures(user_id_str))
+        return score >= COMPLIMENT_SIMILARITY_THRESHOLD
+    
+    def is_similar_text(self, text: str, others: list) -> bool:
+        """Слишком ли текст похож на любой из others (отбраковка при пополнении пула)"""
+        others_signatures = [similarity.signature(other) for other in others]
+        return similarity.max_similarity(similarity.signature(text), others_signatures) >= COMPLIMENT_SIMILARITY_THRESHOLD
     
     def get_compliment_context(self, user_id: str) -> str:
         """Получить контекст о предыдущих комплиментах с запрещёнными словами"""
@@ -181,21 +598,19 @@ class GentlemanBot:
             return ""
         
         # Берём последние 6 комплиментов
-        recent = self.user_compliments[user_id_str][-6:]
-        
-        # Извлекаем запрещённые фразы и слова
-        forbidden_phrases = []
-        all_text = " ".join([c["text"] for c in recent]).lower()
+        history = [c["text"] for c in self.user_compliments[user_id_str][-6:]]
+        name = self.user_names.get(user_id_str, "")
+        name_stems = similarity.stems(name)
         
-        # Ищем стандартные сравнения
-        keywords = ["картин", "замок", "ручей", "цветок", "солнц", "улыбк", "весн", "старинн", "древн", "библиотек", "рембрандт", "очарован", "благородств"]
+        # Запрещаем образы, которые повторялись в истории, и свежие образы из последнего комплимента
+        forbidden = similarity.repeated_stems(history, limit=5, exclude=name_stems)
+        for stem in sorted(similarity.stems(history[-1]) - name_stems):
+            if len(forbidden) >= 5:
+                break
+            if stem not in forbidden:
+                forbidden.append(stem)
         
-        for keyword in keywords:
-            if keyword in all_text:
-                forbidden_phrases.append(f"- ❌ Старые образы со словом '{keyword}'")
-        
-        # Если очень много повторений, добавим более агрессивные инструкции
-        forbidden_text = "\n".join(set(forbidden_phrases[:5])) if forbidden_phrases else ""
+        forbidden_text = "\n".join(f"- ❌ Старые образы со словом '{stem}'" for stem in forbidden)
         
         return f"""
 🚫 ЗАПРЕЩЁННЫЕ СТИЛИ (из предыдущих комплиментов):
@@ -212,109 +627,306 @@ class GentlemanBot:
     
     def add_to_dialog_history(self, user_id: str, role: str, content: str):
         """Добавить сообщение в историю диалога пользователя"""
-        if user_id not in self.user_dialogs:
-            self.user_dialogs[user_id] = []
-        
-        self.user_dialogs[user_id].append({
-            "role": role,
-            "content": content,
-            "timestamp": datetime.now().isoformat()
-        })
-        
-        # Ограничиваем историю последними N сообщениями
-        if len(self.user_dialogs[user_id]) > MAX_DIALOG_HISTORY:
-            self.user_dialogs[user_id] = self.user_dialogs[user_id][-MAX_DIALOG_HISTORY:]
-        
-        self.save_dialogs()
+        # Буфер хранит последние MAX_DIALOG_HISTORY сообщений, запись уходит в хранилище отложенно
+        try:
+            self.user_dialogs.append(user_id, role, content)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения диалогов: {e}")
+    
+    def get_summary(self, user_id_str: str) -> str:
+        """Сводка беседы с пользователем (пустая строка, если её ещё нет)"""
+        try:
+            return self.user_dialogs.get_summary(user_id_str)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки сводки {user_id_str}: {e}")
+            return ""
     
-    def get_dialog_context(self, user_id: str) -> list:
-        """Получить контекст диалога для GigaChat"""
+    def get_dialog_context(self, user_id: str, user_message: str = "") -> list:
+        """Получить контекст диалога для GigaChat с новым сообщением пользователя
+        в пределах CONTEXT_TOKEN_BUDGET токенов"""
         messages = []
         
-        # Добавляем системный промпт с информацией о контексте
+        # Системный промпт + сводка беседы вместо сырой истории
         system_content = GENTLEMAN_SYSTEM_PROMPT
-        
-        # Если есть история - добавляем краткую справку о беседе
-        if user_id in self.user_dialogs and self.user_dialogs[user_id]:
-            history = self.user_dialogs[user_id]
-            recent_topics = []
-            for msg in history[-6:]:  # Последние 3 пары сообщений
-                recent_topics.append(msg["content"])
-            
-            if recent_topics:
-                system_content += f"\n\nКратко о беседе: {', '.join(recent_topics)}"
+        summary = self.get_summary(user_id)
+        if summary:
+            system_content += f"\n\nКратко о беседе: {summary}"
         
         messages.append(Messages(
             role=MessagesRole.SYSTEM,
             content=system_content
         ))
         
-        # Добавляем только последние 3 сообщения пользователя для контекста
+        # Слишком длинное сообщение обрезаем до остатка бюджета (но не меньше его четверти),
+        # иначе оно одно уйдёт в модель целиком
+        budget = CONTEXT_TOKEN_BUDGET - estimate_tokens(system_content)
+        user_message = truncate_to_tokens(user_message, max(budget, CONTEXT_TOKEN_BUDGET // 4))
+        
+        # Добавляем последние сообщения пользователя, пока они помещаются в бюджет
         # (не ответы бота, т.к. GigaChat может не поддерживать ASSISTANT роль)
-        if user_id in self.user_dialogs:
-            user_messages = [msg for msg in self.user_dialogs[user_id] if msg["role"].upper() == "USER"]
-            for msg in user_messages[-3:]:  # Последние 3 сообщения пользователя
-                messages.append(Messages(
-                    role=MessagesRole.USER,
-                    content=msg["content"]
-                ))
+        budget -= estimate_tokens(user_message)
+        history = self.get_dialog_history(user_id) or ()
+        recent = []
+        for msg in reversed(history):
+            if msg.role.upper() != "USER":
+                continue
+            cost = estimate_tokens(msg.content)
+            if cost > budget:
+                break
+            budget -= cost
+            recent.append(msg.content)
+        
+        for content in reversed(recent):
+            messages.append(Messages(
+                role=MessagesRole.USER,
+                content=content
+            ))
+        
+        if user_message:
+            messages.append(Messages(
+                role=MessagesRole.USER,
+                content=user_message
+            ))
         
         return messages
     
-    def get_response(self, user_message: str, user_id: str = None) -> str:
-        """Получить ответ от GigaChat с сохранением контекста"""
-        if not self.giga:
+    def note_dialog_turn(self, user_id_str: str):
+        """Учесть обмен репликами; каждые SUMMARY_EVERY_TURNS обменов обновить сводку в фоне"""
+        # Счётчик живёт рядом с историей в DialogCache и выгружается вместе с ней
+        turns = self.user_dialogs.count_turn(user_id_str)
+        if turns < SUMMARY_EVERY_TURNS or user_id_str in self.summary_tasks:
+            return
+        self.user_dialogs.reset_turns(user_id_str)
+        task = asyncio.get_running_loop().create_task(self.refresh_summary(user_id_str))
+        self.summary_tasks[user_id_str] = task
+        task.add_done_callback(lambda _: self.summary_tasks.pop(user_id_str, None))
+    
+    async def refresh_summary(self, user_id_str: str):
+        """Обновить сводку беседы по предыдущей сводке и последним сообщениям"""
+        history = list(self.get_dialog_history(user_id_str) or ())
+        if not history or not await self.ensure_llm():
+            return
+        
+        transcript = "\n".join(
+            f"{'Пользователь' if msg.role.upper() == 'USER' else 'Бот'}: {msg.content[:400]}"
+            for msg in history
+        )
+        previous = self.get_summary(user_id_str) or "(пока нет)"
+        payload = Chat(
+            messages=[
+                Messages(role=MessagesRole.SYSTEM, content=SUMMARY_SYSTEM_PROMPT),
+                Messages(role=MessagesRole.USER, content=f"Прежняя сводка: {previous}\n\nНовые сообщения:\n{transcript}")
+            ],
+            temperature=0.3,
+            max_tokens=SUMMARY_MAX_TOKENS,
+        )
+        try:
+            response = await self.chat(payload, BACKGROUND, task=SUMMARY)
+            if not response or not response.choices:
+                return
+            summary = response.choices[0].message.content.strip()
+            self.user_dialogs.set_summary(user_id_str, summary)
+            logger.info(f"📝 Сводка беседы обновлена для {user_id_str}")
+        except Exception as e:
+            logger.error(f"Ошибка обновления сводки {user_id_str}: {type(e).__name__}: {e}")
+    
+    async def chat(self, payload: Chat, priority: int = COMMAND, user_id_str: str = None, task: str = SHORT):
+        """Асинхронный запрос к GigaChat (допуск по приоритету, модель по задаче, таймаут, повторы, предохранитель)"""
+        return await self.llm.chat(payload, priority, user_id_str, task)
+    
+    async def generate(self, prompt: str, cached: bool = False, priority: int = BACKGROUND,
+                       user_id_str: str = None) -> str:
+        """Запрос к GigaChat без контекста диалога; при ошибке бросает исключение.
+        С cached=True ответ может прийти из кэша (одна из RESPONSE_CACHE_VARIANTS версий).
+        По умолчанию запрос фоновый: интерактивные вызовы передают свой priority"""
+        if not await self.ensure_llm():
+            raise RuntimeError("GigaChat не инициализирован")
+        messages = [
+            Messages(role=MessagesRole.SYSTEM, content=GENTLEMAN_SYSTEM_PROMPT),
+            Messages(role=MessagesRole.USER, content=prompt)
+        ]
+        cache_key = None
+        if cached:
+            cache_key = ResponseCache.make_key(messages, temperature=1.0, max_tokens=SHORT_MAX_TOKENS)
+            answer = self.response_cache.get(cache_key)
+            if answer is not None:
+                return answer
+        
+        payload = Chat(
+            messages=messages,
+            temperature=1.0,
+            max_tokens=SHORT_MAX_TOKENS,
+        )
+        try:
+            response = await self.chat(payload, priority, user_id_str)
+        except (CircuitOpenError, AdmissionError):
+            # GigaChat недоступен или перегружен — отдаём любой закэшированный вариант, если он есть
+            answer = self.response_cache.peek(cache_key) if cache_key else None
+            if answer is None:
+                raise
+            return answer
+        if not response or not response.choices:
+            raise ValueError("Неожиданный формат ответа")
+        answer = response.choices[0].message.content.strip()
+        if cache_key:
+            self.response_cache.put(cache_key, answer)
+        return answer
+    
+    async def generate_candidates(self, prompt: str, count: int, priority: int = BACKGROUND,
+                                  user_id_str: str = None) -> list:
+        """Попросить у GigaChat count разных вариантов одним запросом и вернуть прошедшие проверку
+        (без обрывков, пояснений модели и почти-повторов друг друга); при ошибке бросает исключение"""
+        if count <= 1:
+            return candidates.parse(await self.generate(prompt, priority=priority, user_id_str=user_id_str))
+        if not await self.ensure_llm():
+            raise RuntimeError("GigaChat не инициализирован")
+        payload = Chat(
+            messages=[
+                Messages(role=MessagesRole.SYSTEM, content=GENTLEMAN_SYSTEM_PROMPT),
+                Messages(role=MessagesRole.USER, content=candidates.batch_prompt(prompt, count))
+            ],
+            temperature=1.0,
+            max_tokens=min(1024, SHORT_MAX_TOKENS * count),
+        )
+        response = await self.chat(payload, priority, user_id_str)
+        if not response or not response.choices:
+            raise ValueError("Неожиданный формат ответа")
+        result = []
+        for text in candidates.parse(response.choices[0].message.content, limit=count):
+            if not self.is_similar_text(text, result):
+                result.append(text)
+        registry.inc('llm_candidates_total', len(result), result='accepted')
+        registry.inc('llm_candidates_total', count - len(result), result='dropped')
+        return result
+    
+    async def generate_pool_batch(self, prompt: str) -> list:
+        """Пополнение пулов: несколько ответов за один фоновый запрос"""
+        return await self.generate_candidates(prompt, POOL_BATCH_SIZE)
+    
+    def build_dialog_payload(self, user_id_str: str, user_message: str) -> Chat:
+        """Запрос к GigaChat с контекстом диалога и новым сообщением пользователя"""
+        messages = self.get_dialog_context(user_id_str, user_message)
+        return Chat(
+            messages=messages,
+            temperature=1.0,
+            max_tokens=DIALOG_MAX_TOKENS,
+        )
+    
+    def record_dialog_turn(self, user_id_str: str, user_message: str, answer: str):
+        """Сохранить обмен репликами в историю диалога"""
+        self.add_to_dialog_history(user_id_str, "USER", user_message)
+        self.add_to_dialog_history(user_id_str, "ASSISTANT", answer)
+        self.note_dialog_turn(user_id_str)
+    
+    async def stream_response(self, update: Update, user_message: str, user_id: int):
+        """Ответить в диалоге потоково: первый кусочек отправляется сразу,
+        дальше сообщение редактируется не чаще STREAM_EDIT_INTERVAL секунд"""
+        user_id_str = str(user_id)
+        payload = self.build_dialog_payload(user_id_str, user_message)
+        logger.info("📤 Потоковый запрос: %.100s", user_message, extra=SAMPLED)
+        
+        text = ""
+        sent = None
+        shown = ""
+        next_edit = 0.0
+        try:
+            async for delta in self.llm.stream(payload, LIVE, user_id_str, DIALOG):
+                text += delta
+                if sent is None:
+                    if text.strip():
+                        sent = await update.message.reply_text(text)
+                        shown = text
+                        next_edit = asyncio.get_running_loop().time() + STREAM_EDIT_INTERVAL
+                    continue
+                now = asyncio.get_running_loop().time()
+                if now >= next_edit and len(text) - len(shown) >= STREAM_MIN_CHARS:
+                    next_edit = now + await self.edit_streamed(sent, text)
+                    shown = text
+        except AdmissionError as e:
+            # До GigaChat запрос не дошёл: повтор обычным запросом только усилил бы перегрузку
+            logger.warning(f"🚦 Потоковый запрос {user_id} отклонён: {e}")
+            if sent is None:
+                await update.message.reply_text(BUSY_REPLY)
+            return
+        except Exception as e:
+            logger.error(f"❌ Ошибка потокового ответа: {type(e).__name__}: {e}")
+            if sent is None:
+                # Ничего не успели показать — отвечаем обычным способом
+                response = await self.get_response(user_message, user_id)
+                await update.message.reply_text(response)
+            else:
+                await self.edit_streamed(sent, f"{text}…\n\n⚠️ Ответ прервался, попробуйте ещё раз.")
+            return
+        
+        if sent is None:
+            response = await self.get_response(user_message, user_id)
+            await update.message.reply_text(response)
+            return
+        
+        # Финальный текст обязательно показываем, даже если Telegram попросил подождать
+        if text != shown:
+            for _ in range(3):
+                pause = await self.edit_streamed(sent, text)
+                if pause <= STREAM_EDIT_INTERVAL:
+                    break
+                await asyncio.sleep(pause)
+        logger.info("📥 Ответ: %.100s", text, extra=SAMPLED)
+        self.record_dialog_turn(user_id_str, user_message, text)
+    
+    async def edit_streamed(self, message, text: str) -> float:
+        """Обновить текст сообщения; возвращает паузу до следующего редактирования"""
+        try:
+            await message.edit_text(text)
+        except RetryAfter as e:
+            return STREAM_EDIT_INTERVAL + retry_after_seconds(e)
+        except BadRequest as e:
+            # «message is not modified» и подобное не мешают дальнейшему выводу
+            logger.debug(f"Не удалось обновить сообщение: {e}")
+        return STREAM_EDIT_INTERVAL
+    
+    async def get_response(self, user_message: str, user_id: str = None, requester: str = None) -> str:
+        """Получить ответ от GigaChat с сохранением контекста.
+        Без user_id это команда от пользователя requester (учитывается в его доле очереди)"""
+        if not await self.ensure_llm():
             return "⚠️ Бот временно недоступен. Проверьте API ключ."
         
         try:
-            logger.info(f"📤 Запрос: {user_message[:100]}")
+            logger.info("📤 Запрос: %.100s", user_message, extra=SAMPLED)
             
-            # Если есть user_id, используем контекст диалога
-            if user_id:
-                user_id_str = str(user_id)
-                messages = self.get_dialog_context(user_id_str)
-                # Добавляем текущее сообщение пользователя
-                messages.append(Messages(
-                    role=MessagesRole.USER,
-                    content=user_message
-                ))
-            else:
-                # Без контекста - для команд типа /compliment
-                messages = [
-                    Messages(
-                        role=MessagesRole.SYSTEM,
-                        content=GENTLEMAN_SYSTEM_PROMPT
-                    ),
-                    Messages(
-                        role=MessagesRole.USER,
-                        content=user_message
-                    )
-                ]
+            if not user_id:
+                # Без контекста - для команд типа /compliment; такие ответы кэшируются
+                answer = await self.generate(user_message, cached=True, priority=COMMAND, user_id_str=requester)
+                logger.info("📥 Ответ: %.100s", answer, extra=SAMPLED)
+                return answer
             
-            payload = Chat(
-                messages=messages,
-                temperature=1.0,
-                max_tokens=512,
-            )
+            # Есть user_id - используем контекст диалога
+            user_id_str = str(user_id)
+            payload = self.build_dialog_payload(user_id_str, user_message)
             
-            response = self.giga.chat(payload)
-            logger.info(f"✅ Ответ получен")
+            response = await self.chat(payload, LIVE, user_id_str, DIALOG)
+            logger.info("✅ Ответ получен", extra=SAMPLED)
             
             if response and response.choices:
                 answer = response.choices[0].message.content
-                logger.info(f"📥 Ответ: {answer[:100]}")
+                logger.info("📥 Ответ: %.100s", answer, extra=SAMPLED)
                 
-                # Сохраняем в историю диалога если есть user_id
-                if user_id:
-                    user_id_str = str(user_id)
-                    self.add_to_dialog_history(user_id_str, "USER", user_message)
-                    self.add_to_dialog_history(user_id_str, "ASSISTANT", answer)
+                # Сохраняем в историю диалога
+                self.record_dialog_turn(user_id_str, user_message, answer)
                 
                 return answer
             else:
                 logger.error(f"⚠️ Неожиданный формат ответа")
                 return "Не удалось получить ответ"
                 
+        except CircuitOpenError:
+            logger.warning("🔌 GigaChat недоступен, запрос отклонён без обращения к API")
+            return "⚠️ Джентльмен ненадолго отлучился. Пожалуйста, напишите чуть позже."
+        except AdmissionError as e:
+            logger.warning(f"🚦 Запрос отклонён: {e}")
+            return BUSY_REPLY
+        except asyncio.TimeoutError:
+            logger.error(f"⏱ GigaChat не ответил за {GIGACHAT_TIMEOUT:.0f} с")
+            return "⚠️ Джентльмен задумался слишком надолго. Попробуйте ещё раз чуть позже."
         except Exception as e:
             logger.error(f"❌ Ошибка GigaChat: {type(e).__name__}: {e}", exc_info=True)
             return f"⚠️ Ошибка: {str(e)[:100]}"
@@ -392,48 +1004,106 @@ class GentlemanBot:
         self.user_ids.add(user_id)
         user_id_str = str(user_id)
         
-        logger.info(f"🎁 /compliment от {user_id}")
-        
-        # Получаем контекст о предыдущих комплиментах
-        compliment_context = self.get_compliment_context(user_id_str)
-        
-        # Формируем подсказку для GigaChat с ОЧЕНЬ СТРОГИМИ инструкциями
-        if user_id_str in self.user_names:
-            name = self.user_names[user_id_str]
-            prompt = f"""Ты — галантный джентльмен. Придумай НОВЫЙ комплимент для {name}.
-
-ТРЕБОВАНИЯ:
-1. Один комплимент, 1-2 предложения максимум
-2. Используй имя {name} в комплименте
-3. Должен быть ОРИГИНАЛЬНЫМ и УНИКАЛЬНЫМ - не повторять старые метафоры
-4. Фокусируйся на её ЛИЧНОСТИ, ХАРАКТЕРЕ, ВЛИЯНИИ, а не на внешности через природные образы
-
-{compliment_context}
-
-Комплимент:"""
-        else:
-            prompt = f"""Ты — галантный джентльмен. Придумай НОВЫЙ комплимент для женщины.
-
-ТРЕБОВАНИЯ:
-1. Один комплимент, 1-2 предложения максимум
-2. ОРИГИНАЛЬНЫЙ и УНИКАЛЬНЫЙ - без старых метафор
-3. Про личность, характер, влияние на окружающих
-
-{compliment_context}
-
-Комплимент:"""
-        
-        response = self.get_response(prompt)
-        
-        # Очищаем ответ от лишнего
-        response = response.strip()
-        if response.startswith('"') and response.endswith('"'):
-            response = response[1:-1]
-        
-        # Сохраняем комплимент
-        self.add_compliment(user_id_str, response)
-        
-        await update.message.reply_text(response)
+        # Повторное нажатие, пока предыдущее ещё выполняется, игнорируем
+        if (user_id_str, 'compliment') in self.inflight_commands:
+            logger.info("⏳ /compliment от %s уже выполняется", user_id, extra=SAMPLED)
+            return
+        self.inflight_commands.add((user_id_str, 'compliment'))
+        try:
+            logger.info("🎁 /compliment от %s", user_id, extra=SAMPLED)
+            
+            name = self.user_names.get(user_id_str)
+            is_repeat = lambda text: self.is_repeat_compliment(user_id_str, clean_compliment(text))
+            
+            # Сначала — варианты, оставшиеся от прошлой генерации для этого пользователя,
+            # затем готовый комплимент из пула; похожие на уже полученные пропускаем
+            pool_key = self.compliment_pool_key(name)
+            response = self.take_surplus(user_id_str, reject=is_repeat)
+            if response is None and pool_key:
+                response = self.pool.take(pool_key, reject=is_repeat)
+            
+            # Иначе просим у GigaChat сразу несколько вариантов; непохожие на прежние идут в запас
+            last = None
+            for attempt in range(COMPLIMENT_MAX_ATTEMPTS if response is None else 0):
+                generated = await self.compliment_candidates(user_id_str, name)
+                if not generated:
+                    break
+                last = generated[0]
+                fresh = [text for text in generated if not self.is_repeat_compliment(user_id_str, text)]
+                if fresh:
+                    response = fresh[0]
+                    self.store_surplus(user_id_str, fresh[1:], pool_key)
+                    break
+                logger.info("🔁 Комплименты для %s похожи на прежние, попытка %d", user_id, attempt + 1, extra=SAMPLED)
+            
+            if response is None:
+                # Все варианты похожи на прежние — берём последний; не получилось совсем — обычный запрос
+                response = last or clean_compliment(await self.get_response(compliment_prompt(name), requester=user_id_str))
+            
+            # Сохраняем комплимент
+            self.add_compliment(user_id_str, response)
+            
+            await update.message.reply_text(response)
+        finally:
+            self.inflight_commands.discard((user_id_str, 'compliment'))
+    
+    async def compliment_candidates(self, user_id_str: str, name: str = None) -> list:
+        """Варианты комплимента с учётом прежних (пустой список при ошибке)"""
+        # Формируем подсказку для GigaChat с ОЧЕНЬ СТРОГИМИ инструкциями и запретами прежних образов
+        prompt = compliment_prompt(name, self.get_compliment_context(user_id_str))
+        try:
+            return await self.generate_candidates(prompt, COMPLIMENT_CANDIDATES, COMMAND, user_id_str)
+        except Exception as e:
+            logger.error(f"❌ Не удалось получить варианты комплимента: {type(e).__name__}: {e}")
+            return []
+    
+    def take_surplus(self, user_id_str: str, reject=None):
+        """Невостребованный вариант, сгенерированный для пользователя раньше (None, если нет)"""
+        surplus = self.compliment_surplus.get(user_id_str)
+        if not surplus:
+            return None
+        deadline = monotonic() - POOL_TTL
+        result = None
+        while surplus and result is None:
+            created, text = surplus.popleft()
+            if created > deadline and (reject is None or not reject(text)):
+                result = text
+        if not surplus:
+            del self.compliment_surplus[user_id_str]
+        if result is not None:
+            registry.inc('compliment_surplus_hits_total')
+        return result
+    
+    def store_surplus(self, user_id_str: str, texts: list, pool_key: str = None):
+        """Отложить лишние варианты для следующих /compliment пользователя;
+        сверх его запаса — в пул для того же имени"""
+        if not texts:
+            return
+        surplus = self.compliment_surplus.setdefault(user_id_str, deque(maxlen=COMPLIMENT_CANDIDATES))
+        self.compliment_surplus.move_to_end(user_id_str)
+        now = monotonic()
+        keep = COMPLIMENT_CANDIDATES - len(surplus)
+        surplus.extend((now, text) for text in texts[:keep])
+        if pool_key and pool_key != 'compliment':
+            self.pool.offer(pool_key, texts[keep:])
+        while len(self.compliment_surplus) > STATE_CACHE_USERS:
+            self.compliment_surplus.popitem(last=False)
+    
+    def compliment_pool_key(self, name: str = None):
+        """Ключ пула для комплимента; частым именам заводится собственный пул"""
+        if not name:
+            return 'compliment'
+        key = f'compliment:{name}'
+        if key not in self.pool:
+            requests = self.name_requests.pop(name, 0) + 1
+            if requests < POOL_NAME_MIN_REQUESTS:
+                # Имена приходят от пользователей: счётчики храним только для последних STATE_CACHE_USERS
+                self.name_requests[name] = requests
+                while len(self.name_requests) > STATE_CACHE_USERS:
+                    self.name_requests.popitem(last=False)
+                return None
+            self.pool.register(key, compliment_prompt(name))
+        return key
     
     async def setname_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда для установки имени"""
@@ -448,12 +1118,22 @@ class GentlemanBot:
         """Мотивирующее сообщение"""
         user_id = update.effective_user.id
         self.user_ids.add(user_id)
+        user_id_str = str(user_id)
         
-        logger.info(f"💪 /motivate от {user_id}")
-        
-        prompt = "Напиши вдохновляющее сообщение о достижении целей и саморазвитии. Одно-два предложения, мудро и лаконично."
-        response = self.get_response(prompt)
-        await update.message.reply_text(response)
+        # Повторное нажатие, пока предыдущее ещё выполняется, игнорируем
+        if (user_id_str, 'motivate') in self.inflight_commands:
+            logger.info("⏳ /motivate от %s уже выполняется", user_id, extra=SAMPLED)
+            return
+        self.inflight_commands.add((user_id_str, 'motivate'))
+        try:
+            logger.info("💪 /motivate от %s", user_id, extra=SAMPLED)
+            
+            response = self.pool.take('motivate')
+            if response is None:
+                response = await self.get_response(MOTIVATE_PROMPT, requester=user_id_str)
+            await update.message.reply_text(response)
+        finally:
+            self.inflight_commands.discard((user_id_str, 'motivate'))
     
     async def schedule_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда для настройки расписания"""
@@ -462,14 +1142,14 @@ class GentlemanBot:
         
         schedule_text = """⏰ Настройка расписания мотиваций
 
-Введите часы через запятую (0-23), когда вы хотите получать мотивирующие сообщения.
+Введите время через запятую (часы 0-23, можно с минутами), когда вы хотите получать мотивирующие сообщения.
 
 Примеры:
 • 8,14,20 - мотивация в 8:00, 14:00 и 20:00
-• 9,12,18,21 - мотивация в 9:00, 12:00, 18:00 и 21:00
+• 9:30,12,18:45 - мотивация в 9:30, 12:00 и 18:45
 • 6 - только в 6:00
 
-Напишите часы или 'отмена' чтобы отключить:"""
+Напишите время или 'отмена' чтобы отключить:"""
         
         await update.message.reply_text(schedule_text)
         context.user_data['waiting_for_schedule'] = True
@@ -478,10 +1158,18 @@ class GentlemanBot:
     async def myschedule_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать текущее расписание пользователя"""
         user_id = str(update.effective_user.id)
+        await self.schedules_loaded.wait()
         
-        if user_id in self.user_schedules and self.user_schedules[user_id]['hours']:
-            hours = self.user_schedules[user_id]['hours']
-            times = ', '.join([f"{h}:00" for h in sorted(hours)])
+        schedule = self.user_schedules.get(user_id)
+        slots = schedule_slots(schedule) if schedule else []
+        if slots and not schedule.get('enabled', True):
+            # Рассылку отключили, когда бот был заблокирован: отправляться она не будет
+            times = ', '.join(format_slot(slot) for slot in slots)
+            await update.message.reply_text(
+                f"⏸ Рассылка мотиваций приостановлена (было: {times}).\n/schedule - включить расписание снова"
+            )
+        elif slots:
+            times = ', '.join(format_slot(slot) for slot in slots)
             await update.message.reply_text(f"📅 Ваше расписание мотиваций:\n{times}")
         else:
             await update.message.reply_text("❌ У вас не установлено расписание.\n/schedule - установить расписание")
@@ -505,13 +1193,69 @@ class GentlemanBot:
             await self.process_schedule_input(update, user_message, user_id)
             return
         
-        logger.info(f"📨 Сообщение от {user_id}: {user_message[:100]}")
+        logger.info("📨 Сообщение от %s: %.100s", user_id, user_message, extra=SAMPLED)
+        
+        # Сообщения, пришедшие, пока реплика ждёт очереди, склеиваются в один запрос
+        pending = self.pending_messages.get(user_id_str)
+        now = asyncio.get_running_loop().time()
+        burst = now - self.last_message_at.get(user_id_str, float('-inf')) < MESSAGE_DEBOUNCE
+        self.last_message_at[user_id_str] = now
+        if pending is not None:
+            pending.append((update, user_message))
+            return
         
+        self.pending_messages[user_id_str] = [(update, user_message)]
         await update.message.chat.send_action("typing")
         
-        response = self.get_response(user_message, user_id)
-        logger.info(f"📬 Отправляю ответ {user_id}")
-        await update.message.reply_text(response)
+        # Одиночное сообщение обрабатывается сразу; в серии — ждём продолжения MESSAGE_DEBOUNCE
+        previous_turn = self.user_turns.get(user_id_str)
+        turn = context.application.create_task(
+            self.answer_user_messages(user_id, previous_turn, MESSAGE_DEBOUNCE if burst else 0.0),
+            name=f"turn_{user_id}"
+        )
+        self.user_turns[user_id_str] = turn
+        turn.add_done_callback(lambda task: self.finish_turn(user_id_str, task))
+    
+    def finish_turn(self, user_id_str: str, task: asyncio.Task):
+        if self.user_turns.get(user_id_str) is task:
+            # Последняя реплика отвечена: серия закончилась, время сообщения больше не нужно
+            del self.user_turns[user_id_str]
+            self.last_message_at.pop(user_id_str, None)
+    
+    async def answer_user_messages(self, user_id: int, previous_turn: asyncio.Task = None, delay: float = 0.0):
+        """Ответить на накопившиеся сообщения пользователя одним запросом"""
+        user_id_str = str(user_id)
+        if delay:
+            await asyncio.sleep(delay)
+        
+        # Дожидаемся ответа на предыдущую реплику, чтобы история шла по порядку;
+        # всё, что пришло за это время, уйдёт одним запросом
+        if previous_turn is not None and not previous_turn.done():
+            await asyncio.gather(previous_turn, return_exceptions=True)
+        batch = self.pending_messages.pop(user_id_str, [])
+        if not batch:
+            return
+        
+        update = batch[-1][0]
+        user_message = "\n".join(text for _, text in batch)
+        if len(batch) > 1:
+            logger.info("🧩 Склеено сообщений от %s: %d", user_id, len(batch), extra=SAMPLED)
+            await update.message.chat.send_action("typing")
+        
+        registry.observe('bot_batched_messages', len(batch), buckets=(1, 2, 3, 5, 10))
+        started = asyncio.get_running_loop().time()
+        try:
+            if STREAM_REPLIES and await self.ensure_llm():
+                await self.stream_response(update, user_message, user_id)
+                return
+            response = await self.get_response(user_message, user_id)
+            logger.info("📬 Отправляю ответ %s", user_id, extra=SAMPLED)
+            await update.message.reply_text(response)
+        except Exception as e:
+            registry.inc('bot_handler_errors_total', handler='dialog_turn', error=type(e).__name__)
+            logger.error(f"Ошибка ответа {user_id}: {type(e).__name__}: {e}")
+        finally:
+            registry.observe('bot_dialog_turn_seconds', asyncio.get_running_loop().time() - started)
     
     async def process_name_input(self, update: Update, user_name: str, user_id_str: str):
         """Обработать введённое имя"""
@@ -524,7 +1268,7 @@ class GentlemanBot:
         
         # Сохраняем имя
         self.user_names[user_id_str] = name
-        self.save_names()
+        self.save_names(user_id_str)
         
         await update.message.reply_text(f"✅ Спасибо, {name}! Я буду дарить вам персонализированные комплименты! 🎩")
         logger.info(f"✅ Имя сохранено для {user_id_str}: {name}")
@@ -536,103 +1280,373 @@ class GentlemanBot:
         if user_input.lower() == 'отмена':
             if user_id_str in self.user_schedules:
                 del self.user_schedules[user_id_str]
-            self.save_schedules()
+            self.index_schedule(user_id_str)
+            self.save_schedules(user_id_str)
             await update.message.reply_text("❌ Расписание отключено")
             logger.info(f"❌ Расписание отключено для {user_id}")
             return
         
         try:
-            hours = [int(h.strip()) for h in user_input.split(',')]
-            
-            # Валидация
-            if not all(0 <= h <= 23 for h in hours):
-                await update.message.reply_text("❌ Ошибка! Часы должны быть от 0 до 23")
-                context.user_data['waiting_for_schedule'] = True
-                return
+            slots = parse_schedule_times(user_input)
             
-            # Сохраняем расписание
+            # Сохраняем расписание ('hours' оставляем для совместимости со старыми версиями)
+            times = [format_slot(slot) for slot in slots]
             self.user_schedules[user_id_str] = {
-                'hours': sorted(hours),
+                'times': times,
+                'hours': sorted({slot // 60 for slot in slots}),
                 'enabled': True
             }
-            self.save_schedules()
+            self.index_schedule(user_id_str)
+            self.save_schedules(user_id_str)
             
-            times = ', '.join([f"{h}:00" for h in sorted(hours)])
-            await update.message.reply_text(f"✅ Расписание установлено!\n⏰ {times}")
-            logger.info(f"✅ Расписание установлено для {user_id}: {hours}")
+            await update.message.reply_text(f"✅ Расписание установлено!\n⏰ {', '.join(times)}")
+            logger.info(f"✅ Расписание установлено для {user_id}: {times}")
             
         except ValueError:
-            await update.message.reply_text("❌ Ошибка! Введите часы через запятую (например: 8,14,20)")
+            await update.message.reply_text("❌ Ошибка! Введите время через запятую: часы 0-23, минуты 0-59 (например: 8,14:30,20)")
             context.user_data['waiting_for_schedule'] = True
     
+    def due_schedule_slots(self, now: datetime) -> list:
+        """Слоты (дата, минута суток), рассылку которых пора выполнить (с догоном пропущенных тиков)"""
+        slots = due_slots(now, self.last_schedule_slot)
+        if slots:
+            self.last_schedule_slot = slots[-1][1]
+        return slots
+    
     async def scheduled_message(self, context: ContextTypes.DEFAULT_TYPE):
-        """Отправить мотивирующее сообщение пользователям по их расписаниям"""
+        """Подготовить сообщения для ближайших слотов и разослать те, чья минута наступила"""
+        with registry.timer('scheduler_tick_seconds'):
+            await self.schedule_tick(context)
+    
+    async def schedule_tick(self, context: ContextTypes.DEFAULT_TYPE):
+        """Один тик планировщика (без замера времени)"""
+        await self.schedules_loaded.wait()
         now = datetime.now()
-        current_hour = now.hour
-        
-        prompts = [
-            "Напиши короткий комплимент для начала дня - позитивное и воодушевляющее сообщение.",
-            "Придумай мудрый совет о самолюбии и уверенности в себе.",
-            "Напиши вдохновляющее сообщение о том, что каждый день - новая возможность.",
-            "Скажи что-то приятное про умных и целеустремленных женщин.",
-            "Напиши мотивацию для завершения дня с улыбкой.",
-        ]
+        # Слот занимается в общем хранилище: повторный или параллельный запуск воркера его не продублирует.
+        # Занятие ждёт блокировку базы (её держат сброс и другие воркеры), поэтому идёт в потоке
+        slots = []
+        for day, slot in self.due_schedule_slots(now):
+            if await asyncio.to_thread(self.storage.claim, f"slot:{day.isoformat()}:{format_slot(slot)}:{self.shard}"):
+                slots.append(slot)
+        
+        # Заранее запускаем персональную генерацию для слота через SCHEDULE_PREGEN_MINUTES минут
+        if SCHEDULE_PREGEN_MINUTES > 0:
+            for slot in slots:
+                upcoming = (slot + SCHEDULE_PREGEN_MINUTES) % MINUTES_PER_DAY
+                users = set(self.schedule_index.get(upcoming, ()))
+                if users and upcoming not in self.pregen_tasks:
+                    self.pregen_results[upcoming] = {}
+                    self.pregen_tasks[upcoming] = context.application.create_task(
+                        self.pregenerate_slot(upcoming, users),
+                        name=f"pregenerate_{format_slot(upcoming)}"
+                    )
+        
+        due_users = set()
+        ready = {}
+        for slot in slots:
+            due_users.update(self.schedule_index.get(slot, ()))
+            # Дедлайн: что не успело сгенерироваться, заменим общим сообщением
+            task = self.pregen_tasks.pop(slot, None)
+            if task and not task.done():
+                task.cancel()
+            ready.update(self.pregen_results.pop(slot, {}))
         
-        prompt = random.choice(prompts)
-        message = self.get_response(prompt)
+        registry.inc('scheduler_due_users_total', len(due_users))
+        registry.inc('scheduler_pregenerated_total', len(ready))
+        if not due_users:
+            return
         
-        count = 0
-        for user_id_str, schedule in self.user_schedules.items():
-            if schedule.get('enabled', True) and current_hour in schedule.get('hours', []):
+        # Рассылка идёт в фоне, чтобы большой слот не задерживал тики следующих минут
+        context.application.create_task(
+            self.deliver_scheduled(context.bot, due_users, ready),
+            name="scheduled_delivery"
+        )
+    
+    def build_scheduled_prompt(self, user_id_str: str) -> str:
+        """Персональная подсказка для мотивации по расписанию"""
+        prompt = random.choice(SCHEDULED_PROMPTS)
+        name = self.user_names.get(user_id_str)
+        if name:
+            prompt += f"\nОбратись к {name} по имени."
+        prompt += "\nОдно-два предложения."
+        compliment_context = self.get_compliment_context(user_id_str)
+        if compliment_context:
+            prompt += f"\n{compliment_context}"
+        return prompt
+    
+    async def pregenerate_slot(self, slot: int, users: set):
+        """Сгенерировать персональные сообщения для слота пачками с ограниченной параллельностью"""
+        results = self.pregen_results.setdefault(slot, {})
+        semaphore = asyncio.Semaphore(SCHEDULE_PREGEN_CONCURRENCY)
+        started = datetime.now()
+        # Имена и истории комплиментов слота читаются пачкой в потоке, а не по пользователю в цикле событий
+        try:
+            await self.user_names.preload(users)
+            await self.user_compliments.preload(users)
+        except Exception as e:
+            logger.error(f"Ошибка подгрузки данных слота {format_slot(slot)}: {e}")
+        
+        async def generate_for(user_id_str: str):
+            async with semaphore:
                 try:
-                    user_id = int(user_id_str)
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=f"✨ {message}\n\n— Ваш джентльмен"
-                    )
-                    count += 1
+                    results[user_id_str] = await self.generate(self.build_scheduled_prompt(user_id_str))
                 except Exception as e:
-                    logger.error(f"Ошибка отправки {user_id_str}: {e}")
+                    logger.error(f"Ошибка подготовки сообщения для {user_id_str}: {e}")
+        
+        await asyncio.gather(*(generate_for(user_id_str) for user_id_str in users))
+        elapsed = (datetime.now() - started).total_seconds()
+        logger.info(f"🧾 Слот {format_slot(slot)}: подготовлено {len(results)}/{len(users)} сообщений за {elapsed:.1f} с")
+    
+    async def deliver_scheduled(self, bot, due_users: set, ready: dict):
+        """Разослать пользователям слота персональные сообщения (или общее, если не успели)"""
+        missing = [user_id_str for user_id_str in due_users if user_id_str not in ready]
+        shared = None
+        if missing:
+            try:
+                shared = await self.generate(random.choice(SCHEDULED_PROMPTS), cached=True)
+            except Exception as e:
+                logger.error(f"❌ Не удалось получить общее сообщение для рассылки: {e}")
+            logger.info(f"📦 Общее сообщение для {len(missing)} пользователей без персонального")
+        
+        messages = []
+        for user_id_str in due_users:
+            text = ready.get(user_id_str) or shared
+            if text:
+                messages.append((int(user_id_str), f"✨ {text}\n\n— Ваш джентльмен"))
+        
+        report = await self.broadcaster.broadcast(bot, messages)
+        registry.observe('broadcast_seconds', report.elapsed)
+        registry.inc('broadcast_messages_total', report.sent, result='sent')
+        registry.inc('broadcast_messages_total', report.failed - len(report.blocked), result='failed')
+        registry.inc('broadcast_messages_total', len(report.blocked), result='blocked')
+        registry.inc('broadcast_retries_total', report.retries)
+        
+        # Пользователи, заблокировавшие бота, больше не получают рассылку
+        blocked = {str(chat_id) for chat_id in report.blocked}
+        for user_id_str in blocked:
+            self.disable_schedule(user_id_str)
         
-        if count > 0:
-            logger.info(f"📢 Отправлено мотиваций: {count} пользователям")
+        logger.info(f"📢 Рассылка мотиваций: {report.summary()}")
+    
+    def disable_schedule(self, user_id_str: str):
+        """Отключить рассылку пользователю (например, если он заблокировал бота)"""
+        schedule = self.user_schedules.get(user_id_str)
+        if not schedule or not schedule.get('enabled', True):
+            return
+        schedule['enabled'] = False
+        self.index_schedule(user_id_str)
+        self.save_schedules(user_id_str)
+        logger.info(f"🔕 Расписание отключено для {user_id_str}: бот заблокирован")
     
     def setup_scheduler(self, application: Application):
         """Настройка расписания сообщений"""
-        # Проверяем каждый час (в начале каждого часа)
+        # Тик в начале каждой минуты: выравниваем первый запуск по границе минуты,
+        # дальше интервал отсчитывается от него и не накапливает дрейф
+        now = datetime.now()
+        first = 60 - now.second - now.microsecond / 1_000_000
         application.job_queue.run_repeating(
             self.scheduled_message,
-            interval=3600,  # каждый час (3600 секунд)
-            first=0,  # запустить сразу
-            name="hourly_motivations"
+            interval=60,
+            first=first,
+            name="minute_motivations"
         )
-        logger.info("✅ Планировщик настроен: проверка каждый час")
+        logger.info(f"✅ Планировщик настроен: проверка каждую минуту, расписаний в индексе: {len(self.user_slots)}")
     
-    async def run(self):
-        """Запуск бота"""
-        app = Application.builder().token(TELEGRAM_TOKEN).build()
+    def timed(self, name: str, handler):
+        """Обработчик с замером длительности и подсчётом ошибок"""
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            started = asyncio.get_running_loop().time()
+            try:
+                return await handler(update, context)
+            except Exception as e:
+                registry.inc('bot_handler_errors_total', handler=name, error=type(e).__name__)
+                raise
+            finally:
+                registry.observe('bot_handler_seconds', asyncio.get_running_loop().time() - started, handler=name)
+        return wrapper
+    
+    async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Сводка метрик (только для администратора)"""
+        if not ADMIN_ID or update.effective_user.id != ADMIN_ID:
+            return
+        text = registry.summary()
+        # Лимит Telegram — 4096 символов на сообщение
+        for start in range(0, len(text), 4000):
+            await update.message.reply_text(text[start:start + 4000])
+    
+    async def profile_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Профилирование без перезапуска (только для администратора):
+        /profile cpu [секунд] — сэмплирующий профиль цикла событий;
+        /profile slow <мс|off> — сторож зависаний цикла;
+        /profile mem on|snap|off — снимки выделений памяти (tracemalloc)"""
+        if not ADMIN_ID or update.effective_user.id != ADMIN_ID:
+            return
+        args = [arg.lower() for arg in context.args or ()]
+        action = args[0] if args else ''
+        option = args[1] if len(args) > 1 else ''
+        try:
+            if action == 'cpu':
+                seconds = min(max(float(option or PROFILE_CPU_SECONDS), 1.0), 300.0)
+                await update.message.reply_text(f"🔬 Снимаю профиль CPU {seconds:g} с…")
+                path, top = await self.profiler.profile_cpu(seconds)
+                lines = [f"🔬 Профиль: {path}", "Чаще всего на вершине стека:"]
+                lines.extend(f"• {share:.0%} {name}" for name, share in top)
+            elif action == 'slow' and option == 'off':
+                self.profiler.disarm_watchdog()
+                lines = ["🐕 Сторож цикла событий выключен"]
+            elif action == 'slow':
+                threshold = float(option) / 1000 if option else PROFILE_SLOW_THRESHOLD or 0.25
+                self.profiler.arm_watchdog(max(threshold, 0.02))
+                lines = [f"🐕 Сторож включён: порог {self.profiler.slow_threshold * 1000:.0f} мс, "
+                         f"зависания — в {PROFILE_DIR}/stalls-{os.getpid()}.log"]
+            elif action == 'mem' and option == 'on':
+                self.profiler.start_tracemalloc()
+                lines = ["🧠 tracemalloc включён; снимок — /profile mem snap"]
+            elif action == 'mem' and option == 'snap':
+                path, report = await self.profiler.snapshot_memory()
+                lines = [f"🧠 Снимок: {path}", *report]
+            elif action == 'mem' and option == 'off':
+                self.profiler.stop_tracemalloc()
+                lines = ["🧠 tracemalloc выключен"]
+            else:
+                watchdog = f"{self.profiler.slow_threshold * 1000:.0f} мс" if self.profiler.slow_threshold else "выключен"
+                lines = [
+                    f"Сторож цикла: {watchdog}, зависаний: {self.profiler.stalls}",
+                    f"Профиль CPU: {'идёт' if self.profiler.cpu_running else 'нет'}",
+                    f"tracemalloc: {'включён' if profiling.tracemalloc.is_tracing() else 'выключен'}",
+                    "",
+                    "/profile cpu [секунд]",
+                    "/profile slow <мс|off>",
+                    "/profile mem on|snap|off",
+                ]
+        except (ValueError, RuntimeError) as e:
+            lines = [f"⚠️ {e}"]
+        text = "\n".join(lines)
+        for start in range(0, len(text), 4000):
+            await update.message.reply_text(text[start:start + 4000])
+    
+    def register_gauges(self, app: Application):
+        """Показатели, которые снимаются в момент чтения метрик"""
+        registry.gauge_callback('bot_update_queue_size', app.update_queue.qsize, "Обновлений в очереди приложения")
+        registry.gauge_callback(
+            'bot_pending_messages', lambda: sum(len(batch) for batch in self.pending_messages.values()),
+            "Сообщений, ждущих склейки"
+        )
+        registry.gauge_callback('bot_active_turns', lambda: len(self.user_turns), "Реплик в обработке")
+        registry.gauge_callback('storage_pending_records', self.storage.dirty_count, "Записей, ждущих сброса на диск")
+        registry.gauge_callback(
+            'pool_items', lambda: sum(len(items) for items in self.pool.items.values()), "Готовых ответов в пулах"
+        )
+        registry.gauge_callback(
+            'pool_hit_ratio', lambda: self.pool.hits / max(1, self.pool.hits + self.pool.misses),
+            "Доля ответов /compliment и /motivate из пула"
+        )
+        registry.gauge_callback('response_cache_hit_ratio', lambda: self.response_cache.hit_rate, "Доля ответов из кэша")
+        registry.gauge_callback('dialog_cache_users', lambda: len(self.user_dialogs), "Историй диалогов в памяти")
+        registry.gauge_callback('schedule_users', lambda: len(self.user_slots), "Пользователей с рассылкой")
+        # Клиент GigaChat появляется в фоне после старта
+        registry.gauge_callback(
+            'gigachat_inflight', lambda: len(self.llm.tasks) if self.llm else 0, "Запросов к GigaChat в процессе"
+        )
+        registry.gauge_callback(
+            'gigachat_circuit_state',
+            lambda: ('closed', 'half-open', 'open').index(self.llm.breaker.state) if self.llm else 2,
+            "Предохранитель GigaChat: 0 — закрыт, 1 — пробный запрос, 2 — открыт"
+        )
+        for priority, name in PRIORITY_NAMES.items():
+            registry.gauge_callback(
+                f'llm_queue_{name}', lambda priority=priority: self.llm.admission.queued[priority] if self.llm else 0,
+                f"Запросов класса {name}, ждущих слота GigaChat"
+            )
+    
+    def build_application(self, with_updater: bool = True, request: BaseRequest = None) -> Application:
+        """Создать приложение с обработчиками и планировщиком
+        (request — свой транспорт к Bot API, например заглушка в нагрузочном тесте)"""
+        builder = Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(CONCURRENT_UPDATES)
+        if TELEGRAM_API_URL:
+            builder = builder.base_url(TELEGRAM_API_URL)
+        # Все вызовы Bot API (кроме long polling) замеряются
+        builder = builder.request(metrics.TimedRequest(request or HTTPXRequest(connection_pool_size=256)))
+        if request is not None:
+            builder = builder.get_updates_request(request)
+        if not with_updater:
+            # Воркер кластера: обновления приходят от общего приёмника
+            builder = builder.updater(None)
+        app = builder.build()
         
         # Команды
-        app.add_handler(CommandHandler("start", self.start))
-        app.add_handler(CommandHandler("help", self.help_command))
-        app.add_handler(CommandHandler("compliment", self.compliment_command))
-        app.add_handler(CommandHandler("motivate", self.motivate_command))
-        app.add_handler(CommandHandler("setname", self.setname_command))
-        app.add_handler(CommandHandler("schedule", self.schedule_command))
-        app.add_handler(CommandHandler("myschedule", self.myschedule_command))
+        app.add_handler(CommandHandler("start", self.timed("start", self.start)))
+        app.add_handler(CommandHandler("help", self.timed("help", self.help_command)))
+        app.add_handler(CommandHandler("compliment", self.timed("compliment", self.compliment_command)))
+        app.add_handler(CommandHandler("motivate", self.timed("motivate", self.motivate_command)))
+        app.add_handler(CommandHandler("setname", self.timed("setname", self.setname_command)))
+        app.add_handler(CommandHandler("schedule", self.timed("schedule", self.schedule_command)))
+        app.add_handler(CommandHandler("myschedule", self.timed("myschedule", self.myschedule_command)))
+        app.add_handler(CommandHandler("stats", self.stats_command))
+        app.add_handler(CommandHandler("profile", self.profile_command))
         
         # Обычные сообщения
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.timed("message", self.handle_message)))
         
         # Настроим планировщик
         self.setup_scheduler(app)
+        self.register_gauges(app)
+        
+        return app
+    
+    def start_services(self, giga=None):
+        """Запустить фоновые задачи: прогрев хранилища, загрузка расписаний, GigaChat, сброс состояния,
+        пополнение пула, метрики"""
+        self.warm_task = asyncio.create_task(self.storage.warm())
+        self.schedules_task = asyncio.create_task(self.load_schedules())
+        self.llm_task = asyncio.create_task(self.start_llm(giga))
+        self.storage_task = asyncio.create_task(self.storage.run())
+        self.pool_task = asyncio.create_task(self.pool.run())
+        self.metrics_tasks = [asyncio.create_task(metrics.watch_loop_lag())]
+        self.profiler.attach()
+        if PROFILE_SLOW_THRESHOLD:
+            self.profiler.arm_watchdog(PROFILE_SLOW_THRESHOLD)
+        if METRICS_PORT:
+            port = METRICS_PORT + (self.shard if self.shards > 1 else 0)
+            self.metrics_tasks.append(asyncio.create_task(metrics.serve(METRICS_HOST, port)))
+    
+    async def stop_services(self, app: Application):
+        """Остановить приложение и фоновые задачи, сбросить состояние на диск"""
+        if self.pool_task:
+            self.pool_task.cancel()
+        self.pool.stop()
+        for task in (self.llm_task, self.schedules_task, self.warm_task, *self.metrics_tasks):
+            if task:
+                task.cancel()
+        self.profiler.close()
+        if self.llm:
+            await self.llm.close()
+        await app.stop()
+        await app.shutdown()
+        # Гарантированно сбрасываем накопленные изменения на диск
+        if self.storage_task:
+            self.storage_task.cancel()
+            await asyncio.gather(self.storage_task, return_exceptions=True)
+        await self.storage.flush()
+        self.storage.close()
+        logger.info(f"💾 Состояние сохранено (сбросов: {self.storage.flushes}, записей: {self.storage.records_written})")
+    
+    async def run(self):
+        """Запуск бота"""
+        app = self.build_application()
         
         logger.info("🎩 Джентльмен готов к работе!")
         
         # Инициализируем и запускаем
         await app.initialize()
         await app.start()
-        await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        webhook = webhook_config()
+        if webhook:
+            await app.updater.start_webhook(allowed_updates=ALLOWED_UPDATES, **webhook)
+            logger.info(f"🌐 Вебхук: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        else:
+            await app.updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+        self.start_services()
         
         try:
             await asyncio.Event().wait()
@@ -640,10 +1654,49 @@ class GentlemanBot:
             logger.info("⛔ Бот остановлен")
         finally:
             await app.updater.stop()
-            await app.stop()
-            await app.shutdown()
+            await self.stop_services(app)
+    
+    async def run_worker(self, updates):
+        """Запуск воркера кластера: обновления своих пользователей приходят из очереди updates"""
+        app = self.build_application(with_updater=False)
+        await app.initialize()
+        await app.start()
+        self.start_services()
+        logger.info(f"🎩 Воркер {self.shard + 1}/{self.shards} готов к работе")
+        
+        try:
+            while True:
+                data = await asyncio.to_thread(cluster.next_update, updates)
+                if data is None:
+                    break
+                if data is False:
+                    continue
+                await app.update_queue.put(Update.de_json(data, app.bot))
+        finally:
+            await self.stop_services(app)
+
 
+def run_shard_worker(shard: int, shards: int, updates):
+    """Точка входа процесса-воркера"""
+    root, ext = os.path.splitext(LOG_FILE)
+    setup_logging(f"{root}.{shard}{ext}")
+    bot = GentlemanBot(shard, shards)
+    try:
+        asyncio.run(bot.run_worker(updates))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logs.shutdown_logging()
 
 if __name__ == '__main__':
-    bot = GentlemanBot()
-    asyncio.run(bot.run())
\ No newline at end of file
+    setup_logging()
+    if WORKERS > 1:
+        # Воркеры делят состояние через общий файл SQLite
+        if STORAGE_BACKEND != 'sqlite':
+            raise SystemExit("Для WORKERS > 1 нужен STORAGE_BACKEND=sqlite")
+        ingress_bot = Bot(TELEGRAM_TOKEN, base_url=TELEGRAM_API_URL) if TELEGRAM_API_URL else Bot(TELEGRAM_TOKEN)
+        cluster.run_cluster(WORKERS, run_shard_worker, ingress_bot, ALLOWED_UPDATES, webhook_config())
+    else:
+        bot = GentlemanBot()
+        asyncio.run(bot.run())
+    logs.shutdown_logging()
\ No newline at end of file
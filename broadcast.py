@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from telegram.error import Forbidden, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Длительность паузы из RetryAfter (в PTB 22 это int или timedelta)"""
+    delay = error.retry_after
+    if isinstance(delay, timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+
+class RateLimiter:
+    """Ограничитель частоты: не больше rate событий в секунду, равномерно во времени"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_time = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        slot = max(now, self.next_time)
+        self.next_time = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds: float):
+        """Сдвинуть все следующие отправки (после RetryAfter от Telegram)"""
+        self.next_time = max(self.next_time, time.monotonic() + seconds)
+
+
+@dataclass
+class BroadcastReport:
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    retries: int = 0
+    blocked: list = field(default_factory=list)
+    errors: dict = field(default_factory=dict)  # chat_id -> текст последней ошибки
+    elapsed: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        return (f"отправлено {self.sent}/{self.total} за {self.elapsed:.1f} с "
+                f"({self.throughput:.1f} сообщ./с), ошибок {self.failed}, "
+                f"заблокировали бота {len(self.blocked)}, повторов {self.retries}")
+
+
+class Broadcaster:
+    """Рассылка пулом воркеров с учётом глобального и поканального лимитов Telegram"""
+
+    def __init__(self, workers: int = 16, global_rate: float = 25.0,
+                 chat_interval: float = 1.0, max_retries: int = 3):
+        self.workers = workers
+        self.limiter = RateLimiter(global_rate)
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.chat_next_time = {}  # chat_id -> когда в этот чат можно писать снова
+
+    async def wait_for_chat(self, chat_id: int):
+        now = time.monotonic()
+        slot = max(now, self.chat_next_time.get(chat_id, 0.0))
+        self.chat_next_time[chat_id] = slot + self.chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def send_one(self, bot, chat_id: int, text: str, report: BroadcastReport):
+        for attempt in range(self.max_retries + 1):
+            await self.wait_for_chat(chat_id)
+            await self.limiter.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                report.sent += 1
+                return
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                logger.warning(f"⏳ Telegram просит подождать {delay:.0f} с")
+                self.limiter.pause(delay)
+                report.retries += 1
+            except Forbidden as e:
+                report.blocked.append(chat_id)
+                report.errors[chat_id] = str(e)
+                report.failed += 1
+                return
+            except TelegramError as e:
+                report.errors[chat_id] = str(e)
+                if attempt >= self.max_retries:
+                    break
+                report.retries += 1
+                await asyncio.sleep(min(2 ** attempt, 10))
+            except Exception as e:
+                report.errors[chat_id] = str(e)
+                break
+        report.failed += 1
+        logger.error(f"Ошибка отправки {chat_id}: {report.errors.get(chat_id)}")
+
+    async def broadcast(self, bot, messages) -> BroadcastReport:
+        """Разослать сообщения: messages — итерируемое из пар (chat_id, текст)"""
+        queue = asyncio.Queue()
+        for chat_id, text in messages:
+            queue.put_nowait((chat_id, text))
+        report = BroadcastReport(total=queue.qsize())
+        if not report.total:
+            return report
+
+        async def worker():
+            while True:
+                try:
+                    chat_id, text = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await self.send_one(bot, chat_id, text, report)
+
+        started = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(min(self.workers, report.total))))
+        report.elapsed = time.monotonic() - started
+
+        # Не даём словарю поканальных лимитов расти бесконечно
+        now = time.monotonic()
+        self.chat_next_time = {c: t for c, t in self.chat_next_time.items() if t > now}
+        return report
@@ -0,0 +1,75 @@
+import hashlib
+import json
+import random
+import time
+from collections import OrderedDict
+
+
+def normalize_content(text: str) -> str:
+    return " ".join(text.split())
+
+
+class ResponseCache:
+    """Кэш ответов LLM для подсказок без контекста пользователя.
+
+    Ключ — нормализованные сообщения и параметры модели. На каждый ключ копится
+    до variants разных ответов: пока их меньше, запрос считается промахом и идёт
+    в модель, дальше ответы выдаются по кругу. Каждый вариант живёт ttl секунд,
+    число ключей ограничено max_keys (вытесняются давно не использованные).
+    """
+
+    def __init__(self, max_keys: int = 256, ttl: float = 3600.0, variants: int = 5):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.variants = variants
+        self.entries = OrderedDict()  # key -> [список (время, текст), индекс следующей выдачи]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(messages, **params) -> str:
+        parts = [(str(getattr(m.role, 'value', m.role)), normalize_content(m.content)) for m in messages]
+        raw = json.dumps([parts, sorted(params.items())], ensure_ascii=False)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        """Ответ из кэша или None, если вариантов пока недостаточно"""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        deadline = time.monotonic() - self.ttl
+        entry[0] = [(created, text) for created, text in entry[0] if created > deadline]
+        if len(entry[0]) < self.variants:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        index = entry[1] % len(entry[0])
+        entry[1] = index + 1
+        self.hits += 1
+        return entry[0][index][1]
+
+    def peek(self, key: str):
+        """Любой свежий вариант ответа, сколько бы их ни накопилось (для деградации при сбоях)"""
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        deadline = time.monotonic() - self.ttl
+        fresh = [text for created, text in entry[0] if created > deadline]
+        return random.choice(fresh) if fresh else None
+
+    def put(self, key: str, text: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = [[], 0]
+        self.entries.move_to_end(key)
+        if text not in (t for _, t in entry[0]):
+            entry[0].append((time.monotonic(), text))
+            del entry[0][:-self.variants]
+        while len(self.entries) > self.max_keys:
+            self.entries.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
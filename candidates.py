@@ -0,0 +1,51 @@
+import re
+
+MIN_CHARS = 15  # Короче — обрывок или служебный текст
+MAX_CHARS = 400  # Длиннее — модель не уложилась в 1-2 предложения
+
+_NUMBER_RE = re.compile(r"^\s*(?:\d{1,2}\s*[.)]|[-•*])\s*")
+_QUOTES = ('"', '«', '»', '“', '”', '„', "'")
+# Строки-пояснения вместо ответа: «Вот несколько вариантов:», «Вариант 2:», «Конечно!»
+_META_RE = re.compile(r"^(?:вот\b|конечно\b|вариант\b|варианты\b|комплимент\s*\d*\s*:|примечание\b)", re.IGNORECASE)
+
+
+def batch_prompt(prompt: str, count: int) -> str:
+    """Подсказка, просящая count разных вариантов вместо одного"""
+    prompt = prompt.rstrip()
+    for tail in ("Комплимент:", "Ответ:"):
+        if prompt.endswith(tail):
+            prompt = prompt[:-len(tail)].rstrip()
+    return (
+        f"{prompt}\n\nНапиши {count} РАЗНЫХ вариантов, не похожих друг на друга ни образами, ни построением. "
+        f"Каждый вариант — отдельной строкой, начиная с номера: «1.», «2.» и так далее. "
+        f"Только сами варианты, без пояснений и заголовков."
+    )
+
+
+def clean(text: str) -> str:
+    """Убрать нумерацию, разметку, обрамляющие кавычки и лишние пробелы"""
+    text = _NUMBER_RE.sub("", text.strip()).replace("**", "").strip()
+    while len(text) > 1 and text[0] in _QUOTES and text[-1] in _QUOTES:
+        text = text[1:-1].strip()
+    return " ".join(text.split())
+
+
+def is_valid(text: str) -> bool:
+    """Похоже ли на готовый ответ, а не на обрывок или пояснение модели"""
+    return (MIN_CHARS <= len(text) <= MAX_CHARS
+            and not text.endswith(':')
+            and not _META_RE.match(text))
+
+
+def parse(text: str, limit: int = None) -> list:
+    """Разобрать ответ модели на варианты: нумерованные строки, а если нумерации нет —
+    весь текст как один вариант. Невалидные и повторяющиеся отбрасываются"""
+    lines = [line for line in text.splitlines() if line.strip()]
+    numbered = [line for line in lines if _NUMBER_RE.match(line)]
+    raw = numbered if len(numbered) > 1 else [text]
+    result = []
+    for item in raw:
+        candidate = clean(item)
+        if is_valid(candidate) and candidate not in result:
+            result.append(candidate)
+    return result[:limit] if limit else result
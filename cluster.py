@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+
+from telegram import Bot
+from telegram.ext import Updater
+
+logger = logging.getLogger(__name__)
+
+
+def shard_for(user_id: int, shards: int) -> int:
+    """Номер воркера, которому принадлежит пользователь"""
+    return user_id % shards
+
+
+def next_update(updates: multiprocessing.Queue, timeout: float = 1.0):
+    """Следующее обновление для воркера; False, если за timeout ничего не пришло"""
+    try:
+        return updates.get(timeout=timeout)
+    except queue.Empty:
+        return False
+
+
+async def route_updates(bot: Bot, queues: list, allowed_updates: list, webhook: dict = None):
+    """Принимать обновления (long polling или вебхук) и раздавать их воркерам по user_id"""
+    update_queue = asyncio.Queue()
+    updater = Updater(bot=bot, update_queue=update_queue)
+    await updater.initialize()
+    if webhook:
+        await updater.start_webhook(allowed_updates=allowed_updates, **webhook)
+    else:
+        await updater.start_polling(allowed_updates=allowed_updates)
+    logger.info(f"🔀 Приём обновлений запущен, воркеров: {len(queues)}")
+
+    routed = [0] * len(queues)
+    try:
+        while True:
+            update = await update_queue.get()
+            user = update.effective_user
+            shard = shard_for(user.id, len(queues)) if user else 0
+            queues[shard].put(update.to_dict())
+            routed[shard] += 1
+    finally:
+        await updater.stop()
+        await updater.shutdown()
+        logger.info(f"🔀 Приём обновлений остановлен, разослано по воркерам: {routed}")
+
+
+def run_cluster(workers: int, worker_main, bot: Bot, allowed_updates: list, webhook: dict = None):
+    """Запустить workers процессов worker_main(shard, shards, updates) и общий приём обновлений"""
+    queues = [multiprocessing.Queue() for _ in range(workers)]
+    processes = [
+        multiprocessing.Process(target=worker_main, args=(shard, workers, queues[shard]), name=f"shard-{shard}")
+        for shard in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    logger.info(f"🚀 Запущено воркеров: {workers}")
+
+    try:
+        asyncio.run(route_updates(bot, queues, allowed_updates, webhook))
+    except KeyboardInterrupt:
+        logger.info("⛔ Кластер останавливается")
+    finally:
+        # None — сигнал воркеру завершиться после уже полученных обновлений
+        for updates in queues:
+            updates.put(None)
+        for process in processes:
+            process.join()
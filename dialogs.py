@@ -0,0 +1,130 @@
+import logging
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+from storage import DIALOGS, SUMMARIES
+
+logger = logging.getLogger(__name__)
+
+
+class DialogRecord:
+    """Одно сообщение диалога; время — целые секунды Unix"""
+
+    __slots__ = ('role', 'content', 'ts')
+
+    def __init__(self, role: str, content: str, ts: int = None):
+        self.role = role
+        self.content = content
+        self.ts = int(time.time()) if ts is None else ts
+
+    def to_json(self) -> dict:
+        return {"role": self.role, "content": self.content, "ts": self.ts}
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'DialogRecord':
+        ts = data.get("ts")
+        if ts is None and data.get("timestamp"):
+            # Старый формат: ISO-строка
+            try:
+                ts = int(datetime.fromisoformat(data["timestamp"]).timestamp())
+            except ValueError:
+                ts = 0
+        return cls(data["role"], data["content"], ts or 0)
+
+
+class DialogCache:
+    """Истории диалогов в памяти только для активных пользователей.
+
+    Каждая история — кольцевой буфер на max_history сообщений; рядом с ней
+    держится сводка беседы, чтобы не читать её из хранилища на каждое сообщение. Пользователи,
+    молчащие дольше idle_ttl секунд или вытесненные сверх max_users, выгружаются
+    (в хранилище они уже записаны) и подгружаются заново при следующем сообщении.
+    """
+
+    def __init__(self, storage, max_history: int, max_users: int = 5000, idle_ttl: float = 1800.0):
+        self.storage = storage
+        self.max_history = max_history
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self.histories = OrderedDict()  # user_id -> deque[DialogRecord], порядок — давность обращения
+        self.last_access = {}
+        self.summaries = {}  # user_id -> сводка беседы ("" — её нет) для пользователей в памяти
+        self.turns = {}  # user_id -> обменов с последнего обновления сводки (для пользователей в памяти)
+        self.loads = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.histories)
+
+    def get(self, user_id: str):
+        """История пользователя (подгружается из хранилища); None, если её нет"""
+        history = self.histories.get(user_id)
+        if history is None:
+            history = self.load(user_id)
+            if history is None:
+                return None
+            self.histories[user_id] = history
+        self.touch(user_id)
+        return history
+
+    def load(self, user_id: str):
+        stored = self.storage.get(DIALOGS, user_id)
+        if stored is None:
+            return None
+        self.loads += 1
+        if isinstance(stored, deque):
+            # Запись ещё ждёт сброса на диск — это тот же живой буфер
+            return stored
+        return deque((DialogRecord.from_json(item) for item in stored), maxlen=self.max_history)
+
+    def append(self, user_id: str, role: str, content: str):
+        """Добавить сообщение и пометить историю для записи в хранилище"""
+        history = self.get(user_id)
+        if history is None:
+            history = deque(maxlen=self.max_history)
+            self.histories[user_id] = history
+            self.touch(user_id)
+        history.append(DialogRecord(role, content))
+        self.storage.put(DIALOGS, user_id, history)
+        self.evict()
+
+    def get_summary(self, user_id: str) -> str:
+        """Сводка беседы (пустая строка, если её нет); сводки бывают только у пользователей с историей"""
+        if self.get(user_id) is None:
+            return ""
+        summary = self.summaries.get(user_id)
+        if summary is None:
+            record = self.storage.get(SUMMARIES, user_id)
+            summary = self.summaries[user_id] = record["text"] if record else ""
+        return summary
+
+    def set_summary(self, user_id: str, text: str):
+        self.storage.put(SUMMARIES, user_id, {"text": text, "ts": int(time.time())})
+        if user_id in self.histories:
+            self.summaries[user_id] = text
+
+    def count_turn(self, user_id: str) -> int:
+        """Учесть обмен репликами; число обменов с последнего обновления сводки"""
+        turns = self.turns[user_id] = self.turns.get(user_id, 0) + 1
+        return turns
+
+    def reset_turns(self, user_id: str):
+        self.turns.pop(user_id, None)
+
+    def touch(self, user_id: str):
+        self.histories.move_to_end(user_id)
+        self.last_access[user_id] = time.monotonic()
+
+    def evict(self):
+        """Выгрузить лишних и давно молчащих пользователей (самые старые — в начале)"""
+        deadline = time.monotonic() - self.idle_ttl
+        while self.histories:
+            user_id = next(iter(self.histories))
+            if len(self.histories) <= self.max_users and self.last_access[user_id] > deadline:
+                break
+            del self.histories[user_id]
+            del self.last_access[user_id]
+            self.summaries.pop(user_id, None)
+            self.turns.pop(user_id, None)
+            self.evictions += 1
@@ -0,0 +1,318 @@
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+from gigachat.exceptions import AuthenticationError, ResponseError
+
+from admission import AdmissionController, AdmissionError, BACKGROUND, COMMAND, LIVE
+from metrics import registry
+from routing import ModelRouter
+
+logger = logging.getLogger(__name__)
+
+# HTTP-коды, при которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# Модель недоступна этому ключу или не существует — повтор имеет смысл только на другой модели
+MODEL_UNAVAILABLE_STATUSES = {402, 404}
+
+
+class CircuitOpenError(Exception):
+    """GigaChat признан недоступным: запрос отклонён без обращения к API"""
+
+
+def is_transient(error: Exception) -> bool:
+    """Временная ли ошибка (сеть, таймаут, перегрузка API)"""
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    if isinstance(error, AuthenticationError):
+        return False
+    if isinstance(error, ResponseError) and len(error.args) > 1:
+        return error.args[1] in RETRYABLE_STATUSES
+    return False
+
+
+def is_model_unavailable(error: Exception) -> bool:
+    return isinstance(error, ResponseError) and len(error.args) > 1 and error.args[1] in MODEL_UNAVAILABLE_STATUSES
+
+
+class CircuitBreaker:
+    """Предохранитель: после failure_threshold ошибок подряд запросы отклоняются
+    reset_timeout секунд, затем пропускается одна пробная попытка"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("✅ GigaChat снова доступен")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.probing:
+                logger.error(f"🔌 GigaChat недоступен, запросы приостановлены на {self.reset_timeout:.0f} с")
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+
+class GigaChatClient:
+    """Обёртка над одним клиентом GigaChat (и его HTTP-сессией) на весь процесс:
+    допуск запросов по приоритетам, таймаут, повторы с экспоненциальной задержкой,
+    предохранитель, выбор модели по задаче и заблаговременное обновление токена доступа"""
+
+    def __init__(self, giga, max_concurrency: int = 8, timeout: float = 30.0, max_retries: int = 2,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0, breaker: CircuitBreaker = None,
+                 token_refresh_interval: float = 60.0, admission: AdmissionController = None,
+                 router: ModelRouter = None, token_refresh_margin: float = 120.0):
+        self.giga = giga
+        self.router = router or ModelRouter({})
+        self.admission = admission or AdmissionController(
+            max_concurrency,
+            queue_limits={LIVE: 200, COMMAND: 200, BACKGROUND: 1000},
+            deadlines={LIVE: 20.0, COMMAND: 30.0, BACKGROUND: 120.0},
+        )
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.token_refresh_interval = token_refresh_interval  # Пауза перед повтором неудачного обновления
+        self.token_refresh_margin = token_refresh_margin  # За сколько секунд до истечения обновлять токен
+        self.tasks = set()  # Запросы в процессе выполнения
+        self.token_task = None
+        self.access_token = None
+        self.token_expires_at = None  # Unix-время истечения токена, секунды
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+        self.rejected = 0
+
+    async def call(self, request, method: str = 'chat', priority: int = COMMAND, user=None, deadline: float = None,
+                   model: str = None):
+        """Выполнить запрос request(giga) -> awaitable в слоте допуска и с таймаутом"""
+        async with self.admission.slot(priority, user, deadline):
+            started = time.perf_counter()
+            task = asyncio.ensure_future(request(self.giga))
+            self.tasks.add(task)
+            try:
+                response = await asyncio.wait_for(task, timeout=self.timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Таймаут и ошибки API — сигнал о здоровье модели для маршрутизатора
+                self.router.record(model, time.perf_counter() - started, False)
+                raise
+            else:
+                self.router.record(model, time.perf_counter() - started, True)
+                return response
+            finally:
+                self.tasks.discard(task)
+                registry.observe(
+                    'gigachat_request_seconds', time.perf_counter() - started, method=method, model=model or 'default'
+                )
+
+    @staticmethod
+    def record_usage(response):
+        usage = getattr(response, 'usage', None)
+        if usage is None:
+            return
+        registry.inc('gigachat_tokens_total', getattr(usage, 'prompt_tokens', 0) or 0, kind='prompt')
+        registry.inc('gigachat_tokens_total', getattr(usage, 'completion_tokens', 0) or 0, kind='completion')
+
+    def record_error(self, error: Exception):
+        self.errors += 1
+        registry.inc('gigachat_errors_total', error=type(error).__name__)
+
+    async def chat(self, payload, priority: int = COMMAND, user=None, task: str = None):
+        """Запрос к GigaChat с повторами временных ошибок и предохранителем.
+        Срок ожидания в очереди общий для всех попыток. Модель выбирает
+        маршрутизатор по задаче task; повтор уходит на следующую модель задачи"""
+        deadline = self.admission.deadline_for(priority)
+        attempt = 0
+        failed = []  # Модели, на которых этот запрос уже не удался
+        while True:
+            model = self.router.choose(task, avoid=failed)
+            if model is not None:
+                payload.model = model
+            if not self.breaker.allow():
+                self.rejected += 1
+                registry.inc('gigachat_rejected_total')
+                raise CircuitOpenError("GigaChat временно недоступен")
+            self.calls += 1
+            try:
+                response = await self.call(lambda giga: giga.achat(payload), 'chat', priority, user, deadline, model)
+            except (asyncio.CancelledError, AdmissionError):
+                # До API запрос не дошёл — о доступности сервиса он ничего не говорит
+                self.breaker.probing = False
+                raise
+            except Exception as e:
+                self.record_error(e)
+                failed.append(model)
+                if is_model_unavailable(e) and attempt < self.max_retries and self.router.has_alternative(task, failed):
+                    # Модель недоступна этому ключу — сразу пробуем следующую модель задачи
+                    logger.warning(f"🔀 Модель {model} недоступна: {e}")
+                    attempt += 1
+                    continue
+                if not is_transient(e):
+                    # API ответил — ошибка в запросе, а не недоступность сервиса
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                if attempt >= self.max_retries or self.breaker.state == 'open':
+                    raise
+                # Полный джиттер: случайная пауза до base * 2^attempt
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                attempt += 1
+                self.retries += 1
+                registry.inc('gigachat_retries_total')
+                logger.warning(f"🔁 Повтор запроса к GigaChat через {delay:.1f} с: {type(e).__name__}: {e}")
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.record_success()
+            self.record_usage(response)
+            return response
+
+    async def stream(self, payload, priority: int = LIVE, user=None, task: str = None):
+        """Потоковый запрос к GigaChat: отдаёт кусочки текста по мере генерации.
+        Таймаут действует на ожидание каждого следующего кусочка; повторов нет"""
+        model = self.router.choose(task)
+        if model is not None:
+            payload.model = model
+        if not self.breaker.allow():
+            self.rejected += 1
+            registry.inc('gigachat_rejected_total')
+            raise CircuitOpenError("GigaChat временно недоступен")
+        try:
+            await self.admission.acquire(priority, user)
+        except (asyncio.CancelledError, AdmissionError):
+            self.breaker.probing = False
+            raise
+        try:
+            self.calls += 1
+            started = time.perf_counter()
+            first = True
+            chunks = self.giga.astream(payload)
+            try:
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=self.timeout)
+                    except StopAsyncIteration:
+                        break
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if first:
+                            first = False
+                            registry.observe('gigachat_first_chunk_seconds', time.perf_counter() - started)
+                        yield chunk.choices[0].delta.content
+            except asyncio.CancelledError:
+                self.breaker.probing = False
+                raise
+            except Exception as e:
+                self.record_error(e)
+                self.router.record(model, time.perf_counter() - started, False)
+                if is_transient(e):
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                raise
+            finally:
+                await chunks.aclose()
+                registry.observe(
+                    'gigachat_request_seconds', time.perf_counter() - started, method='stream', model=model or 'default'
+                )
+        finally:
+            self.admission.release(priority)
+        self.router.record(model, time.perf_counter() - started, True)
+        self.breaker.record_success()
+
+    async def refresh_token(self, force: bool = False) -> bool:
+        """Получить токен доступа; False, если не удалось.
+        aget_token отдаёт закэшированный токен, не глядя на срок, поэтому для
+        обновления (force=True) кэш клиента сначала сбрасывается"""
+        try:
+            if force:
+                reset = getattr(self.giga, '_reset_token', None)
+                if reset is not None:
+                    reset()
+            # Мимо очереди допуска: обновление токена не должно ждать за запросами
+            token = await asyncio.wait_for(self.giga.aget_token(), timeout=self.timeout)
+        except Exception as e:
+            logger.error(f"Ошибка обновления токена GigaChat: {type(e).__name__}: {e}")
+            return False
+        if token is None:
+            return False
+        expires_at = getattr(token, 'expires_at', None)
+        # expires_at в ответе GigaChat — миллисекунды
+        self.token_expires_at = expires_at / 1000 if expires_at else None
+        if token.access_token != self.access_token:
+            self.access_token = token.access_token
+            logger.info("🔑 Токен GigaChat обновлён")
+        return True
+
+    def token_refresh_delay(self) -> float:
+        """Сколько ждать до следующего обновления токена"""
+        if self.token_expires_at is None:
+            return self.token_refresh_interval
+        # Не меньше секунды: иначе слишком короткоживущий токен зациклил бы обновление
+        return max(1.0, self.token_expires_at - self.token_refresh_margin - time.time())
+
+    async def warmup(self) -> bool:
+        """Получить токен и открыть соединение заранее, до первого запроса пользователя"""
+        started = time.perf_counter()
+        ready = await self.refresh_token()
+        if ready:
+            logger.info(f"🔥 GigaChat готов за {time.perf_counter() - started:.2f} с")
+        return ready
+
+    async def refresh_token_loop(self):
+        """Обновлять токен в фоне, чтобы его получение не ложилось на запрос пользователя"""
+        ok = self.access_token is not None or await self.refresh_token()
+        while True:
+            await asyncio.sleep(self.token_refresh_delay() if ok else self.token_refresh_interval)
+            ok = await self.refresh_token(force=True)
+
+    def start(self):
+        if self.token_task is None:
+            self.token_task = asyncio.get_running_loop().create_task(self.refresh_token_loop())
+
+    async def cancel_all(self):
+        """Отменить незавершённые запросы (при остановке бота)"""
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            logger.info(f"⛔ Отменено запросов к GigaChat: {len(tasks)}")
+
+    async def close(self):
+        if self.token_task:
+            self.token_task.cancel()
+            await asyncio.gather(self.token_task, return_exceptions=True)
+            self.token_task = None
+        await self.cancel_all()
+        await self.giga.aclose()
@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+
+from telegram.request import BaseRequest
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (накопительная, как в Prometheus)"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля сверху: граница корзины, в которую он попадает"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """Реестр метрик процесса: счётчики, показатели и гистограммы с метками.
+
+    Показатели, которые дешевле считать при чтении (размеры очередей, доля
+    попаданий в кэш), регистрируются функциями через gauge_callback.
+    """
+
+    def __init__(self):
+        self.help = {}  # имя -> (тип, описание)
+        self.counters = {}  # имя -> {метки: значение}
+        self.gauges = {}
+        self.histograms = {}  # имя -> {метки: Histogram}
+        self.callbacks = {}  # имя -> функция без аргументов
+
+    def describe(self, name: str, kind: str, text: str):
+        self.help[name] = (kind, text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = _label_key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        self.gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    def observe(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = _label_key(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Замерить длительность блока в гистограмму name"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def gauge_callback(self, name: str, func, text: str = ""):
+        self.callbacks[name] = func
+        if text:
+            self.describe(name, 'gauge', text)
+
+    def read_callbacks(self) -> dict:
+        values = {}
+        for name, func in self.callbacks.items():
+            try:
+                values[name] = float(func())
+            except Exception as e:
+                logger.debug(f"Не удалось прочитать метрику {name}: {e}")
+        return values
+
+    def render(self) -> str:
+        """Текстовый формат экспозиции Prometheus"""
+        lines = []
+
+        def header(name: str, default_kind: str):
+            kind, text = self.help.get(name, (default_kind, ""))
+            if text:
+                lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name, series in sorted(self.counters.items()):
+            header(name, 'counter')
+            for key, value in series.items():
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        for name, series in sorted(self.gauges.items()):
+            header(name, 'gauge')
+            for key, value in series.items():
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        for name, value in sorted(self.read_callbacks().items()):
+            header(name, 'gauge')
+            lines.append(f"{name} {value}")
+        for name, series in sorted(self.histograms.items()):
+            header(name, 'histogram')
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(key, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(key, (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Короткая сводка для администратора в Telegram"""
+        lines = ["⏱ Задержки (n / среднее / p95):"]
+        for name, series in sorted(self.histograms.items()):
+            for key, histogram in sorted(series.items()):
+                if not histogram.count:
+                    continue
+                label = ",".join(str(v) for _, v in key)
+                # Задержки — в миллисекундах, прочие гистограммы (размеры) — как есть
+                scale, unit = (1000, " мс") if name.endswith('_seconds') else (1, "")
+                lines.append(
+                    f"• {name}{f'[{label}]' if label else ''}: {histogram.count} / "
+                    f"{histogram.sum / histogram.count * scale:.0f}{unit} / "
+                    f"≤{histogram.quantile(0.95) * scale:.0f}{unit}"
+                )
+        lines.append("\n🔢 Счётчики:")
+        for name, series in sorted(self.counters.items()):
+            for key, value in sorted(series.items()):
+                label = ",".join(str(v) for _, v in key)
+                lines.append(f"• {name}{f'[{label}]' if label else ''}: {value:g}")
+        lines.append("\n📊 Текущие значения:")
+        gauges = {name: value for name, series in self.gauges.items() for key, value in series.items() if not key}
+        gauges.update(self.read_callbacks())
+        for name, value in sorted(gauges.items()):
+            lines.append(f"• {name}: {value:g}")
+        return "\n".join(lines)
+
+
+registry = Metrics()
+
+
+class TimedRequest(BaseRequest):
+    """Транспорт Bot API, замеряющий длительность каждого вызова Telegram"""
+
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        endpoint = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await self.inner.do_request(url, method, request_data, **timeouts)
+        except Exception as e:
+            registry.inc('telegram_api_errors_total', method=endpoint, error=type(e).__name__)
+            raise
+        finally:
+            registry.observe('telegram_api_seconds', time.perf_counter() - started, method=endpoint)
+
+
+async def watch_loop_lag(interval: float = 0.5):
+    """Задержка цикла событий: насколько позже положенного просыпается sleep(interval)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        registry.set('event_loop_lag_last_seconds', lag)
+        registry.observe('event_loop_lag_seconds', lag)
+
+
+async def serve(host: str, port: int):
+    """HTTP-эндпоинт /metrics для Prometheus (только чтение, без зависимостей)"""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Заголовки запроса не нужны, но их надо дочитать
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = "200 OK", registry.render().encode('utf-8')
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"📈 Метрики: http://{host}:{port}/metrics")
+    async with server:
+        await server.serve_forever()
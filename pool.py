@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class ResponsePool:
+    """Пул заранее сгенерированных ответов с фоновым пополнением.
+
+    Каждый ключ пула связан с подсказкой; ответы живут не дольше ttl секунд,
+    а когда их остаётся low_watermark или меньше, пул дозаполняется до size.
+    """
+
+    def __init__(self, generate, size: int = 10, low_watermark: int = 3, ttl: float = 3600.0,
+                 concurrency: int = 2, max_keys: int = 50, is_duplicate=None, batch_size: int = 1):
+        self.generate = generate  # async (prompt) -> str или список из batch_size вариантов
+        self.batch_size = max(1, batch_size)
+        # (текст, тексты пула) -> bool: отбраковка почти-повторов при пополнении
+        self.is_duplicate = is_duplicate or (lambda text, texts: text in texts)
+        self.size = size
+        self.low_watermark = low_watermark
+        self.ttl = ttl
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_keys = max_keys
+        self.prompts = OrderedDict()  # key -> подсказка, порядок — давность использования
+        self.pinned = set()  # Ключи, которые не вытесняются (общие пулы)
+        self.items = {}  # key -> deque[(время создания, текст)]
+        self.refilling = {}  # key -> задача пополнения
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, key: str, prompt: str, pinned: bool = False):
+        """Завести пул под ключ; лишние незакреплённые ключи вытесняются по давности"""
+        if key in self.prompts:
+            self.prompts.move_to_end(key)
+            return
+        self.prompts[key] = prompt
+        self.items[key] = deque()
+        if pinned:
+            self.pinned.add(key)
+        while len(self.prompts) - len(self.pinned) > self.max_keys:
+            victim = next(k for k in self.prompts if k not in self.pinned)
+            self.drop(victim)
+        self.schedule_refill(key)
+
+    def drop(self, key: str):
+        self.prompts.pop(key, None)
+        self.items.pop(key, None)
+        task = self.refilling.pop(key, None)
+        if task:
+            task.cancel()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.prompts
+
+    def expire(self, key: str):
+        items = self.items.get(key)
+        deadline = time.monotonic() - self.ttl
+        while items and items[0][0] < deadline:
+            items.popleft()
+
+    def take(self, key: str, reject=None):
+        """Выдать свежий ответ, не отвергнутый reject(text); None, если подходящего нет"""
+        if key not in self.prompts:
+            self.misses += 1
+            return None
+        self.prompts.move_to_end(key)
+        self.expire(key)
+        items = self.items[key]
+        result = None
+        for i, (_, text) in enumerate(items):
+            if reject is None or not reject(text):
+                result = text
+                del items[i]
+                break
+        if len(items) <= self.low_watermark:
+            self.schedule_refill(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def offer(self, key: str, texts: list):
+        """Добавить готовые ответы в пул (без почти-повторов и не сверх size)"""
+        items = self.items.get(key)
+        if items is None:
+            return
+        for text in texts:
+            if len(items) >= self.size:
+                break
+            if not self.is_duplicate(text, [t for _, t in items]):
+                items.append((time.monotonic(), text))
+
+    def schedule_refill(self, key: str):
+        task = self.refilling.get(key)
+        if task and not task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # Цикл событий ещё не запущен — пул пополнит run()
+        self.refilling[key] = loop.create_task(self.refill(key))
+
+    async def refill(self, key: str):
+        """Догенерировать ответы до size"""
+        prompt = self.prompts.get(key)
+        if prompt is None:
+            return
+        missing = self.size - len(self.items[key])
+
+        async def generate_batch():
+            async with self.semaphore:
+                try:
+                    texts = await self.generate(prompt)
+                except Exception as e:
+                    logger.error(f"Ошибка пополнения пула {key}: {e}")
+                    return
+            self.offer(key, [texts] if isinstance(texts, str) else texts)
+
+        await asyncio.gather(*(generate_batch() for _ in range(math.ceil(missing / self.batch_size))))
+        logger.info(f"🧺 Пул {key}: {len(self.items.get(key, ()))}/{self.size}")
+
+    async def run(self, interval: float = 60.0):
+        """Фоновая проверка: выбрасываем устаревшее и дозаполняем просевшие пулы"""
+        while True:
+            for key in list(self.prompts):
+                self.expire(key)
+                if len(self.items[key]) <= self.low_watermark:
+                    self.schedule_refill(key)
+            await asyncio.sleep(interval)
+
+    def stop(self):
+        for task in self.refilling.values():
+            task.cancel()
+        self.refilling.clear()
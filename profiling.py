@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+
+
+def collapse(frame) -> str:
+    """Стек в «свёрнутом» формате flamegraph: от корня к листу через ';'"""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def format_stack(frame, limit: int = 25) -> str:
+    names = []
+    while frame is not None and len(names) < limit:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return "\n".join(f"  {name}" for name in names)
+
+
+class LoopProfiler:
+    """Профилирование цикла событий на ходу, без перезапуска бота.
+
+    Все три инструмента работают из отдельных потоков и снимают стек потока
+    цикла через sys._current_frames, поэтому сам цикл не замедляют:
+    - сэмплирующий профилировщик CPU на заданное окно (свёрнутые стеки для flamegraph);
+    - сторож зависаний: цикл раз в threshold / 2 отмечается «пульсом», и если
+      пульса нет дольше threshold, в файл пишется стек того, что держит цикл;
+    - снимки выделений памяти tracemalloc с разницей от предыдущего снимка.
+    Сторож стоит один таймер цикла и одно пробуждение потока на пульс, его можно
+    держать включённым постоянно; tracemalloc дорог и включается только по команде.
+    """
+
+    def __init__(self, directory: str = 'profiles', interval: float = 0.005):
+        self.directory = directory
+        self.interval = interval
+        self.loop = None
+        self.thread_id = None
+        self.cpu_running = False
+        self.slow_threshold = 0.0
+        self.heartbeat = 0.0
+        self.beat_handle = None
+        self.watchdog_thread = None
+        self.stalls = 0
+        self.previous_snapshot = None
+
+    def attach(self):
+        """Запомнить цикл событий и его поток (вызывается внутри цикла)"""
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+
+    def path(self, kind: str, suffix: str) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        return os.path.join(self.directory, f"{kind}-{stamp}-{os.getpid()}.{suffix}")
+
+    # --- CPU ---
+
+    async def profile_cpu(self, duration: float) -> tuple:
+        """Сэмплировать стек цикла duration секунд; (файл, самые частые функции)"""
+        if self.cpu_running:
+            raise RuntimeError("профилирование уже идёт")
+        self.cpu_running = True
+        try:
+            return await asyncio.to_thread(self.sample, duration)
+        finally:
+            self.cpu_running = False
+
+    def sample(self, duration: float) -> tuple:
+        stacks = Counter()
+        leaves = Counter()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stacks[collapse(frame)] += 1
+                leaves[frame_name(frame)] += 1
+            del frame
+            time.sleep(self.interval)
+        path = self.path('cpu', 'collapsed')
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        total = sum(leaves.values()) or 1
+        top = [(name, count / total) for name, count in leaves.most_common(10)]
+        logger.info(f"🔬 Профиль CPU за {duration:g} с: {sum(stacks.values())} сэмплов → {path}")
+        return path, top
+
+    # --- Сторож зависаний цикла ---
+
+    def arm_watchdog(self, threshold: float):
+        """Включить (или перенастроить) сторож: зависание цикла дольше threshold секунд пишется в файл"""
+        self.disarm_watchdog()
+        self.slow_threshold = threshold
+        self.heartbeat = time.monotonic()
+        self.beat()
+        self.watchdog_thread = threading.Thread(
+            target=self.watch, args=(threshold,), name='loop-watchdog', daemon=True
+        )
+        self.watchdog_thread.start()
+        logger.info(f"🐕 Сторож цикла событий включён: порог {threshold * 1000:.0f} мс")
+
+    def disarm_watchdog(self):
+        if self.beat_handle is not None:
+            self.beat_handle.cancel()
+            self.beat_handle = None
+        # Поток сторожа заметит это при следующем пробуждении и завершится сам
+        self.watchdog_thread = None
+        self.slow_threshold = 0.0
+
+    def beat(self):
+        self.heartbeat = time.monotonic()
+        self.beat_handle = self.loop.call_later(self.slow_threshold / 2, self.beat)
+
+    def watch(self, threshold: float):
+        thread = threading.current_thread()
+        reported = None  # Пульс, по которому уже записали зависание
+        while True:
+            time.sleep(threshold / 2)
+            if self.watchdog_thread is not thread:
+                return
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat - threshold / 2
+            if stalled <= threshold or heartbeat == reported:
+                continue
+            reported = heartbeat
+            frame = sys._current_frames().get(self.thread_id)
+            stack = format_stack(frame) if frame is not None else "  (стек недоступен)"
+            del frame
+            self.stalls += 1
+            registry.inc('event_loop_stalls_total')
+            logger.warning(f"🐢 Цикл событий занят уже {stalled * 1000:.0f} мс:\n{stack}")
+            self.write_stall(stalled, stack)
+
+    def write_stall(self, stalled: float, stack: str):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"stalls-{os.getpid()}.log")
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(f"{datetime.now().isoformat(timespec='milliseconds')} занят {stalled * 1000:.0f} мс\n{stack}\n\n")
+        except OSError as e:
+            logger.error(f"Не удалось записать зависание цикла: {e}")
+
+    # --- Память ---
+
+    def start_tracemalloc(self, frames: int = 10):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self.previous_snapshot = None
+            logger.info("🧠 tracemalloc включён")
+
+    def stop_tracemalloc(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            self.previous_snapshot = None
+            logger.info("🧠 tracemalloc выключен")
+
+    async def snapshot_memory(self) -> tuple:
+        """Снимок выделений: дамп для офлайн-анализа и отчёт (с разницей от прошлого снимка); (файл, строки отчёта)"""
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc не включён")
+        return await asyncio.to_thread(self.dump_memory)
+
+    def dump_memory(self) -> tuple:
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        path = self.path('memory', 'tracemalloc')
+        snapshot.dump(path)
+        if self.previous_snapshot is not None:
+            stats = snapshot.compare_to(self.previous_snapshot, 'lineno')
+        else:
+            stats = snapshot.statistics('lineno')
+        self.previous_snapshot = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"Сейчас {current / 2 ** 20:.1f} МБ, пик {peak / 2 ** 20:.1f} МБ"]
+        lines.extend(str(stat) for stat in stats[:15])
+        with open(f"{path}.txt", 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        logger.info(f"🧠 Снимок памяти → {path}")
+        return path, lines
+
+    def close(self):
+        self.disarm_watchdog()
+        self.stop_tracemalloc()
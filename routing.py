@@ -0,0 +1,126 @@
+import logging
+import time
+from collections import deque
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Типы задач: у каждого свой список моделей и свой лимит токенов в запросе
+DIALOG = 'dialog'  # Многоходовая беседа — сильная модель
+SHORT = 'short'  # Комплимент, мотивация, сообщение по расписанию — лёгкая и быстрая
+SUMMARY = 'summary'  # Сводка беседы в фоне
+
+
+def parse_models(value: str) -> tuple:
+    """'GigaChat-Pro, GigaChat' -> ('GigaChat-Pro', 'GigaChat')"""
+    return tuple(model.strip() for model in value.split(',') if model.strip())
+
+
+class Route:
+    """Модели задачи в порядке предпочтения и бюджет задержки одного запроса"""
+
+    __slots__ = ('models', 'latency_budget')
+
+    def __init__(self, models: tuple, latency_budget: float):
+        self.models = models
+        self.latency_budget = latency_budget
+
+
+class ModelStats:
+    """Скользящее окно исходов запросов к одной модели: (время, длительность, успех)"""
+
+    __slots__ = ('samples',)
+
+    def __init__(self, max_samples: int):
+        self.samples = deque(maxlen=max_samples)
+
+    def prune(self, horizon: float):
+        while self.samples and self.samples[0][0] < horizon:
+            self.samples.popleft()
+
+    def error_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, _, ok in self.samples if not ok) / len(self.samples)
+
+    def mean_latency(self) -> float:
+        latencies = [latency for _, latency, ok in self.samples if ok]
+        return sum(latencies) / len(latencies) if latencies else 0.0
+
+
+class ModelRouter:
+    """Выбор модели GigaChat для задачи.
+
+    Берётся первая исправная модель из списка задачи. Модель считается
+    деградировавшей, если за последние window секунд по ней накопилось
+    не меньше min_samples запросов и среди них слишком много ошибок или
+    средняя задержка выше бюджета задачи. Старые исходы выпадают из окна,
+    поэтому через window секунд деградировавшая модель снова получает
+    запросы и может вернуть себе трафик.
+    """
+
+    def __init__(self, routes: dict, window: float = 300.0, min_samples: int = 10,
+                 max_error_rate: float = 0.3, max_samples: int = 200):
+        self.routes = routes
+        self.window = window
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.max_samples = max_samples
+        self.stats = {}  # модель -> ModelStats
+        self.degraded = set()  # (задача, модель), о которых уже предупредили в журнале
+
+    def stats_for(self, model: str) -> ModelStats:
+        stats = self.stats.get(model)
+        if stats is None:
+            stats = self.stats[model] = ModelStats(self.max_samples)
+        stats.prune(time.monotonic() - self.window)
+        return stats
+
+    def healthy(self, model: str, route: Route) -> bool:
+        stats = self.stats_for(model)
+        if len(stats.samples) < self.min_samples:
+            return True
+        return stats.error_rate() <= self.max_error_rate and stats.mean_latency() <= route.latency_budget
+
+    def choose(self, task: str, avoid=()) -> str:
+        """Модель для очередного запроса задачи; avoid — модели, уже подведшие этот запрос.
+        None — задача не настроена, запрос уйдёт в модель клиента по умолчанию"""
+        route = self.routes.get(task)
+        if route is None or not route.models:
+            return None
+        candidates = [model for model in route.models if model not in avoid] or list(route.models)
+        for model in candidates:
+            if self.healthy(model, route):
+                self.note_health(task, model, True)
+                break
+            self.note_health(task, model, False)
+        else:
+            # Исправных нет — меньше всего ошибок, затем самая быстрая
+            model = min(candidates, key=lambda m: (self.stats_for(m).error_rate(), self.stats_for(m).mean_latency()))
+        if model != route.models[0]:
+            registry.inc('llm_route_fallback_total', task=task, model=model)
+        registry.inc('llm_route_total', task=task, model=model)
+        return model
+
+    def has_alternative(self, task: str, avoid) -> bool:
+        """Есть ли у задачи модель, ещё не подводившая запрос"""
+        route = self.routes.get(task)
+        return route is not None and any(model not in avoid for model in route.models)
+
+    def note_health(self, task: str, model: str, healthy: bool):
+        key = (task, model)
+        if healthy and key in self.degraded:
+            self.degraded.discard(key)
+            logger.info(f"✅ Модель {model} снова обслуживает задачи {task}")
+        elif not healthy and key not in self.degraded:
+            self.degraded.add(key)
+            stats = self.stats_for(model)
+            logger.warning(
+                f"🐢 Модель {model} деградировала для {task}: ошибок {stats.error_rate():.0%}, "
+                f"задержка {stats.mean_latency():.1f} с — запросы переводятся на запасную"
+            )
+
+    def record(self, model: str, latency: float, ok: bool):
+        if model is not None:
+            self.stats_for(model).samples.append((time.monotonic(), latency, ok))
@@ -0,0 +1,62 @@
+import re
+import zlib
+from collections import Counter
+
+SHINGLE_SIZE = 4  # Длина символьной n-граммы
+SKETCH_SIZE = 32  # Сколько минимальных хешей хранить в подписи (bottom-k MinHash)
+STEM_SIZE = 6  # Грубая основа слова для поиска повторяющихся образов
+
+_WORD_RE = re.compile(r"[a-zа-яё]+")
+
+# Частые слова, которые не являются «образами» и не должны попадать в запреты
+STOP_STEMS = {
+    "котора", "которы", "которо", "всегда", "каждый", "каждую", "каждог", "вашему", "вашего",
+    "только", "сегодн", "потому", "словно", "вокруг", "вместе", "сейчас", "сможет", "самого",
+    "самому", "другим", "других", "настоя", "особен", "действ",
+}
+
+
+def normalize(text: str) -> str:
+    """Нижний регистр, только буквы, одинарные пробелы"""
+    return " ".join(_WORD_RE.findall(text.lower().replace("ё", "е")))
+
+
+def signature(text: str) -> list:
+    """Подпись текста: SKETCH_SIZE наименьших хешей его символьных n-грамм"""
+    norm = normalize(text)
+    if len(norm) <= SHINGLE_SIZE:
+        shingles = {norm}
+    else:
+        shingles = {norm[i:i + SHINGLE_SIZE] for i in range(len(norm) - SHINGLE_SIZE + 1)}
+    hashes = {zlib.crc32(s.encode("utf-8")) for s in shingles}
+    return sorted(hashes)[:SKETCH_SIZE]
+
+
+def similarity(a: list, b: list) -> float:
+    """Оценка сходства Жаккара по двум подписям (0 — ничего общего, 1 — совпадают)"""
+    if not a or not b:
+        return 0.0
+    set_a = a if isinstance(a, frozenset) else frozenset(a)
+    return len(set_a.intersection(b)) / len(set_a.union(b))
+
+
+def max_similarity(sig: list, others) -> float:
+    """Наибольшее сходство подписи с любой из others"""
+    sig = frozenset(sig)
+    return max((similarity(sig, other) for other in others), default=0.0)
+
+
+def stems(text: str) -> set:
+    """Основы значимых слов текста"""
+    return {
+        word[:STEM_SIZE] for word in _WORD_RE.findall(text.lower().replace("ё", "е"))
+        if len(word) >= STEM_SIZE and word[:STEM_SIZE] not in STOP_STEMS
+    }
+
+
+def repeated_stems(texts: list, limit: int = 5, exclude=()) -> list:
+    """Основы слов, встречающиеся в нескольких текстах — повторяющиеся образы"""
+    counts = Counter()
+    for text in texts:
+        counts.update(stems(text) - set(exclude))
+    return [stem for stem, count in counts.most_common(limit) if count > 1]
@@ -0,0 +1,257 @@
+"""Обслуживание состояния бота без загрузки хранилищ в память.
+
+Записи читаются потоком: из SQLite — страницами, из JSON-файлов — инкрементальным
+разбором по одной записи, из выгрузки — построчно. Поэтому экспорт, сжатие и
+отчёты работают в памяти, не зависящей от числа пользователей.
+
+Команды:
+    export   — выгрузить хранилища в JSON Lines: {"store", "user_id", "value"} на строку
+    compact  — обрезать истории диалогов до MAX_DIALOG_HISTORY сообщений и комплиментов
+               до MAX_COMPLIMENT_HISTORY, перевести старые записи диалогов в текущий формат
+    stats    — активные пользователи по дням, сообщения на пользователя, часы рассылки,
+               доля повторных комплиментов
+
+Примеры:
+    python state_cli.py export --output state.jsonl
+    python state_cli.py export --store dialogs --output - | gzip > dialogs.jsonl.gz
+    python state_cli.py compact --dry-run
+    python state_cli.py stats --input state.jsonl --json
+
+Хранилище JSON-файлов бот держит в памяти и перезаписывает целиком, поэтому compact
+для STORAGE_BACKEND=json запускайте при остановленном боте. SQLite можно сжимать на ходу.
+"""
+import argparse
+import json
+import os
+import sys
+from collections import Counter
+from datetime import datetime
+
+import bot
+import similarity
+import storage
+from dialogs import DialogRecord
+from storage import SCHEDULES, NAMES, DIALOGS, COMPLIMENTS, STORES
+
+# Корзины «сообщений пользователя в сохранённой истории»: (верхняя граница, подпись)
+MESSAGE_BUCKETS = ((1, "1"), (2, "2"), (5, "3-5"), (10, "6-10"), (15, "11-15"), (float('inf'), ">15"))
+
+
+def open_backend(args, read_only: bool = True):
+    """Хранилище бота как есть: без переноса JSON-файлов в SQLite (его делает только бот)
+    и, для export и stats, без права записи"""
+    if args.backend == 'json':
+        return storage.JsonStateStore(bot.STATE_FILES)
+    if not os.path.exists(args.db):
+        raise SystemExit(f"База {args.db} не найдена (укажите --db или --backend json)")
+    return storage.SqliteStateStore(args.db, read_only=read_only)
+
+
+def backend_records(backend, stores):
+    """(хранилище, user_id, значение) прямо из хранилища бота"""
+    for store in stores:
+        for user_id, value in backend.scan(store):
+            yield store, user_id, value
+
+
+def export_records(path: str, stores):
+    """(хранилище, user_id, значение) из выгрузки export"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record['store'] in stores:
+                yield record['store'], record['user_id'], record['value']
+
+
+def export(args):
+    backend = open_backend(args)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    counts = Counter()
+    try:
+        for store, user_id, value in backend_records(backend, args.store or STORES):
+            output.write(storage.encode({"store": store, "user_id": user_id, "value": value}) + "\n")
+            counts[store] += 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        backend.close()
+    for store, count in counts.items():
+        print(f"📤 {store}: {count}", file=sys.stderr)
+
+
+def compact_dialog(value: list, max_history: int):
+    """Последние max_history сообщений в текущем формате; None, если менять нечего"""
+    if len(value) <= max_history and all(set(item) == {"role", "content", "ts"} for item in value):
+        return None
+    return [DialogRecord.from_json(item).to_json() for item in value[-max_history:]]
+
+
+def compact_compliments(value: list, max_history: int):
+    if len(value) <= max_history:
+        return None
+    return value[-max_history:]
+
+
+def compact(args):
+    backend = open_backend(args, read_only=args.dry_run)
+    transforms = {
+        DIALOGS: lambda user_id, value: compact_dialog(value, args.max_history),
+        COMPLIMENTS: lambda user_id, value: compact_compliments(value, args.max_compliments),
+    }
+    try:
+        for store, transform in transforms.items():
+            if args.dry_run:
+                seen = changed = 0
+                for _, value in backend.scan(store):
+                    seen += 1
+                    changed += transform(None, value) is not None
+            else:
+                seen, changed = backend.rewrite(store, transform)
+            print(f"🗜 {store}: записей {seen}, {'к сжатию' if args.dry_run else 'сжато'} {changed}")
+    finally:
+        backend.close()
+
+
+class Aggregates:
+    """Сводные показатели по потоку записей; память — O(дней + корзин), а не O(пользователей)"""
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.named = 0
+        self.active_by_day = Counter()  # день -> пользователей, писавших в этот день
+        self.message_buckets = Counter()
+        self.messages = 0
+        self.dialog_users = 0
+        self.max_messages = 0
+        self.schedule_hours = Counter()
+        self.scheduled_users = 0
+        self.compliments = 0
+        self.compliments_checked = 0
+        self.repeats = 0
+
+    def add(self, store: str, user_id: str, value):
+        if store == NAMES:
+            self.named += 1
+        elif store == DIALOGS:
+            self.add_dialog(value)
+        elif store == SCHEDULES:
+            slots = bot.schedule_slots(value)
+            if slots:
+                self.scheduled_users += 1
+            self.schedule_hours.update({slot // 60 for slot in slots})
+        elif store == COMPLIMENTS:
+            self.add_compliments(value)
+
+    def add_dialog(self, value: list):
+        records = [DialogRecord.from_json(item) for item in value]
+        user_records = [record for record in records if record.role.upper() == 'USER']
+        if not user_records:
+            return
+        self.dialog_users += 1
+        count = len(user_records)
+        self.messages += count
+        self.max_messages = max(self.max_messages, count)
+        self.message_buckets[next(label for bound, label in MESSAGE_BUCKETS if count <= bound)] += 1
+        days = {datetime.fromtimestamp(record.ts).date().isoformat() for record in user_records if record.ts}
+        self.active_by_day.update(days)
+
+    def add_compliments(self, value: list):
+        """Повтор — комплимент, похожий на один из полученных пользователем раньше"""
+        signatures = []
+        for record in value:
+            signature = record.get("sig") or similarity.signature(record["text"])
+            if signatures:
+                self.compliments_checked += 1
+                if similarity.max_similarity(signature, signatures) >= self.threshold:
+                    self.repeats += 1
+            signatures.append(signature)
+        self.compliments += len(value)
+
+    def report(self, days: int) -> dict:
+        recent = sorted(self.active_by_day.items())[-days:] if days else sorted(self.active_by_day.items())
+        return {
+            "named_users": self.named,
+            "dialog_users": self.dialog_users,
+            "active_users_by_day": dict(recent),
+            "messages_per_user": {
+                "mean": round(self.messages / self.dialog_users, 2) if self.dialog_users else 0,
+                "max": self.max_messages,
+                "histogram": {label: self.message_buckets[label] for _, label in MESSAGE_BUCKETS if self.message_buckets[label]},
+            },
+            "scheduled_users": self.scheduled_users,
+            "schedule_hours": {hour: self.schedule_hours[hour] for hour in sorted(self.schedule_hours)},
+            "compliments": self.compliments,
+            "repeat_compliment_rate": round(self.repeats / self.compliments_checked, 4) if self.compliments_checked else 0,
+        }
+
+
+def print_report(report: dict):
+    print(f"👤 Пользователей с именем: {report['named_users']}, с диалогом: {report['dialog_users']}")
+    print("\n📅 Активные пользователи по дням:")
+    for day, count in report['active_users_by_day'].items():
+        print(f"  {day}  {count}")
+    per_user = report['messages_per_user']
+    print(f"\n💬 Сообщений на пользователя (в сохранённой истории): среднее {per_user['mean']}, максимум {per_user['max']}")
+    for bucket, count in per_user['histogram'].items():
+        print(f"  {bucket:>5}  {count}")
+    print(f"\n⏰ Часы рассылки ({report['scheduled_users']} пользователей):")
+    for hour, count in report['schedule_hours'].items():
+        print(f"  {hour:02d}:00  {count}")
+    print(f"\n💐 Комплиментов: {report['compliments']}, доля повторов: {report['repeat_compliment_rate']:.1%}")
+
+
+def stats(args):
+    aggregates = Aggregates(args.threshold)
+    if args.input:
+        records = export_records(args.input, STORES)
+        backend = None
+    else:
+        backend = open_backend(args)
+        records = backend_records(backend, STORES)
+    try:
+        for store, user_id, value in records:
+            aggregates.add(store, user_id, value)
+    finally:
+        if backend:
+            backend.close()
+    report = aggregates.report(args.days)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Экспорт, сжатие и отчёты по состоянию бота")
+    parser.add_argument('--backend', default=bot.STORAGE_BACKEND, choices=('sqlite', 'json'), help="тип хранилища")
+    parser.add_argument('--db', default=bot.STATE_DB_FILE, help="файл SQLite")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help="выгрузить хранилища в JSON Lines")
+    export_parser.add_argument('--store', action='append', choices=STORES, help="хранилище (можно несколько; по умолчанию все)")
+    export_parser.add_argument('--output', default='-', help="файл выгрузки ('-' — stdout)")
+    export_parser.set_defaults(func=export)
+
+    compact_parser = commands.add_parser('compact', help="обрезать истории диалогов и комплиментов")
+    compact_parser.add_argument('--max-history', type=int, default=bot.MAX_DIALOG_HISTORY, help="сообщений диалога")
+    compact_parser.add_argument('--max-compliments', type=int, default=bot.MAX_COMPLIMENT_HISTORY, help="комплиментов")
+    compact_parser.add_argument('--dry-run', action='store_true', help="только посчитать, ничего не менять")
+    compact_parser.set_defaults(func=compact)
+
+    stats_parser = commands.add_parser('stats', help="сводные показатели")
+    stats_parser.add_argument('--input', help="выгрузка export вместо хранилища бота")
+    stats_parser.add_argument('--days', type=int, default=30, help="сколько последних дней активности показать (0 — все)")
+    stats_parser.add_argument(
+        '--threshold', type=float, default=bot.COMPLIMENT_SIMILARITY_THRESHOLD, help="сходство, с которого комплимент — повтор"
+    )
+    stats_parser.add_argument('--json', action='store_true', help="вывести результат в JSON")
+    stats_parser.set_defaults(func=stats)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,623 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from pathlib import Path
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Имена хранилищ состояния бота
+SCHEDULES = 'schedules'
+NAMES = 'names'
+DIALOGS = 'dialogs'
+COMPLIMENTS = 'compliments'
+SUMMARIES = 'summaries'
+STORES = (SCHEDULES, NAMES, DIALOGS, COMPLIMENTS, SUMMARIES)
+
+
+def _to_json(value):
+    # Компактные объекты бота (например, записи диалога) умеют сериализовать себя сами
+    if hasattr(value, 'to_json'):
+        return value.to_json()
+    if isinstance(value, deque):
+        return list(value)
+    raise TypeError(f"Не сериализуется: {type(value).__name__}")
+
+
+def encode(value) -> str:
+    """Сериализовать значение одной записи"""
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=_to_json)
+
+
+def iter_json_object(path, chunk_size: int = 1 << 16):
+    """Перебрать пары (ключ, значение) JSON-объекта верхнего уровня, не читая файл целиком:
+    в памяти одновременно не больше одной записи и буфера чтения"""
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ""
+        pos = 0
+        eof = False
+
+        def skip(chars: str):
+            # Пропустить пробелы и ровно один из разделителей chars (если он есть)
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos].isspace():
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    break
+                fill()
+            if pos < len(buffer) and buffer[pos] in chars:
+                pos += 1
+                return buffer[pos - 1]
+            return None
+
+        def fill():
+            nonlocal buffer, pos, eof
+            # Прочитанное отбрасываем; чтение растёт вместе с недочитанной записью
+            buffer = buffer[pos:]
+            pos = 0
+            chunk = f.read(max(chunk_size, len(buffer)))
+            if not chunk:
+                eof = True
+            buffer += chunk
+
+        def value():
+            nonlocal pos
+            while True:
+                skip("")
+                try:
+                    result, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    fill()
+                    continue
+                # Число на границе чтения могло оборваться («0.» разбирается как 0) —
+                # значение принимаем, только если за ним виден разделитель
+                if not eof and (end == len(buffer) or not (buffer[end].isspace() or buffer[end] in ",}]:")):
+                    fill()
+                    continue
+                pos = end
+                return result
+
+        if skip("{") is None:
+            if pos >= len(buffer):
+                return
+            raise ValueError(f"{path}: ожидался JSON-объект")
+        if skip("}"):
+            return
+        while True:
+            key = value()
+            if skip(":") is None:
+                raise ValueError(f"{path}: ожидалось ':' после ключа {key!r}")
+            yield key, value()
+            separator = skip(",}")
+            if separator == "}":
+                return
+            if separator is None:
+                raise ValueError(f"{path}: оборванный JSON")
+
+
+class JsonStateStore:
+    """Хранилище в JSON-файлах: каждое хранилище — отдельный файл user_id -> значение"""
+
+    def __init__(self, files: dict):
+        self.files = files
+        # lock защищает записи в памяти и держится недолго; запись файла идёт под
+        # write_lock, чтобы чтение из цикла событий не ждало fsync
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        # Храним уже сериализованные записи, чтобы запись файла не трогала живые объекты бота
+        self.encoded = {store: {} for store in STORES}
+        self.loaded = set()  # Хранилища, файл которых уже прочитан
+
+    def read_file(self, store: str) -> dict:
+        path = Path(self.files[store])
+        if not path.exists():
+            return {}
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return {user_id: encode(value) for user_id, value in data.items()}
+
+    def ensure_loaded(self, store: str):
+        """Прочитать файл хранилища при первом обращении к нему (вызывается под self.lock)"""
+        if store in self.loaded:
+            return
+        self.encoded[store] = self.read_file(store)
+        self.loaded.add(store)
+
+    def warm(self):
+        """Заранее прочитать файлы всех хранилищ (при старте, в потоке), чтобы первое
+        обращение из цикла событий не разбирало файл целиком"""
+        for store in STORES:
+            with self.lock:
+                if store in self.loaded:
+                    continue
+            # Разбираем без блокировки: хранилища, уже прочитанные, тем временем доступны
+            records = self.read_file(store)
+            with self.lock:
+                # Запись могла успеть прочитать файл сама и уже изменить его
+                if store not in self.loaded:
+                    self.encoded[store] = records
+                    self.loaded.add(store)
+
+    def load(self, store: str) -> dict:
+        """Загрузить хранилище целиком"""
+        return dict(self.items(store))
+
+    def get(self, store: str, user_id: str):
+        """Получить запись одного пользователя (None, если её нет)"""
+        with self.lock:
+            self.ensure_loaded(store)
+            raw = self.encoded[store].get(user_id)
+        return json.loads(raw) if raw is not None else None
+
+    def get_many(self, store: str, user_ids) -> dict:
+        """Записи нескольких пользователей {user_id: значение}; отсутствующих в ответе нет"""
+        with self.lock:
+            self.ensure_loaded(store)
+            records = self.encoded[store]
+            found = {user_id: records[user_id] for user_id in user_ids if user_id in records}
+        return {user_id: json.loads(raw) for user_id, raw in found.items()}
+
+    def items(self, store: str):
+        """Перебрать записи хранилища (user_id, значение)"""
+        with self.lock:
+            self.ensure_loaded(store)
+            snapshot = list(self.encoded[store].items())
+        for user_id, raw in snapshot:
+            yield user_id, json.loads(raw)
+
+    def write(self, store: str, changes: dict):
+        """Применить изменения {user_id: сериализованное значение или None для удаления}"""
+        with self.write_lock:
+            with self.lock:
+                # Иначе файл перезапишется только новыми записями
+                self.ensure_loaded(store)
+                records = self.encoded[store]
+                for user_id, raw in changes.items():
+                    if raw is None:
+                        records.pop(user_id, None)
+                    else:
+                        records[user_id] = raw
+                body = ','.join(f'{json.dumps(user_id)}:{raw}' for user_id, raw in records.items())
+            # Пишем во временный файл и атомарно подменяем, чтобы сбой не оставил обрывок JSON
+            path = self.files[store]
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write('{' + body + '}')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+
+    def put(self, store: str, user_id: str, value):
+        self.write(store, {user_id: encode(value)})
+
+    def delete(self, store: str, user_id: str):
+        self.write(store, {user_id: None})
+
+    def scan(self, store: str):
+        """Перебрать записи прямо из файла, не загружая хранилище в память"""
+        path = Path(self.files[store])
+        if path.exists():
+            yield from iter_json_object(path)
+
+    def rewrite(self, store: str, transform) -> tuple:
+        """Переписать файл хранилища потоком: transform(user_id, значение) возвращает
+        новое значение или None, если запись не меняется. Бот при этом должен быть остановлен:
+        он держит файл в памяти и перезапишет его своей копией. Возвращает (записей, изменено)"""
+        path = self.files[store]
+        if not Path(path).exists():
+            return 0, 0
+        seen = changed = 0
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('{')
+            for user_id, value in iter_json_object(path):
+                new_value = transform(user_id, value)
+                if new_value is not None:
+                    value = new_value
+                    changed += 1
+                f.write(f"{',' if seen else ''}{json.dumps(user_id)}:{encode(value)}")
+                seen += 1
+            f.write('}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.loaded.discard(store)
+            self.encoded[store] = {}
+        return seen, changed
+
+    def claim(self, name: str) -> bool:
+        """JSON-файлы не делятся между процессами — занимать нечего"""
+        return True
+
+    def close(self):
+        pass
+
+
+class SqliteStateStore:
+    """Хранилище в SQLite (WAL): одна строка на пользователя в каждом хранилище"""
+
+    def __init__(self, path: str, legacy_files: dict = None, read_only: bool = False):
+        self.path = path
+        self.lock = threading.Lock()
+        if read_only:
+            # Только чтение существующей базы (отчёты, выгрузка): ни схемы, ни миграции
+            self.conn = sqlite3.connect(
+                f"{Path(path).resolve().as_uri()}?mode=ro", uri=True, timeout=30.0,
+                check_same_thread=False, isolation_level=None
+            )
+            self.reader, self.read_lock = self.conn, self.lock
+            return
+        # Файл может быть общим для нескольких процессов-воркеров: ждём блокировку, а не падаем
+        self.conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "store TEXT NOT NULL, user_id TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (store, user_id)) WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS claims (name TEXT PRIMARY KEY, claimed_at REAL NOT NULL)")
+        if legacy_files:
+            self.migrate_json(legacy_files)
+        # Отдельное соединение для чтения: в WAL читатель не ждёт пишущую транзакцию,
+        # и подгрузка записи из цикла событий не стоит в очереди за сбросом в потоке
+        self.reader = sqlite3.connect(path, timeout=30.0, check_same_thread=False, isolation_level=None)
+        self.read_lock = threading.Lock()
+
+    def migrate_json(self, files: dict):
+        """Однократно перенести данные из старых JSON-файлов"""
+        with self.lock:
+            # IMMEDIATE: при одновременном старте воркеров миграцию выполнит только один
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                done = self.conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+                if done:
+                    self.conn.execute("COMMIT")
+                    return
+                for store, file in files.items():
+                    if not Path(file).exists():
+                        continue
+                    with open(file, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO state (store, user_id, value) VALUES (?, ?, ?)",
+                        [(store, str(user_id), encode(value)) for user_id, value in data.items()]
+                    )
+                    logger.info(f"📦 Перенесено из {file}: {len(data)} записей")
+                self.conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', '1')")
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def load(self, store: str) -> dict:
+        """Загрузить хранилище целиком"""
+        return dict(self.items(store))
+
+    def get(self, store: str, user_id: str):
+        """Получить запись одного пользователя (None, если её нет)"""
+        with self.read_lock:
+            row = self.reader.execute(
+                "SELECT value FROM state WHERE store = ? AND user_id = ?", (store, user_id)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, store: str, user_ids, page: int = 500) -> dict:
+        """Записи нескольких пользователей {user_id: значение} — запрос на page пользователей,
+        а не на каждого; отсутствующих в ответе нет"""
+        user_ids = list(user_ids)
+        records = {}
+        for start in range(0, len(user_ids), page):
+            chunk = user_ids[start:start + page]
+            with self.read_lock:
+                rows = self.reader.execute(
+                    f"SELECT user_id, value FROM state WHERE store = ? AND user_id IN ({','.join('?' * len(chunk))})",
+                    (store, *chunk)
+                ).fetchall()
+            records.update((user_id, json.loads(raw)) for user_id, raw in rows)
+        return records
+
+    def items(self, store: str):
+        """Перебрать записи хранилища (user_id, значение)"""
+        with self.read_lock:
+            rows = self.reader.execute(
+                "SELECT user_id, value FROM state WHERE store = ?", (store,)
+            ).fetchall()
+        for user_id, raw in rows:
+            yield user_id, json.loads(raw)
+
+    def write(self, store: str, changes: dict):
+        """Применить изменения {user_id: сериализованное значение или None для удаления}"""
+        upserts = [(store, user_id, raw) for user_id, raw in changes.items() if raw is not None]
+        deletes = [(store, user_id) for user_id, raw in changes.items() if raw is None]
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                if upserts:
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO state (store, user_id, value) VALUES (?, ?, ?)", upserts
+                    )
+                if deletes:
+                    self.conn.executemany("DELETE FROM state WHERE store = ? AND user_id = ?", deletes)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def put(self, store: str, user_id: str, value):
+        self.write(store, {user_id: encode(value)})
+
+    def delete(self, store: str, user_id: str):
+        self.write(store, {user_id: None})
+
+    def scan(self, store: str, page: int = 500):
+        """Перебрать записи страницами по page штук (по возрастанию user_id): в памяти
+        только одна страница, а блокировка не держится, пока вызывающий обрабатывает записи"""
+        last = ""
+        while True:
+            with self.read_lock:
+                rows = self.reader.execute(
+                    "SELECT user_id, value FROM state WHERE store = ? AND user_id > ? ORDER BY user_id LIMIT ?",
+                    (store, last, page)
+                ).fetchall()
+            if not rows:
+                return
+            for user_id, raw in rows:
+                yield user_id, json.loads(raw)
+            last = rows[-1][0]
+
+    def rewrite(self, store: str, transform, page: int = 500) -> tuple:
+        """Переписать записи хранилища: transform(user_id, значение) возвращает новое
+        значение или None, если запись не меняется. Изменения пишутся постранично.
+        Возвращает (записей, изменено)"""
+        seen = changed = 0
+        changes = {}
+        for user_id, value in self.scan(store, page):
+            seen += 1
+            new_value = transform(user_id, value)
+            if new_value is not None:
+                changes[user_id] = encode(new_value)
+            if len(changes) >= page:
+                self.write(store, changes)
+                changed += len(changes)
+                changes = {}
+        if changes:
+            self.write(store, changes)
+            changed += len(changes)
+        return seen, changed
+
+    def warm(self):
+        """Записи читаются запросами по пользователю — заранее читать нечего"""
+
+    def claim(self, name: str, keep_seconds: float = 2 * 24 * 3600) -> bool:
+        """Атомарно занять имя (например, слот рассылки); False, если его уже занял кто-то другой"""
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO claims (name, claimed_at) VALUES (?, ?)", (name, now)
+            )
+            claimed = cursor.rowcount == 1
+            if claimed:
+                self.conn.execute("DELETE FROM claims WHERE claimed_at < ?", (now - keep_seconds,))
+        return claimed
+
+    def close(self):
+        with self.read_lock:
+            if self.reader is not self.conn:
+                self.reader.close()
+        with self.lock:
+            self.conn.close()
+
+
+class WriteBehindStore:
+    """Отложенная запись поверх хранилища: изменения копятся в памяти и сбрасываются пачкой
+    по таймеру или при накоплении max_pending записей, в отдельном потоке"""
+
+    def __init__(self, backend, interval: float = 5.0, max_pending: int = 500):
+        self.backend = backend
+        self.interval = interval
+        self.max_pending = max_pending
+        # store -> {user_id: живой объект или None для удаления}
+        self.pending = {store: {} for store in STORES}
+        # store -> {user_id: сериализованное значение или None}: уже отдано на запись
+        # (или не записалось из-за ошибки), но ещё не подтверждено хранилищем
+        self.unflushed = {store: {} for store in STORES}
+        self.flush_lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.flushes = 0
+        self.records_written = 0
+
+    def dirty_count(self) -> int:
+        return sum(len(changes) for changes in self.pending.values())
+
+    def load(self, store: str) -> dict:
+        return self.backend.load(store)
+
+    def unwritten(self, store: str, user_id: str) -> tuple:
+        """(True, значение), если у записи есть изменение, ещё не подтверждённое хранилищем:
+        пока оно не записано, в хранилище может лежать старое значение"""
+        if user_id in self.pending[store]:
+            return True, self.pending[store][user_id]
+        if user_id in self.unflushed[store]:
+            raw = self.unflushed[store][user_id]
+            return True, json.loads(raw) if raw is not None else None
+        return False, None
+
+    def get(self, store: str, user_id: str):
+        found, value = self.unwritten(store, user_id)
+        if found:
+            return value
+        return self.backend.get(store, user_id)
+
+    async def get_many(self, store: str, user_ids) -> dict:
+        """Записи нескольких пользователей {user_id: значение или None}: хранилище читается
+        пачкой в потоке, а не по запросу на пользователя в цикле событий"""
+        # Сброс не завершится посреди чтения, поэтому изменение, записанное не раньше
+        # прочитанного значения, к концу чтения ещё лежит в pending или unflushed
+        async with self.flush_lock:
+            loaded = await asyncio.to_thread(self.backend.get_many, store, list(user_ids))
+        records = {}
+        for user_id in user_ids:
+            found, value = self.unwritten(store, user_id)
+            records[user_id] = value if found else loaded.get(user_id)
+        return records
+
+    def items(self, store: str):
+        pending = dict(self.pending[store])
+        unflushed = {
+            user_id: json.loads(raw) if raw is not None else None
+            for user_id, raw in self.unflushed[store].items() if user_id not in pending
+        }
+        unflushed.update(pending)
+        for user_id, value in self.backend.items(store):
+            if user_id not in unflushed:
+                yield user_id, value
+        for user_id, value in unflushed.items():
+            if value is not None:
+                yield user_id, value
+
+    def put(self, store: str, user_id: str, value):
+        """Пометить запись грязной; сериализуется она только при сбросе"""
+        self.pending[store][user_id] = value
+        if self.dirty_count() >= self.max_pending:
+            self.wakeup.set()
+
+    def delete(self, store: str, user_id: str):
+        self.put(store, user_id, None)
+
+    async def flush(self):
+        """Сбросить накопленные изменения в хранилище"""
+        async with self.flush_lock:
+            for store in STORES:
+                pending, self.pending[store] = self.pending[store], {}
+                if not pending and not self.unflushed[store]:
+                    continue
+                # Сериализуем в цикле событий: объекты бота могут меняться, пока поток пишет.
+                # Изменения остаются в unflushed, пока запись не пройдёт: get и items
+                # читают их оттуда, а не старое значение из хранилища
+                changes = self.unflushed[store]
+                with registry.timer('storage_encode_seconds', store=store):
+                    for user_id, value in pending.items():
+                        changes[user_id] = encode(value) if value is not None else None
+                started = time.perf_counter()
+                try:
+                    await asyncio.to_thread(self.backend.write, store, changes)
+                    self.unflushed[store] = {}
+                    self.flushes += 1
+                    self.records_written += len(changes)
+                    registry.observe('storage_flush_seconds', time.perf_counter() - started, store=store)
+                    registry.inc('storage_records_written_total', len(changes), store=store)
+                    registry.inc(
+                        'storage_bytes_written_total',
+                        sum(len(value.encode('utf-8')) for value in changes.values() if value is not None), store=store
+                    )
+                except Exception as e:
+                    registry.inc('storage_flush_errors_total', store=store)
+                    logger.error(f"Ошибка сброса хранилища {store}: {e}")
+
+    async def run(self):
+        """Фоновый цикл сброса изменений"""
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def warm(self):
+        """Прогреть хранилище в потоке, не задерживая цикл событий"""
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(self.backend.warm)
+            logger.info(f"🔥 Хранилище прогрето за {time.perf_counter() - started:.1f} с")
+        except Exception as e:
+            logger.error(f"Ошибка прогрева хранилища: {e}")
+
+    def claim(self, name: str) -> bool:
+        return self.backend.claim(name)
+
+    def close(self):
+        self.backend.close()
+
+
+class LazyRecords:
+    """Записи одного хранилища, которые читаются по пользователю при первом обращении.
+
+    Ведёт себя как словарь user_id -> значение для get / in / [] / []=. В памяти
+    держится не больше max_users последних записей (включая отметки «записи нет»);
+    изменённые записи к этому моменту уже переданы в storage.put, так что
+    вытеснение ничего не теряет.
+    """
+
+    def __init__(self, storage, store: str, max_users: int = 10000):
+        self.storage = storage
+        self.store = store
+        self.max_users = max_users
+        self.cache = OrderedDict()  # user_id -> значение или None, порядок — давность обращения
+        self.loads = 0
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def get(self, user_id: str, default=None):
+        if user_id in self.cache:
+            self.cache.move_to_end(user_id)
+            value = self.cache[user_id]
+        else:
+            value = self.storage.get(self.store, user_id)
+            self.loads += 1
+            self.remember(user_id, value)
+        return default if value is None else value
+
+    def __contains__(self, user_id: str) -> bool:
+        return self.get(user_id) is not None
+
+    def __getitem__(self, user_id: str):
+        value = self.get(user_id)
+        if value is None:
+            raise KeyError(user_id)
+        return value
+
+    def __setitem__(self, user_id: str, value):
+        self.remember(user_id, value)
+
+    async def preload(self, user_ids):
+        """Подгрузить записи нескольких пользователей одним чтением в потоке, чтобы
+        следующие обращения к ним не читали хранилище из цикла событий"""
+        missing = [user_id for user_id in user_ids if user_id not in self.cache]
+        if not missing:
+            return
+        records = await self.storage.get_many(self.store, missing)
+        for user_id in missing:
+            # Пока читали, запись могли изменить: свежее значение уже в кэше
+            if user_id not in self.cache:
+                self.loads += 1
+                self.remember(user_id, records.get(user_id))
+
+    def remember(self, user_id: str, value):
+        self.cache[user_id] = value
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.max_users:
+            self.cache.popitem(last=False)
+
+
+def open_store(backend: str, files: dict, db_path: str):
+    """Создать хранилище выбранного типа ('sqlite' или 'json')"""
+    if backend == 'json':
+        logger.info("💾 Хранилище: JSON-файлы")
+        return JsonStateStore(files)
+    logger.info(f"💾 Хранилище: SQLite ({db_path})")
+    return SqliteStateStore(db_path, legacy_files=files)
@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, DeadlineExceeded, OverloadedError, LIVE, COMMAND, BACKGROUND
+
+
+def controller(max_concurrency: int = 1, queue_limit: int = 10, deadline: float = 5.0, **kwargs):
+    return AdmissionController(
+        max_concurrency,
+        queue_limits={priority: queue_limit for priority in (LIVE, COMMAND, BACKGROUND)},
+        deadlines={priority: deadline for priority in (LIVE, COMMAND, BACKGROUND)},
+        **kwargs,
+    )
+
+
+def test_free_slot_is_taken_without_queueing():
+    async def scenario():
+        admission = controller(max_concurrency=2)
+        async with admission.slot(LIVE, user="1"):
+            async with admission.slot(COMMAND, user="2"):
+                assert admission.active == 2
+        assert admission.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_waiters_are_served_by_priority_then_round_robin_between_users():
+    async def scenario():
+        admission = controller()
+        order = []
+
+        async def request(priority, user, label):
+            async with admission.slot(priority, user=user):
+                order.append(label)
+
+        await admission.acquire(LIVE)
+        tasks = [
+            asyncio.create_task(request(BACKGROUND, "1", "background")),
+            asyncio.create_task(request(COMMAND, "1", "1a")),
+            asyncio.create_task(request(COMMAND, "1", "1b")),
+            asyncio.create_task(request(COMMAND, "2", "2a")),
+            asyncio.create_task(request(LIVE, "3", "live")),
+        ]
+        await asyncio.sleep(0)
+        admission.release(LIVE)
+        await asyncio.gather(*tasks)
+        assert order == ["live", "1a", "2a", "1b", "background"]
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_and_per_user_limit_are_rejected():
+    async def scenario():
+        admission = controller(queue_limit=2, per_user_limit=1)
+        await admission.acquire(LIVE)
+        waiting = asyncio.create_task(admission.acquire(COMMAND, user="1"))
+        await asyncio.sleep(0)
+        with pytest.raises(OverloadedError):
+            await admission.acquire(COMMAND, user="1")
+        other = asyncio.create_task(admission.acquire(COMMAND, user="2"))
+        await asyncio.sleep(0)
+        with pytest.raises(OverloadedError):
+            await admission.acquire(COMMAND, user="3")
+        assert admission.shed == 2
+        waiting.cancel()
+        other.cancel()
+        await asyncio.gather(waiting, other, return_exceptions=True)
+        assert admission.queued[COMMAND] == 0
+
+    asyncio.run(scenario())
+
+
+def test_waiter_past_its_deadline_is_dropped():
+    async def scenario():
+        admission = controller(deadline=0.05)
+        await admission.acquire(LIVE)
+        with pytest.raises(DeadlineExceeded):
+            await admission.acquire(COMMAND, user="1")
+        assert admission.expired == 1
+        assert admission.queued[COMMAND] == 0
+        admission.release(LIVE)
+        assert admission.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_background_share_leaves_room_for_interactive_requests():
+    async def scenario():
+        admission = controller(max_concurrency=2, background_share=0.5)
+        await admission.acquire(BACKGROUND)
+        queued = asyncio.create_task(admission.acquire(BACKGROUND))
+        await asyncio.sleep(0)
+        assert not queued.done()
+        async with admission.slot(LIVE):
+            assert admission.active == 2
+        admission.release(BACKGROUND)
+        await queued
+        assert admission.active_by_class[BACKGROUND] == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,31 @@
+from datetime import date, datetime
+
+import bot
+
+
+def test_due_slots_first_tick_takes_current_minute():
+    assert bot.due_slots(datetime(2026, 3, 1, 8, 29, 45)) == [(date(2026, 3, 1), 8 * 60 + 30)]
+
+
+def test_due_slots_skips_already_processed_minute():
+    assert bot.due_slots(datetime(2026, 3, 1, 8, 30, 10), 8 * 60 + 30) == []
+
+
+def test_due_slots_catches_up_missed_minutes():
+    assert bot.due_slots(datetime(2026, 3, 1, 8, 33, 0), 8 * 60 + 30) == [
+        (date(2026, 3, 1), 8 * 60 + 31), (date(2026, 3, 1), 8 * 60 + 32), (date(2026, 3, 1), 8 * 60 + 33)
+    ]
+
+
+def test_due_slots_long_gap_takes_only_current_minute():
+    assert bot.due_slots(datetime(2026, 3, 1, 9, 0, 0), 8 * 60) == [(date(2026, 3, 1), 9 * 60)]
+
+
+def test_due_slots_early_tick_before_midnight_belongs_to_next_day():
+    assert bot.due_slots(datetime(2026, 3, 1, 23, 59, 50), 23 * 60 + 59) == [(date(2026, 3, 2), 0)]
+
+
+def test_due_slots_catch_up_across_midnight_keeps_each_slot_date():
+    assert bot.due_slots(datetime(2026, 3, 2, 0, 1, 5), 23 * 60 + 58) == [
+        (date(2026, 3, 1), 23 * 60 + 59), (date(2026, 3, 2), 0), (date(2026, 3, 2), 1)
+    ]
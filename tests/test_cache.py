@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+
+from cache import ResponseCache
+
+
+def message(role: str, content: str):
+    return SimpleNamespace(role=role, content=content)
+
+
+def test_make_key_ignores_whitespace_but_not_params():
+    key = ResponseCache.make_key([message("user", "Привет,  мир\n")], temperature=1.0)
+    assert key == ResponseCache.make_key([message("user", "Привет, мир")], temperature=1.0)
+    assert key != ResponseCache.make_key([message("user", "Привет, мир")], temperature=0.5)
+    assert key != ResponseCache.make_key([message("system", "Привет, мир")], temperature=1.0)
+
+
+def test_cache_misses_until_enough_variants_then_rotates():
+    cache = ResponseCache(variants=2)
+    assert cache.get("k") is None
+    cache.put("k", "первый")
+    cache.put("k", "первый")
+    assert cache.get("k") is None
+    assert cache.peek("k") == "первый"
+    cache.put("k", "второй")
+
+    assert [cache.get("k") for _ in range(3)] == ["первый", "второй", "первый"]
+    assert (cache.hits, cache.misses) == (3, 2)
+
+
+def test_cache_drops_expired_variants_and_old_keys():
+    cache = ResponseCache(max_keys=2, ttl=0.0, variants=1)
+    cache.put("a", "текст")
+    assert cache.get("a") is None
+    assert cache.peek("a") is None
+
+    cache.ttl = 60.0
+    cache.put("b", "текст")
+    cache.put("c", "текст")
+    assert list(cache.entries) == ["b", "c"]
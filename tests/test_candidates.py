@@ -0,0 +1,32 @@
+import candidates
+
+
+def test_parse_numbered_variants():
+    text = (
+        "Вот несколько вариантов:\n"
+        "1. «Ваша улыбка делает этот день светлее.»\n"
+        "2) **Рядом с вами хочется быть лучше.**\n"
+        "3. Коротко\n"
+        "4. Ваша улыбка делает этот день светлее.\n"
+    )
+    assert candidates.parse(text) == [
+        "Ваша улыбка делает этот день светлее.",
+        "Рядом с вами хочется быть лучше.",
+    ]
+
+
+def test_parse_without_numbering_takes_whole_text():
+    assert candidates.parse("  Вы умеете слушать так,\nчто хочется говорить.  ") == [
+        "Вы умеете слушать так, что хочется говорить."
+    ]
+
+
+def test_parse_drops_meta_lines_and_applies_limit():
+    text = "1. Конечно! Вот комплимент\n2. Первый настоящий комплимент.\n3. Второй настоящий комплимент."
+    assert candidates.parse(text, limit=1) == ["Первый настоящий комплимент."]
+
+
+def test_batch_prompt_replaces_answer_tail():
+    prompt = candidates.batch_prompt("Придумай комплимент.\nКомплимент:", 3)
+    assert not prompt.rstrip().endswith("Комплимент:")
+    assert "Напиши 3 РАЗНЫХ вариантов" in prompt
@@ -0,0 +1,206 @@
+import asyncio
+import json
+import random
+import threading
+
+import pytest
+
+import storage
+
+
+def write(tmp_path, text: str):
+    path = tmp_path / "store.json"
+    path.write_text(text, encoding="utf-8")
+    return path
+
+
+def parse(path, chunk_size: int) -> dict:
+    return dict(storage.iter_json_object(path, chunk_size))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1 << 16])
+@pytest.mark.parametrize("text", [
+    '{"a": -25000000000.0, "b": 0.0001}',
+    '{"a": 1e-7, "b": [1.5, -2, 3E+10], "c": {"d": 0}}',
+    '{"1": [{"role": "USER", "content": "при{в}ет \\"x\\", :", "ts": 1}], "2": "я"}',
+    '{ "a" : null ,\n  "b" : true , "c" : 12345678901234 }',
+    '{}',
+    ' { } ',
+    '',
+])
+def test_iter_json_object_matches_json_load(tmp_path, text, chunk_size):
+    expected = json.loads(text) if text.strip() else {}
+    assert parse(write(tmp_path, text), chunk_size) == expected
+
+
+def test_iter_json_object_numbers_across_chunk_boundaries(tmp_path):
+    rng = random.Random(0)
+    for _ in range(50):
+        data = {str(i): rng.choice([rng.uniform(-1e12, 1e12), rng.randint(-10 ** 15, 10 ** 15), 2.5e-7, -0.5])
+                for i in range(rng.randint(1, 8))}
+        path = write(tmp_path, json.dumps(data))
+        for chunk_size in (1, 2, 3, 5, 16):
+            assert parse(path, chunk_size) == data
+
+
+@pytest.mark.parametrize("text", ['{"a": 1', '{"a" 1}', '[1, 2]', '{"a": 1,'])
+def test_iter_json_object_rejects_broken_json(tmp_path, text):
+    with pytest.raises(ValueError):
+        parse(write(tmp_path, text), 2)
+
+
+def test_json_store_rewrite_streams_changes(tmp_path):
+    files = {store: str(tmp_path / f"{store}.json") for store in storage.STORES}
+    backend = storage.JsonStateStore(files)
+    backend.put(storage.NAMES, "1", "Анна")
+    backend.put(storage.NAMES, "2", "Мария")
+
+    seen, changed = backend.rewrite(storage.NAMES, lambda user_id, value: value.upper() if user_id == "1" else None)
+
+    assert (seen, changed) == (2, 1)
+    assert dict(backend.scan(storage.NAMES)) == {"1": "АННА", "2": "Мария"}
+    assert backend.get(storage.NAMES, "1") == "АННА"
+
+
+def test_sqlite_store_scan_and_rewrite_pages(tmp_path):
+    backend = storage.SqliteStateStore(str(tmp_path / "state.db"))
+    backend.write(storage.NAMES, {f"{i:04d}": storage.encode(i) for i in range(1203)})
+
+    seen, changed = backend.rewrite(storage.NAMES, lambda user_id, value: value + 1 if value % 2 else None, page=100)
+
+    assert (seen, changed) == (1203, 601)
+    assert sum(1 for _ in backend.scan(storage.NAMES, page=100)) == 1203
+    assert backend.get(storage.NAMES, "0003") == 4
+    backend.close()
+
+
+class SlowBackend:
+    """Хранилище, запись в которое ждёт сигнала или падает"""
+
+    def __init__(self, fail: bool = False):
+        self.records = {}
+        self.fail = fail
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def get(self, store, user_id):
+        raw = self.records.get((store, user_id))
+        return json.loads(raw) if raw is not None else None
+
+    def items(self, store):
+        for (record_store, user_id), raw in list(self.records.items()):
+            if record_store == store:
+                yield user_id, json.loads(raw)
+
+    def write(self, store, changes):
+        self.started.set()
+        self.release.wait(5)
+        if self.fail:
+            raise OSError("диск недоступен")
+        for user_id, raw in changes.items():
+            if raw is None:
+                self.records.pop((store, user_id), None)
+            else:
+                self.records[(store, user_id)] = raw
+
+
+def test_write_behind_reads_records_during_flush():
+    async def scenario():
+        backend = SlowBackend()
+        backend.records[(storage.NAMES, "1")] = storage.encode("старое")
+        store = storage.WriteBehindStore(backend)
+        store.put(storage.NAMES, "1", "новое")
+        store.put(storage.NAMES, "2", "Мария")
+        flush = asyncio.create_task(store.flush())
+        await asyncio.to_thread(backend.started.wait, 5)
+
+        assert store.get(storage.NAMES, "1") == "новое"
+        assert store.get(storage.NAMES, "2") == "Мария"
+        assert dict(store.items(storage.NAMES)) == {"1": "новое", "2": "Мария"}
+
+        backend.release.set()
+        await flush
+        assert store.get(storage.NAMES, "1") == "новое"
+        assert store.unflushed[storage.NAMES] == {}
+
+    asyncio.run(scenario())
+
+
+def test_write_behind_keeps_failed_records_readable():
+    async def scenario():
+        backend = SlowBackend(fail=True)
+        backend.release.set()
+        backend.records[(storage.NAMES, "1")] = storage.encode("старое")
+        store = storage.WriteBehindStore(backend)
+        store.put(storage.NAMES, "1", "новое")
+        store.delete(storage.DIALOGS, "1")
+        backend.records[(storage.DIALOGS, "1")] = storage.encode([1])
+        await store.flush()
+
+        assert store.get(storage.NAMES, "1") == "новое"
+        assert store.get(storage.DIALOGS, "1") is None
+        assert dict(store.items(storage.NAMES)) == {"1": "новое"}
+
+        backend.fail = False
+        await store.flush()
+        assert backend.get(storage.NAMES, "1") == "новое"
+        assert backend.get(storage.DIALOGS, "1") is None
+        assert store.unflushed[storage.NAMES] == {}
+
+    asyncio.run(scenario())
+
+
+def test_lazy_records_preload_reads_unwritten_changes(tmp_path):
+    async def scenario():
+        backend = storage.SqliteStateStore(str(tmp_path / "state.db"))
+        backend.write(storage.NAMES, {str(i): storage.encode(f"имя {i}") for i in range(1200)})
+        store = storage.WriteBehindStore(backend)
+        store.put(storage.NAMES, "5", "новое")
+        store.delete(storage.NAMES, "6")
+        names = storage.LazyRecords(store, storage.NAMES)
+
+        await names.preload([str(i) for i in range(1300)])
+
+        assert names.loads == 1300
+        assert names.get("5") == "новое"
+        assert names.get("6") is None
+        assert names.get("1199") == "имя 1199"
+        assert names.get("1250") is None
+        assert names.loads == 1300
+        backend.close()
+
+    asyncio.run(scenario())
+
+
+def test_json_store_warm_reads_files_up_front(tmp_path):
+    files = {store: str(tmp_path / f"{store}.json") for store in storage.STORES}
+    (tmp_path / f"{storage.NAMES}.json").write_text('{"1": "Анна"}', encoding="utf-8")
+    backend = storage.JsonStateStore(files)
+
+    asyncio.run(storage.WriteBehindStore(backend).warm())
+    (tmp_path / f"{storage.NAMES}.json").unlink()
+
+    assert backend.loaded == set(storage.STORES)
+    assert backend.get(storage.NAMES, "1") == "Анна"
+
+
+def test_write_behind_batches_changes_until_flush(tmp_path):
+    async def scenario():
+        backend = storage.SqliteStateStore(str(tmp_path / "state.db"))
+        backend.put(storage.NAMES, "3", "Ольга")
+        store = storage.WriteBehindStore(backend, max_pending=3)
+        store.put(storage.NAMES, "1", "Анна")
+        store.put(storage.NAMES, "2", "Мария")
+        store.delete(storage.NAMES, "3")
+
+        assert backend.load(storage.NAMES) == {"3": "Ольга"}
+        assert dict(store.items(storage.NAMES)) == {"1": "Анна", "2": "Мария"}
+        assert store.dirty_count() == 3 and store.wakeup.is_set()
+
+        await store.flush()
+        assert backend.load(storage.NAMES) == {"1": "Анна", "2": "Мария"}
+        assert store.dirty_count() == 0
+        assert (store.flushes, store.records_written) == (1, 3)
+        backend.close()
+
+    asyncio.run(scenario())